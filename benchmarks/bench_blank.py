@@ -0,0 +1,87 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Benchmark adding blank pages to documents of various lengths
+
+Compares blank_pdf with copying the pages to a new document and adding a
+separate blank page after every page, which is how blank pages used to be
+added. Reports the time, the size of the output, and the number of objects.
+
+Usage: python benchmarks/bench_blank.py [--repeat N] [PAGES ...]
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+
+import pikepdf
+
+from paper2remarkable.pdf_ops import blank_pdf
+
+DEFAULT_PAGES = [10, 100, 500, 1000, 2000]
+
+
+def blank_pdf_copy(filepath):
+    """Add blank pages by copying to a new document"""
+    pdf = pikepdf.Pdf.open(filepath)
+    dst = pikepdf.Pdf.new()
+    for page in pdf.pages:
+        dst.pages.append(page)
+        x0, y0, x1, y1 = page.MediaBox
+        dst.add_blank_page(page_size=(x1 - x0, y1 - y0))
+    output_file = os.path.splitext(filepath)[0] + "-copy.pdf"
+    dst.save(output_file)
+    return output_file
+
+
+def make_document(filename, pages):
+    pdf = pikepdf.new()
+    for i in range(pages):
+        pdf.add_blank_page(page_size=(612, 792))
+        pdf.pages[-1].Contents = pdf.make_stream(b"BT (Page %i) Tj ET" % i)
+    pdf.save(filename)
+
+
+def bench(func, filename, repeat):
+    """Best time of func on the file, and the size and object count"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = func(filename)
+        times.append(time.perf_counter() - start)
+    with pikepdf.open(output) as pdf:
+        n_objects = len(pdf.objects)
+    return min(times), os.path.getsize(output), n_objects
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("pages", nargs="*", type=int, default=DEFAULT_PAGES)
+    args = parser.parse_args()
+
+    methods = {"blank_pdf": blank_pdf, "copy": blank_pdf_copy}
+    tmpdir = tempfile.mkdtemp(prefix="p2r_bench_")
+    try:
+        print(
+            "%6s %-10s %10s %12s %8s"
+            % ("pages", "method", "seconds", "bytes", "objects")
+        )
+        for pages in args.pages:
+            filename = os.path.join(tmpdir, "doc_%i.pdf" % pages)
+            make_document(filename, pages)
+            for name, func in methods.items():
+                seconds, size, n_objects = bench(func, filename, args.repeat)
+                print(
+                    "%6i %-10s %10.3f %12i %8i"
+                    % (pages, name, seconds, size, n_objects)
+                )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
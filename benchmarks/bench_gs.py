@@ -0,0 +1,132 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Compare the throughput of Ghostscript settings
+
+Generates an image-heavy and a vector-heavy document (or uses the PDF files
+given on the command line) and shrinks them with the default settings, with
+rendering threads, with the tuned pdfwrite profile, and in-process with
+libgs. Requires Ghostscript.
+
+Usage: python benchmarks/bench_gs.py [--gs GS] [--repeat N] [PDF ...]
+
+"""
+
+import argparse
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+import pikepdf
+
+from paper2remarkable.pdf_ops import shrink_pdf
+
+SETTINGS = {
+    "default": {},
+    "threads": {"gs_threads": os.cpu_count() or 1},
+    "tuned": {"gs_tuned": True},
+    "threads+tuned": {"gs_threads": os.cpu_count() or 1, "gs_tuned": True},
+    "libgs": {"gs_backend": "libgs"},
+}
+
+
+def make_image_heavy(filename, pages=10, size=1200):
+    """Pages that each show a large image"""
+    pdf = pikepdf.new()
+    for p in range(pages):
+        data = bytes(
+            (x * 7 + y * 13 + p) % 256
+            for y in range(size)
+            for x in range(size)
+        )
+        image = pdf.make_stream(zlib.compress(data))
+        image.Type = pikepdf.Name.XObject
+        image.Subtype = pikepdf.Name.Image
+        image.Width = image.Height = size
+        image.ColorSpace = pikepdf.Name.DeviceGray
+        image.BitsPerComponent = 8
+        image.Filter = pikepdf.Name.FlateDecode
+        pdf.add_blank_page(page_size=(612, 792))
+        page = pdf.pages[-1].obj
+        page.Resources = pikepdf.Dictionary(
+            XObject=pikepdf.Dictionary(Im0=image)
+        )
+        page.Contents = pdf.make_stream(b"q 512 0 0 512 50 200 cm /Im0 Do Q")
+    pdf.save(filename)
+
+
+def make_vector_heavy(filename, pages=10, paths=5000):
+    """Pages with many small stroked paths"""
+    pdf = pikepdf.new()
+    for p in range(pages):
+        ops = []
+        for i in range(paths):
+            x, y = (i * 37 + p) % 560 + 20, (i * 53) % 740 + 20
+            ops.append(
+                b"%i %i m %i %i l %i %i l h S"
+                % (x, y, x + 9, y + 3, x + 4, y + 8)
+            )
+        pdf.add_blank_page(page_size=(612, 792))
+        pdf.pages[-1].obj.Contents = pdf.make_stream(b"\n".join(ops))
+    pdf.save(filename)
+
+
+def bench(filename, gs_path, settings, repeat):
+    """Best time of shrinking the file with the settings, in seconds"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        output = shrink_pdf(filename, gs_path=gs_path, **settings)
+        times.append(time.perf_counter() - start)
+        if output != filename:
+            os.unlink(output)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--gs", default="gs", help="path to Ghostscript")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("files", nargs="*", help="PDF files to use")
+    args = parser.parse_args()
+
+    if shutil.which(args.gs) is None:
+        parser.error("Ghostscript not found: %s" % args.gs)
+
+    tmpdir = tempfile.mkdtemp(prefix="p2r_bench_")
+    try:
+        files = list(args.files)
+        if not files:
+            files = [
+                os.path.join(tmpdir, "image_heavy.pdf"),
+                os.path.join(tmpdir, "vector_heavy.pdf"),
+            ]
+            make_image_heavy(files[0])
+            make_vector_heavy(files[1])
+
+        print(
+            "%-20s %-15s %10s %12s"
+            % ("file", "settings", "seconds", "pages/s")
+        )
+        for filename in files:
+            with pikepdf.open(filename) as pdf:
+                pages = len(pdf.pages)
+            for name, settings in SETTINGS.items():
+                seconds = bench(filename, args.gs, settings, args.repeat)
+                print(
+                    "%-20s %-15s %10.2f %12.1f"
+                    % (
+                        os.path.basename(filename),
+                        name,
+                        seconds,
+                        pages / seconds,
+                    )
+                )
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main()
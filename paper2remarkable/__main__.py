@@ -8,6 +8,14 @@ import sys
 
 
 def main():
+    # Hand the command to a running daemon, if there is one. This happens
+    # before anything else is imported, to keep the client fast.
+    from .daemon import forward
+
+    status = forward(sys.argv[1:])
+    if status is not None:
+        sys.exit(status)
+
     from .ui import main as realmain
 
     sys.exit(realmain())
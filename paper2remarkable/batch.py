@@ -0,0 +1,188 @@
+# -*- coding: utf-8 -*-
+
+"""State of batch runs, so that interrupted runs can be resumed
+
+Every batch run records the progress of its inputs in a state directory in the
+cache directory, keyed by the inputs, filenames, options, and working
+directory of the run. For every input the last finished stage is recorded,
+together with the file produced by that stage. When a run with ``--resume``
+finds the state of an earlier run with the same key, completed inputs are
+skipped and the others continue after their last finished stage. The state
+directory is removed when the run completes, and the state of runs that never
+completed is removed after ``STATE_TTL`` seconds.
+
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import time
+
+from .cache import cache_dir
+from .log import Logger
+from .utils import file_hash
+
+logger = Logger()
+
+# The stages of processing an input, in order
+STAGES = ["resolved", "downloaded", "processed", "uploaded"]
+
+# Options that don't affect the output and are therefore not part of the key
+IGNORED_OPTIONS = ["verbose", "refresh_metadata"]
+
+# Time after which the state of a run that never completed is removed
+STATE_TTL = 7 * 24 * 60 * 60  # seconds
+
+
+def _hash_json(data):
+    text = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def options_key(options):
+    """Key of the options that affect the output"""
+    options = {k: dict(v) for k, v in options.items()}
+    for key in IGNORED_OPTIONS:
+        options.get("core", {}).pop(key, None)
+    return _hash_json(options)
+
+
+def batch_key(inputs, filenames, options):
+    """Key that identifies a batch run"""
+    data = {
+        "inputs": list(inputs),
+        "filenames": list(filenames),
+        "options": options_key(options),
+        "cwd": os.getcwd(),
+    }
+    return _hash_json(data)
+
+
+def remove_expired(base_dir, ttl=STATE_TTL, keep=None):
+    """Remove the state directories that weren't updated for ttl seconds"""
+    if not os.path.isdir(base_dir):
+        return
+    now = time.time()
+    for name in os.listdir(base_dir):
+        directory = os.path.join(base_dir, name)
+        if directory == keep:
+            continue
+        state_file = os.path.join(directory, "state.json")
+        try:
+            if os.path.exists(state_file):
+                mtime = os.path.getmtime(state_file)
+            else:
+                mtime = os.path.getmtime(directory)
+        except FileNotFoundError:
+            continue
+        if now - mtime > ttl:
+            logger.info("Removing expired batch state %s" % directory)
+            shutil.rmtree(directory, ignore_errors=True)
+
+
+class BatchState:
+    """Progress of a batch run, stored in a directory
+
+    Use :meth:`open` to get the state for a run.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.state_file = os.path.join(directory, "state.json")
+        self.items = {}
+        if os.path.exists(self.state_file):
+            with open(self.state_file, "r") as fp:
+                self.items = json.load(fp)["items"]
+
+    @classmethod
+    def open(cls, inputs, filenames, options, resume=False, base_dir=None):
+        """Get the state for a run, starting over unless resume is True"""
+        base_dir = base_dir or os.path.join(cache_dir(), "batches")
+        directory = os.path.join(
+            base_dir, batch_key(inputs, filenames, options)
+        )
+        remove_expired(base_dir, keep=directory)
+        if os.path.exists(directory) and not resume:
+            shutil.rmtree(directory)
+        elif os.path.exists(directory):
+            logger.info("Resuming batch from %s" % directory)
+        os.makedirs(directory, exist_ok=True)
+        return cls(directory)
+
+    def item(self, index):
+        """Get the state of the input at the index"""
+        return ItemState(self, str(index))
+
+    def save(self):
+        tmp_file = self.state_file + ".tmp"
+        with open(tmp_file, "w") as fp:
+            json.dump({"items": self.items}, fp)
+        os.replace(tmp_file, self.state_file)
+
+    def remove(self):
+        """Remove the state, when the batch has completed"""
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+
+class ItemState:
+    """Progress of a single input of a batch
+
+    The provider records every stage it finishes with :meth:`record`, and
+    uses :meth:`get` and :meth:`restore` to continue after the stages that
+    were finished in an earlier run.
+    """
+
+    def __init__(self, batch, key):
+        self.batch = batch
+        self.key = key
+        self.directory = os.path.join(batch.directory, key)
+
+    @property
+    def stages(self):
+        return self.batch.items.setdefault(self.key, {})
+
+    def done(self, stage):
+        """Whether the stage has been finished"""
+        return stage in self.stages
+
+    def get(self, stage):
+        """Data recorded for the stage, or None if it isn't finished"""
+        return self.stages.get(stage)
+
+    def record(self, stage, path=None, **data):
+        """Record that the stage is finished
+
+        The file at path, if given, is stored with the state, so it can be
+        restored when resuming. Other data must be serializable to JSON.
+        """
+        if path is not None:
+            os.makedirs(self.directory, exist_ok=True)
+            ext = os.path.splitext(path)[1]
+            stored = os.path.join(self.directory, stage + ext)
+            shutil.copy(path, stored)
+            data["file"] = os.path.basename(stored)
+            data["sha256"] = file_hash(stored)
+        # stages are only valid after the stages before them
+        for later in STAGES[STAGES.index(stage) + 1 :]:
+            self.stages.pop(later, None)
+        self.stages[stage] = data
+        self.batch.save()
+
+    def restore(self, stage, dest=None):
+        """Copy the file of a stage to dest or the current directory
+
+        Returns the filename, or None if the stored file is missing or
+        damaged, in which case the stage and those after it are discarded.
+        """
+        data = self.get(stage)
+        stored = os.path.join(self.directory, data["file"])
+        if not os.path.exists(stored) or file_hash(stored) != data["sha256"]:
+            logger.warning("Stored file for stage %s is damaged" % stage)
+            for later in STAGES[STAGES.index(stage) :]:
+                self.stages.pop(later, None)
+            self.batch.save()
+            return None
+        dest = dest or data["file"]
+        shutil.copy(stored, dest)
+        return dest
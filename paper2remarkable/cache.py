@@ -0,0 +1,289 @@
+# -*- coding: utf-8 -*-
+
+"""Caches that persist between runs
+
+The caches are stored in SQLite databases in the user's cache directory, see
+:func:`cache_dir`. Connections are opened per operation so the caches can be
+used from multiple threads.
+
+"""
+
+import email.utils
+import json
+import os
+import sqlite3
+import time
+
+from contextlib import closing
+
+import requests
+
+DEFAULT_METADATA_TTL = 30  # days
+DEFAULT_REDIRECT_TTL = 30  # days
+
+PERMANENT_REDIRECTS = (301, 308)
+
+
+def cache_dir():
+    """Directory for the files that are cached between runs"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(
+        os.path.expanduser("~"), ".cache"
+    )
+    path = os.path.join(base, "paper2remarkable")
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+class SQLiteCache:
+    """Base class for the caches backed by an SQLite table
+
+    The database is created when it is first used, so that creating a cache
+    that isn't needed doesn't touch the cache directory.
+    """
+
+    filename = None
+    schema = None
+
+    def __init__(self, path=None):
+        self._path = path
+        self._created = False
+
+    @property
+    def path(self):
+        if self._path is None:
+            self._path = os.path.join(cache_dir(), self.filename)
+        return self._path
+
+    def _connect(self):
+        if not self._created:
+            with _Connection(self.path) as conn:
+                conn.executescript(self.schema)
+            self._created = True
+        return _Connection(self.path)
+
+
+class _Connection:
+    """Connection context that commits on success and always closes"""
+
+    def __init__(self, path):
+        self._path = path
+        self._conn = None
+
+    def __enter__(self):
+        self._conn = sqlite3.connect(self._path, timeout=30)
+        return self._conn
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        with closing(self._conn):
+            if exc_type is None:
+                self._conn.commit()
+            else:
+                self._conn.rollback()
+
+
+class MetadataCache(SQLiteCache):
+    """Cache of paper information keyed by a canonical paper identifier
+
+    Entries expire after ``ttl`` days, and can be removed manually with
+    :meth:`invalidate`.
+    """
+
+    filename = "metadata.sqlite"
+    schema = (
+        "CREATE TABLE IF NOT EXISTS metadata ("
+        "paper_id TEXT PRIMARY KEY, title TEXT, authors TEXT, year TEXT, "
+        "created REAL)"
+    )
+
+    def __init__(self, path=None, ttl=DEFAULT_METADATA_TTL):
+        super().__init__(path=path)
+        self.ttl = ttl
+
+    def get(self, paper_id):
+        """Get the cached information as a dict, or None if not available"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT title, authors, year, created FROM metadata "
+                "WHERE paper_id = ?",
+                (paper_id,),
+            ).fetchone()
+        if row is None:
+            return None
+        title, authors, year, created = row
+        if time.time() - created > self.ttl * 24 * 3600:
+            return None
+        return {"title": title, "authors": json.loads(authors), "year": year}
+
+    def put(self, paper_id, title, authors, year):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO metadata VALUES (?, ?, ?, ?, ?)",
+                (paper_id, title, json.dumps(authors), year, time.time()),
+            )
+
+    def invalidate(self, paper_id=None):
+        """Remove the entry for the paper_id, or all entries if None"""
+        with self._connect() as conn:
+            if paper_id is None:
+                conn.execute("DELETE FROM metadata")
+            else:
+                conn.execute(
+                    "DELETE FROM metadata WHERE paper_id = ?", (paper_id,)
+                )
+
+
+class RedirectCache(SQLiteCache):
+    """Cache of the responses seen when following redirects
+
+    Every hop of a redirect chain is stored separately, with the location it
+    redirects to (None for the final url of a chain). Permanent redirects and
+    final urls are kept for ``ttl`` days, temporary redirects only when the
+    server allows caching them with a max-age. Cookies set along the way are
+    stored in a separate table and restored when a hop is replayed. Hops
+    that set session cookies aren't cached, as those need a live request,
+    and a hop expires when the first of its cookies does.
+    """
+
+    filename = "redirects.sqlite"
+    schema = (
+        "CREATE TABLE IF NOT EXISTS redirects ("
+        "url TEXT PRIMARY KEY, location TEXT, expires REAL);"
+        "CREATE TABLE IF NOT EXISTS cookies ("
+        "url TEXT, name TEXT, value TEXT, domain TEXT, path TEXT, "
+        "secure INTEGER, expires REAL);"
+    )
+
+    def __init__(self, path=None, ttl=DEFAULT_REDIRECT_TTL):
+        super().__init__(path=path)
+        self.ttl = ttl
+
+    def get(self, url):
+        """Get the location and cookies for a cached hop, or None"""
+        now = time.time()
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT location FROM redirects WHERE url = ? AND expires > ?",
+                (url, now),
+            ).fetchone()
+            if row is None:
+                return None
+            rows = conn.execute(
+                "SELECT name, value, domain, path, secure, expires "
+                "FROM cookies WHERE url = ?",
+                (url,),
+            ).fetchall()
+
+        jar = requests.cookies.RequestsCookieJar()
+        for name, value, domain, path, secure, expires in rows:
+            jar.set(
+                name,
+                value,
+                domain=domain,
+                path=path,
+                secure=bool(secure),
+                expires=int(expires),
+            )
+        return row[0], jar
+
+    def put(self, url, response):
+        """Store the response for the url, if it may be cached"""
+        expires = self._expires(response)
+        if expires is None:
+            return
+
+        cookies = list(response.cookies)
+        if any(c.expires is None for c in cookies):
+            return
+        expires = min([expires] + [c.expires for c in cookies])
+
+        location = None
+        if response.is_redirect:
+            location = requests.compat.urljoin(
+                url, response.headers["Location"]
+            )
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO redirects VALUES (?, ?, ?)",
+                (url, location, expires),
+            )
+            conn.execute("DELETE FROM cookies WHERE url = ?", (url,))
+            conn.executemany(
+                "INSERT INTO cookies VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        url,
+                        c.name,
+                        c.value,
+                        c.domain,
+                        c.path,
+                        int(c.secure),
+                        c.expires,
+                    )
+                    for c in cookies
+                ],
+            )
+
+    def _expires(self, response):
+        """Expiry time of the response, or None if it can't be cached"""
+        now = time.time()
+        cache_control = response.headers.get("Cache-Control", "").lower()
+        directives = [d.strip() for d in cache_control.split(",")]
+        if "no-store" in directives or "no-cache" in directives:
+            return None
+
+        if response.status_code in PERMANENT_REDIRECTS or (
+            response.ok and not response.is_redirect
+        ):
+            return now + self.ttl * 24 * 3600
+
+        # temporary redirects are cached only when the server says so
+        if not response.is_redirect:
+            return None
+        for directive in directives:
+            if directive.startswith("max-age="):
+                try:
+                    return now + int(directive[len("max-age=") :])
+                except ValueError:
+                    return None
+        if "Expires" in response.headers:
+            try:
+                parsed = email.utils.parsedate_to_datetime(
+                    response.headers["Expires"]
+                )
+            except (TypeError, ValueError):
+                return None
+            return parsed.timestamp()
+        return None
+
+
+class UploadHistory(SQLiteCache):
+    """History of the papers that have been uploaded
+
+    Uploads are keyed by the identity of the paper, the target they were
+    uploaded to, and the key of the options used to process them, so that a
+    paper is only considered a duplicate if the result would be the same.
+    """
+
+    filename = "uploads.sqlite"
+    schema = (
+        "CREATE TABLE IF NOT EXISTS uploads ("
+        "identity TEXT, target TEXT, options TEXT, source TEXT, "
+        "uploaded REAL, PRIMARY KEY (identity, target, options))"
+    )
+
+    def get(self, identity, target, options):
+        """Get the source that was uploaded for the paper, or None"""
+        with self._connect() as conn:
+            row = conn.execute(
+                "SELECT source FROM uploads WHERE identity = ? AND "
+                "target = ? AND options = ?",
+                (identity, target, options),
+            ).fetchone()
+        return None if row is None else row[0]
+
+    def put(self, identity, target, options, source):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO uploads VALUES (?, ?, ?, ?, ?)",
+                (identity, target, options, source, time.time()),
+            )
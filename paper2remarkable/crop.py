@@ -12,11 +12,10 @@ import io
 import os
 import subprocess
 
-import pdfplumber
-
 from pikepdf import Pdf
 
 from .log import Logger
+from .tools import find_tool
 
 RM_WIDTH = 1404
 RM_HEIGHT = 1872
@@ -47,9 +46,7 @@ def find_offset_byte_line(line):
 
 def check_pdftoppm(pth):
     """Check that we can run the provided pdftoppm executable"""
-    try:
-        subprocess.check_output([pth, "-v"], stderr=subprocess.DEVNULL)
-    except (subprocess.CalledProcessError, FileNotFoundError, PermissionError):
+    if find_tool("pdftoppm", pth) is None:
         logger.info("pdftoppm not found, using pdfplumber instead (slower)")
         return False
     return True
@@ -144,6 +141,8 @@ class Cropper(object):
 
     def get_raw_bbox_pdfplumber(self, filename, resolution=72):
         """Get the basic bounding box with pdfplumber"""
+        import pdfplumber
+
         pdf = pdfplumber.open(filename)
         im = pdf.pages[0].to_image(resolution=resolution)
         pdf.close()
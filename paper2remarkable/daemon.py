@@ -0,0 +1,228 @@
+# -*- coding: utf-8 -*-
+
+"""Daemon mode and the client that forwards commands to it
+
+With ``p2r --daemon`` a process is started that has all dependencies
+imported and keeps the external programs it discovered, and that listens on
+a Unix socket. Later ``p2r`` invocations forward their command line to the
+daemon and stream back its output, which avoids the startup cost on every
+invocation. Commands are processed one at a time, in the working directory of
+the client. The daemon parses the command line and tells the client to run
+commands that need its terminal, such as debug mode, itself. The help and
+version are always printed by the client, so they describe the installed
+version rather than the one the daemon was started with.
+
+The socket is only used if it and its directory are owned by the user and not
+writable by others. Without ``XDG_RUNTIME_DIR`` the socket is placed in a
+private directory in the temporary directory.
+
+This module is imported by the client before anything else, so it must only
+use the standard library at the top level.
+
+"""
+
+import contextlib
+import json
+import os
+import socket
+import sys
+import tempfile
+
+# Options that print information about the client and exit
+CLIENT_OPTIONS = ["-h", "--help", "-V", "--version"]
+
+
+def socket_path():
+    """Path of the socket that the daemon listens on"""
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR")
+    if runtime_dir:
+        return os.path.join(runtime_dir, "p2r-%s.sock" % _user_id())
+    base = os.path.join(tempfile.gettempdir(), "p2r-%s" % _user_id())
+    return os.path.join(base, "daemon.sock")
+
+
+def _user_id():
+    return os.getuid() if hasattr(os, "getuid") else os.getlogin()
+
+
+def _is_private(path):
+    """Whether the path is owned by the user and not writable by others"""
+    if not hasattr(os, "getuid"):
+        return True
+    st = os.lstat(path)
+    return st.st_uid == os.getuid() and not st.st_mode & 0o022
+
+
+def _is_local(args):
+    """Whether the parsed command must be run by the client itself
+
+    Debug mode needs the terminal of the client, and the other modes start
+    long running processes of their own.
+    """
+    return bool(args.debug or args.daemon or args.watch or args.serve)
+
+
+def forward(argv, path=None):
+    """Forward a command to the daemon and stream back its output
+
+    Returns the exit status of the command, or None if the command wasn't
+    forwarded because no daemon is running or the command must be run
+    locally.
+    """
+    path = path or socket_path()
+    if not hasattr(socket, "AF_UNIX") or not os.path.exists(path):
+        return None
+    if any(arg in CLIENT_OPTIONS for arg in argv):
+        return None
+    if not (_is_private(path) and _is_private(os.path.dirname(path))):
+        print(
+            "WARNING: Ignoring the p2r daemon socket at %s, as it can be "
+            "changed by other users" % path,
+            file=sys.stderr,
+        )
+        return None
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+
+    with sock:
+        request = {"argv": argv, "cwd": os.getcwd()}
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        for line in sock.makefile("r", encoding="utf-8"):
+            message = json.loads(line)
+            if message.get("local"):
+                return None
+            if "status" in message:
+                return message["status"]
+            stream = (
+                sys.stdout if message["stream"] == "stdout" else sys.stderr
+            )
+            stream.write(message["data"])
+            stream.flush()
+    # connection closed without a status, the daemon probably died
+    print("ERROR: Lost connection to the p2r daemon", file=sys.stderr)
+    return 1
+
+
+class _SocketStream:
+    """File-like object that sends what is written to the client"""
+
+    def __init__(self, conn, name):
+        self._conn = conn
+        self._name = name
+        self.closed = False
+
+    def write(self, data):
+        if not data or self.closed:
+            return len(data)
+        message = {"stream": self._name, "data": data}
+        try:
+            self._conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+        except OSError:
+            # the client went away, finish the command regardless
+            self.closed = True
+        return len(data)
+
+    def flush(self):
+        pass
+
+
+def _exit_status(code):
+    if code is None:
+        return 0
+    return code if isinstance(code, int) else 1
+
+
+def handle(conn, execute):
+    """Handle a single connection of a client"""
+    from .log import Logger
+    from .ui import parse_args
+    from .utils import chdir
+
+    with conn.makefile("r", encoding="utf-8") as fp:
+        line = fp.readline()
+    try:
+        request = json.loads(line)
+    except ValueError:
+        # e.g. the connection of another daemon checking for this one
+        return
+
+    stdout = _SocketStream(conn, "stdout")
+    stderr = _SocketStream(conn, "stderr")
+    local = False
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(
+        stderr
+    ):
+        # providers disable the shared logger for non-verbose commands
+        Logger().enable()
+        try:
+            with chdir(request["cwd"]):
+                args = parse_args(request["argv"])
+                local = _is_local(args)
+                status = 0 if local else _exit_status(execute(args))
+        except SystemExit as err:
+            status = _exit_status(err.code)
+        except Exception as err:
+            print(err, file=sys.stderr)
+            status = 1
+
+    message = {"local": True} if local else {"status": status}
+    try:
+        conn.sendall(json.dumps(message).encode("utf-8") + b"\n")
+    except OSError:
+        pass
+
+
+def serve(execute, path=None):
+    """Run the daemon until it is interrupted
+
+    The execute function is called with the parsed arguments of every
+    command that is received.
+    """
+    from .providers import iter_providers
+
+    if not hasattr(socket, "AF_UNIX"):
+        raise OSError("Daemon mode requires support for Unix sockets")
+
+    path = path or socket_path()
+    directory = os.path.dirname(path)
+    os.makedirs(directory, mode=0o700, exist_ok=True)
+    if not _is_private(directory):
+        raise OSError(
+            "Can't use %s for the daemon socket, as it can be changed by "
+            "other users" % directory
+        )
+    if os.path.exists(path):
+        probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        with probe:
+            if probe.connect_ex(path) == 0:
+                raise OSError("A p2r daemon is already listening on %s" % path)
+        # left behind by a daemon that didn't shut down properly
+        os.unlink(path)
+
+    # Load everything up front, so commands don't pay for it
+    list(iter_providers())
+
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    old_umask = os.umask(0o177)
+    try:
+        server.bind(path)
+    finally:
+        os.umask(old_umask)
+    server.listen()
+    print("p2r daemon listening on %s" % path, flush=True)
+
+    try:
+        while True:
+            conn, _ = server.accept()
+            with conn:
+                handle(conn, execute)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
+        os.unlink(path)
@@ -103,6 +103,21 @@ class _CalledProcessError(Error):
         return msg
 
 
+class DownloadError(Error):
+    """Exception raised when a file can't be downloaded."""
+
+    def __init__(self, url, tries):
+        self.url = url
+        self.tries = tries
+
+    def __str__(self):
+        msg = "ERROR: Failed to download {url} after {tries} attempts.".format(
+            url=self.url, tries=self.tries
+        )
+        msg += GH_MSG
+        return msg
+
+
 class NoPDFToolError(Error):
     """Exception raised when neither pdftk or qpdf is found."""
 
@@ -170,3 +185,13 @@ class FulltextMissingError(Error):
             f"\t{self.url}\n"
         )
         return msg
+
+
+class InvalidJobError(Error):
+    """Exception raised when a job submitted to the service is invalid"""
+
+    def __init__(self, reason):
+        self.reason = reason
+
+    def __str__(self):
+        return "ERROR: Invalid job: {reason}".format(reason=self.reason)
@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+
+"""Running Ghostscript
+
+All calls to Ghostscript go through :func:`run_gs`, so that the settings in
+the ``system`` section of the configuration file apply to every call:
+
+- ``gs_threads``: the number of rendering threads (0 leaves the default of
+  Ghostscript, a single thread). Larger band buffers are used with threads,
+  so that pages are rendered in fewer bands.
+- ``gs_tuned``: use a pdfwrite profile that avoids work that doesn't matter
+  for the reMarkable, such as recompressing JPEG images and rotating pages
+  based on the direction of the text.
+- ``gs_backend``: ``subprocess`` (the default) runs the ``gs`` executable
+  for every call, ``libgs`` runs Ghostscript in-process through its C API.
+  The latter falls back to the executable if the library can't be loaded.
+
+The executable is looked up in the registry of :mod:`.tools`, so a missing
+``gs`` is reported before it is called.
+
+"""
+
+import ctypes
+import ctypes.util
+import subprocess
+import threading
+
+from .log import Logger
+from .tools import find_tool
+
+logger = Logger()
+
+DEFAULT_THREADS = 0
+DEFAULT_BACKEND = "subprocess"
+BACKENDS = ["subprocess", "libgs"]
+
+# Profiles for shrinking files, see pdf_ops.shrink_pdf
+SHRINK_PROFILES = ["printer", "eink"]
+
+# Files are only shrunk if the size is expected to go down by this fraction
+DEFAULT_SHRINK_THRESHOLD = 0.05
+
+# Names of the Ghostscript library to try when it isn't found by ctypes
+LIBGS_NAMES = ["libgs.so.10", "libgs.so.9", "libgs.dylib", "gsdll64.dll"]
+
+# Constants from the Ghostscript API (iapi.h and ierrors.h)
+GS_ARG_ENCODING_UTF8 = 1
+GS_ERROR_QUIT = -101
+GS_ERROR_INFO = -110
+
+# Band buffer and bitmap sizes used with multiple rendering threads, in bytes
+BUFFER_SPACE = 64 * 1024 * 1024
+MAX_BITMAP = 512 * 1024 * 1024
+
+# The tuned pdfwrite profile
+TUNED_PDFWRITE = [
+    "-dPassThroughJPEGImages=true",
+    "-dPassThroughJPXImages=true",
+    "-dDetectDuplicateImages=true",
+    "-dAutoRotatePages=/None",
+    "-dFastWebView=false",
+    "-dCompressFonts=true",
+    "-dSubsetFonts=true",
+]
+
+
+def gs_flags(threads=DEFAULT_THREADS, tuned=False):
+    """Command line flags for the given settings"""
+    flags = []
+    if threads > 0:
+        flags.append("-dNumRenderingThreads=%i" % threads)
+        flags.append("-dBufferSpace=%i" % BUFFER_SPACE)
+        flags.append("-dMaxBitmap=%i" % MAX_BITMAP)
+    if tuned:
+        flags.extend(TUNED_PDFWRITE)
+    return flags
+
+
+# Signature of the stdio callbacks of the Ghostscript API
+_STDIO_FUNC = ctypes.CFUNCTYPE(
+    ctypes.c_int, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int
+)
+
+
+@_STDIO_FUNC
+def _discard_output(caller_handle, buf, length):
+    return length
+
+
+@_STDIO_FUNC
+def _no_input(caller_handle, buf, length):
+    return 0
+
+
+class LibGS:
+    """Ghostscript in-process, through the C API of libgs
+
+    The library is loaded once per process and the interpreter runs in the
+    calling process, which avoids starting a new gs process for every call.
+    The API allows an instance to be initialized with arguments only once,
+    so every call gets a new instance. Calls are serialized, as Ghostscript
+    may not support concurrent instances in one process.
+    """
+
+    _instance = None
+    _lock = threading.Lock()
+
+    def __init__(self, path=None):
+        self.lib = self._load(path)
+        self.lib.gsapi_new_instance.argtypes = [
+            ctypes.POINTER(ctypes.c_void_p),
+            ctypes.c_void_p,
+        ]
+        self.lib.gsapi_set_stdio.argtypes = [
+            ctypes.c_void_p,
+            _STDIO_FUNC,
+            _STDIO_FUNC,
+            _STDIO_FUNC,
+        ]
+        self.lib.gsapi_set_arg_encoding.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+        ]
+        self.lib.gsapi_init_with_args.argtypes = [
+            ctypes.c_void_p,
+            ctypes.c_int,
+            ctypes.POINTER(ctypes.c_char_p),
+        ]
+        self.lib.gsapi_exit.argtypes = [ctypes.c_void_p]
+        self.lib.gsapi_delete_instance.argtypes = [ctypes.c_void_p]
+
+    @staticmethod
+    def _load(path):
+        names = [path] if path else []
+        names += [ctypes.util.find_library("gs")] + LIBGS_NAMES
+        for name in filter(None, names):
+            try:
+                return ctypes.CDLL(name)
+            except OSError:
+                continue
+        raise OSError("Ghostscript library not found")
+
+    @classmethod
+    def get(cls):
+        """The shared instance, or None if libgs isn't available"""
+        with cls._lock:
+            if cls._instance is None:
+                try:
+                    cls._instance = cls()
+                except (OSError, AttributeError) as err:
+                    logger.warning(
+                        "Can't use libgs, using gs instead: %s" % err
+                    )
+                    cls._instance = False
+            return cls._instance or None
+
+    def run(self, args):
+        """Run Ghostscript with the arguments, returns the exit status"""
+        argv = [b"gs"] + [a.encode("utf-8") for a in args]
+        c_argv = (ctypes.c_char_p * len(argv))(*argv)
+        instance = ctypes.c_void_p()
+        with self._lock:
+            code = self.lib.gsapi_new_instance(ctypes.byref(instance), None)
+            if code < 0:
+                return 1
+            try:
+                self.lib.gsapi_set_stdio(
+                    instance, _no_input, _discard_output, _discard_output
+                )
+                self.lib.gsapi_set_arg_encoding(instance, GS_ARG_ENCODING_UTF8)
+                code = self.lib.gsapi_init_with_args(
+                    instance, len(argv), c_argv
+                )
+                exit_code = self.lib.gsapi_exit(instance)
+            finally:
+                self.lib.gsapi_delete_instance(instance)
+        if code in (0, GS_ERROR_QUIT, GS_ERROR_INFO):
+            code = exit_code
+        return 0 if code == 0 else 1
+
+
+def run_gs(
+    args,
+    gs_path="gs",
+    threads=DEFAULT_THREADS,
+    tuned=False,
+    backend=DEFAULT_BACKEND,
+):
+    """Run Ghostscript with the given arguments, returns the exit status
+
+    The flags for the settings are placed before the arguments, so that the
+    arguments can override them.
+    """
+    args = gs_flags(threads=threads, tuned=tuned) + list(args)
+    libgs = LibGS.get() if backend == "libgs" else None
+    if libgs is not None:
+        return libgs.run(args)
+    if find_tool("gs", gs_path) is None:
+        logger.warning("Ghostscript not found: %s" % gs_path)
+        return 1
+    return subprocess.call(
+        [gs_path] + args, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
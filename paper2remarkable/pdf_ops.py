@@ -9,16 +9,42 @@ Copyright: 2019, G.J.J. van den Burg
 """
 
 
+import concurrent.futures
+import math
 import os
-import subprocess
 
+from pikepdf import Array
+from pikepdf import Dictionary
+from pikepdf import Name
+from pikepdf import OutlineItem
 from pikepdf import Pdf
+from pikepdf import PdfError
+from pikepdf import Stream
 
 from .crop import Cropper
+from .exceptions import FileTypeError
+from .ghostscript import DEFAULT_BACKEND
+from .ghostscript import DEFAULT_THREADS
+from .ghostscript import run_gs
 from .log import Logger
 
 logger = Logger()
 
+# Size of the screen of the reMarkable in pixels, and its resolution
+REMARKABLE_SCREEN = (1404, 1872)
+REMARKABLE_DPI = 226
+
+# Resolution and downsample threshold of the printer preset of Ghostscript
+PRINTER_DPI = 300
+PRINTER_THRESHOLD = 1.5
+
+# Large files are shrunk in page ranges by parallel Ghostscript processes.
+# Sharding starts at this number of pages or file size, with ranges of at
+# least SHARD_MIN_RANGE pages.
+SHARD_MIN_PAGES = 200
+SHARD_MIN_SIZE = 100 * 1024 * 1024
+SHARD_MIN_RANGE = 20
+
 
 def prepare_pdf(filepath, operation, pdftoppm_path="pdftoppm"):
     """Prepare pdf by cropping, centering, or right-aligning the flie"""
@@ -40,19 +66,75 @@ def prepare_pdf(filepath, operation, pdftoppm_path="pdftoppm"):
     return prepared_file
 
 
+# Page attributes that can be inherited from the nodes of the page tree
+INHERITABLE = ["/Resources", "/MediaBox", "/CropBox", "/Rotate"]
+
+
+def _push_inherited(page):
+    """Copy the attributes a page inherits from the page tree to the page"""
+    node = page.get("/Parent")
+    while node is not None:
+        for key in INHERITABLE:
+            if key not in page and key in node:
+                page[key] = node[key]
+        node = node.get("/Parent")
+
+
 def blank_pdf(filepath):
-    """Add blank pages to PDF"""
+    """Add blank pages to PDF
+
+    The blank pages are inserted in the document itself, so the table of
+    contents still points to the right pages. Blank pages of the same size
+    share their (empty) content stream and resources.
+    """
     logger.info("Adding blank pages")
-    pdf = Pdf.open(filepath)
-    # Note: creating a new file doesn't keep the table of contents, but it
-    # would anyway be incorrect when adding blank pages
-    dst = Pdf.new()
-    for page in pdf.pages:
-        dst.pages.append(page)
-        x0, y0, x1, y1 = page.MediaBox
-        dst.add_blank_page(page_size=(x1 - x0, y1 - y0))
     output_file = os.path.splitext(filepath)[0] + "-blank.pdf"
-    dst.save(output_file)
+    with Pdf.open(filepath) as pdf:
+        root = pdf.Root.Pages
+        contents = pdf.make_stream(b"")
+        resources = pdf.make_indirect(Dictionary())
+        # page size -> media box shared by the blank pages of that size
+        boxes = {}
+        # Inserting pages one at a time with the page list is slow for long
+        # documents, so the page tree is replaced by a single node with the
+        # pages and the blank pages. The page objects stay the same.
+        kids = []
+        for page in [p.obj for p in pdf.pages]:
+            _push_inherited(page)
+            x0, y0, x1, y1 = page.MediaBox
+            size = (float(x1 - x0), float(y1 - y0))
+            if size not in boxes:
+                boxes[size] = pdf.make_indirect(Array([0, 0, *size]))
+            blank = Dictionary(
+                Type=Name.Page,
+                Parent=root,
+                MediaBox=boxes[size],
+                Contents=contents,
+                Resources=resources,
+            )
+            page.Parent = root
+            kids.append(page)
+            kids.append(pdf.make_indirect(blank))
+        for key in INHERITABLE:
+            if key in root:
+                del root[key]
+        root.Kids = Array(kids)
+        root.Count = len(kids)
+        pdf.save(output_file)
+    return output_file
+
+
+def linearize_pdf(filepath):
+    """Linearize the PDF file, for fast display of the first page
+
+    The objects of the first page are placed at the start of the file, with
+    hint tables that locate the other pages, so that a reader can show the
+    first page without reading the whole file.
+    """
+    logger.info("Linearizing pdf file")
+    output_file = os.path.splitext(filepath)[0] + "-linear.pdf"
+    with Pdf.open(filepath) as pdf:
+        pdf.save(output_file, linearize=True)
     return output_file
 
 
@@ -63,26 +145,464 @@ def _filesize_string(size: int) -> str:
         size /= 1024
 
 
-def shrink_pdf(filepath, gs_path="gs"):
-    """Shrink the PDF file size using Ghostscript"""
+def eink_resolution(filepath):
+    """Resolution of the images on the screen of the reMarkable, in dpi
+
+    Pages are scaled to fit the screen, so the resolution follows from the
+    size of the pages after cropping. The highest resolution of all pages is
+    used, so that no page loses detail.
+    """
+    with Pdf.open(filepath) as pdf:
+        return _eink_resolution(_page_sizes(pdf))
+
+
+def _page_sizes(pdf):
+    """Width and height of the visible part of the pages, in points"""
+    for page in pdf.pages:
+        box = page.obj.get("/CropBox") or page.obj.get("/MediaBox")
+        if box is None:
+            continue
+        x0, y0, x1, y1 = [float(v) for v in box]
+        width, height = abs(x1 - x0), abs(y1 - y0)
+        if width and height:
+            yield width, height
+
+
+def _eink_resolution(page_sizes):
+    screen_w, screen_h = REMARKABLE_SCREEN
+    dpi = 0
+    for width, height in page_sizes:
+        page_dpi = min(screen_w * 72 / width, screen_h * 72 / height)
+        dpi = max(dpi, page_dpi)
+    return math.ceil(dpi) if dpi else REMARKABLE_DPI
+
+
+def eink_flags(dpi):
+    """Ghostscript flags to convert images to grayscale at the given dpi
+
+    With a threshold of 1.0 images are downsampled whenever their resolution
+    is above the target, and images below it are left as they are.
+    """
+    flags = [
+        "-sColorConversionStrategy=Gray",
+        "-dProcessColorModel=/DeviceGray",
+        "-dAutoFilterGrayImages=true",
+    ]
+    for kind in ["Color", "Gray", "Mono"]:
+        # line art needs a higher resolution than photos to stay sharp
+        res = dpi * 2 if kind == "Mono" else dpi
+        flags += [
+            "-dDownsample%sImages=true" % kind,
+            "-d%sImageResolution=%i" % (kind, res),
+            "-d%sImageDownsampleThreshold=1.0" % kind,
+        ]
+    flags += [
+        "-dColorImageDownsampleType=/Bicubic",
+        "-dGrayImageDownsampleType=/Bicubic",
+    ]
+    return flags
+
+
+def _stream_length(obj):
+    length = obj.get("/Length")
+    try:
+        return int(length)
+    except (TypeError, ValueError):
+        return len(obj.read_raw_bytes())
+
+
+def _is_color(colorspace):
+    if colorspace is None:
+        return False
+    if isinstance(colorspace, Name):
+        return colorspace in (Name.DeviceRGB, Name.DeviceCMYK)
+    # arrays such as [/ICCBased stream] or [/Indexed base hival lookup]
+    if colorspace[0] == Name.ICCBased:
+        return int(colorspace[1].get("/N", 1)) > 1
+    if colorspace[0] == Name.Indexed:
+        # the palette is in the base color space
+        return _is_color(colorspace[1])
+    return len(colorspace) > 1 and _is_color(colorspace[1])
+
+
+def estimate_shrink(filepath, profile="printer"):
+    """Estimate the fraction by which shrink_pdf reduces the file size
+
+    The estimate is based on the objects in the file, without decoding them:
+    images with a resolution above the target of the profile are
+    downsampled, color images become grayscale with the eink profile,
+    uncompressed streams are compressed, and fonts that are embedded in full
+    are subset. Papers with only text therefore get an estimate close to 0.
+    See also :meth:`PdfProfile.estimate_shrink`.
+    """
+    if not os.path.getsize(filepath):
+        return 0.0
+    return analyze_pdf(filepath).estimate_shrink(profile=profile)
+
+
+def _font_savings(descriptor):
+    """Expected savings of subsetting a font that is embedded in full"""
+    name = str(descriptor.get("/FontName", ""))
+    # subset fonts have a name such as /ABCDEF+Times-Roman
+    if len(name) > 8 and name[7] == "+":
+        return 0
+    for key in ["/FontFile", "/FontFile2", "/FontFile3"]:
+        fontfile = descriptor.get(key)
+        if fontfile is not None:
+            return 0.5 * _stream_length(fontfile)
+    return 0
+
+
+# Fraction of the pages that must be page images for a scanned document
+SCANNED_FRACTION = 0.8
+
+
+class PdfProfile:
+    """Properties of a PDF file, collected by :func:`analyze_pdf`
+
+    Operations use the profile to find out whether their work is needed
+    without opening the file again. A profile only describes the file it was
+    made for, which is checked with :meth:`describes`.
+    """
+
+    def __init__(self, filename):
+        self.filename = os.path.abspath(filename)
+        self.size = os.path.getsize(filename)
+        self.pages = 0
+        self.page_sizes = []
+        self.encrypted = False
+        self.object_streams = False
+        # whether qpdf had to repair the file when opening it
+        self.damaged = False
+        # (pixels, length, color, compressed) of every image
+        self.images = []
+        self.fonts = 0
+        self.full_fonts = 0
+        self.font_savings = 0
+        # length of the streams other than images that aren't compressed
+        self.uncompressed = 0
+        self.scanned_pages = 0
+        # whether the first page may have the arXiv stamp, None if unknown
+        self.arxiv_stamp = None
+
+    @property
+    def scanned(self):
+        """Whether the document consists of scanned page images"""
+        return bool(self.pages) and (
+            self.scanned_pages >= SCANNED_FRACTION * self.pages
+        )
+
+    @property
+    def well_formed(self):
+        """Whether the file can be processed without rewriting it first"""
+        return not (self.encrypted or self.damaged)
+
+    def describes(self, filepath):
+        """Whether this is the profile of the file at filepath"""
+        return (
+            os.path.abspath(filepath) == self.filename
+            and os.path.getsize(filepath) == self.size
+        )
+
+    def estimate_shrink(self, profile="printer"):
+        """Estimate the fraction by which shrink_pdf reduces the file size"""
+        if not self.size:
+            return 0.0
+        if profile == "eink":
+            dpi, threshold = _eink_resolution(self.page_sizes), 1.0
+        else:
+            dpi, threshold = PRINTER_DPI, PRINTER_THRESHOLD
+        # the largest number of image pixels that can be shown on a page
+        areas = [w * h for w, h in self.page_sizes] or [612 * 792]
+        max_pixels = max(areas) / 72**2 * dpi**2
+
+        savings = self.font_savings + 0.7 * self.uncompressed
+        for pixels, length, color, compressed in self.images:
+            remaining = length
+            if pixels > max_pixels * threshold**2:
+                remaining *= max_pixels / pixels
+            if profile == "eink" and color:
+                remaining /= 3
+            if not compressed:
+                remaining /= 2
+            savings += length - remaining
+        return min(1.0, savings / self.size)
+
+    def summary(self):
+        parts = ["%i pages" % self.pages, "%i images" % len(self.images)]
+        parts.append("%i fonts (%i in full)" % (self.fonts, self.full_fonts))
+        for name in ["encrypted", "damaged", "object_streams", "scanned"]:
+            if getattr(self, name):
+                parts.append(name.replace("_", " "))
+        return ", ".join(parts)
+
+
+def _inherited(page, key):
+    """Attribute of a page, which may be inherited from the page tree"""
+    node = page
+    while node is not None:
+        if key in node:
+            return node[key]
+        node = node.get("/Parent")
+    return None
+
+
+def _is_page_image(page):
+    """Whether a page shows images but has no text, as a scanned page does
+
+    Scanned pages with a text layer from OCR are therefore not counted.
+    """
+    resources = _inherited(page, "/Resources") or {}
+    if resources.get("/Font"):
+        return False
+    has_image = False
+    for _, xobj in resources.get("/XObject", {}).items():
+        if not isinstance(xobj, Stream):
+            continue
+        if xobj.get("/Subtype") == Name.Image:
+            has_image = True
+        elif xobj.get("/Resources", {}).get("/Font"):
+            return False
+    return has_image
+
+
+def analyze_pdf(filename, inspect=None):
+    """Open a PDF file once and collect its :class:`PdfProfile`
+
+    The inspect function, if given, is called with the open file and the
+    profile, so that providers can add their own checks. Raises a
+    FileTypeError if the file can't be opened as a PDF.
+    """
+    profile = PdfProfile(filename)
+    try:
+        pdf = Pdf.open(filename)
+    except PdfError:
+        raise FileTypeError(filename, "pdf")
+    with pdf:
+        profile.encrypted = pdf.is_encrypted
+        profile.object_streams = pdf.trailer.get("/Type") == Name.XRef
+        profile.pages = len(pdf.pages)
+        profile.page_sizes = list(_page_sizes(pdf))
+        profile.scanned_pages = sum(
+            _is_page_image(page.obj) for page in pdf.pages
+        )
+
+        for obj in pdf.objects:
+            if isinstance(obj, Dictionary):
+                if obj.get("/Type") == Name.FontDescriptor:
+                    savings = _font_savings(obj)
+                    profile.fonts += 1
+                    profile.full_fonts += savings > 0
+                    profile.font_savings += savings
+                continue
+            if not isinstance(obj, Stream):
+                continue
+            if obj.get("/Type") == Name.ObjStm:
+                profile.object_streams = True
+                continue
+            length = _stream_length(obj)
+            compressed = obj.get("/Filter") is not None
+            if obj.get("/Subtype") != Name.Image:
+                if not compressed:
+                    profile.uncompressed += length
+                continue
+            pixels = int(obj.get("/Width", 0)) * int(obj.get("/Height", 0))
+            color = _is_color(obj.get("/ColorSpace"))
+            profile.images.append((pixels, length, color, compressed))
+
+        # damaged objects are only found when they are read
+        profile.damaged = bool(pdf.get_warnings())
+
+        if inspect is not None:
+            inspect(pdf, profile)
+    return profile
+
+
+def shard_ranges(n_pages, n_shards):
+    """Split the pages into n_shards ranges of consecutive pages
+
+    Returns a list of (first, last) page numbers, starting from 1.
+    """
+    ranges = []
+    first = 1
+    for i in range(n_shards):
+        last = first - 1 + n_pages // n_shards + (i < n_pages % n_shards)
+        ranges.append((first, last))
+        first = last + 1
+    return ranges
+
+
+def _num_shards(n_pages, size, gs_shards):
+    """Number of page ranges to shrink in parallel, 1 to not use sharding"""
+    if gs_shards == 1:
+        return 1
+    if n_pages < SHARD_MIN_PAGES and size < SHARD_MIN_SIZE:
+        return 1
+    workers = gs_shards or os.cpu_count() or 1
+    return max(1, min(workers, n_pages // SHARD_MIN_RANGE))
+
+
+def _copy_outline(src, dst):
+    """Copy the outline of src to dst, which has the same pages
+
+    Items are linked to the page of their destination, which is looked up
+    in the named destinations if needed. Items for which the page can't be
+    found are kept without a destination.
+    """
+    page_index = {page.objgen: i for i, page in enumerate(src.pages)}
+    names = {}
+    dests = src.Root.get("/Dests")
+    if dests is not None:
+        names.update({str(k): v for k, v in dests.items()})
+    try:
+        from pikepdf import NameTree
+
+        tree = src.Root.Names.Dests
+        names.update({str(k): v for k, v in NameTree(tree).items()})
+    except (AttributeError, KeyError, ImportError):
+        pass
+
+    def page_of(item):
+        dest = item.destination
+        if dest is None and item.action is not None:
+            dest = item.action.get("/D")
+        if dest is not None and not isinstance(dest, Array):
+            dest = names.get(str(dest))
+            if dest is not None and not isinstance(dest, Array):
+                dest = dest.get("/D")
+        if dest is None or not len(dest):
+            return None
+        return page_index.get(getattr(dest[0], "objgen", None))
+
+    def convert(item):
+        new = OutlineItem(item.title, page_of(item))
+        new.children.extend(convert(child) for child in item.children)
+        return new
+
+    with src.open_outline() as src_outline:
+        items = [convert(item) for item in src_outline.root]
+    if items:
+        with dst.open_outline() as dst_outline:
+            dst_outline.root.extend(items)
+
+
+def _has_internal_links(pdf):
+    """Whether any page has a link to a destination in the document
+
+    Such links point to the pages of the input, which are replaced when the
+    page ranges are merged, so they would break in the output.
+    """
+    for page in pdf.pages:
+        for annot in page.obj.get("/Annots", []):
+            if annot.get("/Subtype") != Name.Link:
+                continue
+            action = annot.get("/A")
+            if annot.get("/Dest") is not None:
+                return True
+            if action is not None and action.get("/S") == Name.GoTo:
+                return True
+    return False
+
+
+def _shrink_sharded(filepath, output_file, args, n_pages, n_shards, **kw):
+    """Shrink page ranges in parallel and merge the results
+
+    Returns the exit status, which is nonzero if any range failed.
+    """
+    ranges = shard_ranges(n_pages, n_shards)
+    logger.info("Shrinking in %i parallel page ranges" % len(ranges))
+    base = os.path.splitext(output_file)[0]
+    parts = ["%s-%i.pdf" % (base, i) for i in range(len(ranges))]
+
+    def shrink_range(i):
+        first, last = ranges[i]
+        range_args = ["-dFirstPage=%i" % first, "-dLastPage=%i" % last]
+        return run_gs(
+            args + range_args + ["-sOutputFile=%s" % parts[i], filepath],
+            **kw,
+        )
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(len(ranges)) as executor:
+            statuses = list(executor.map(shrink_range, range(len(ranges))))
+        if any(statuses):
+            return 1
+
+        with Pdf.open(filepath) as src, Pdf.new() as dst:
+            opened = [Pdf.open(part) for part in parts]
+            try:
+                for part in opened:
+                    dst.pages.extend(part.pages)
+                if not len(dst.pages) == len(src.pages):
+                    return 1
+                dst.docinfo = dst.copy_foreign(src.docinfo)
+                _copy_outline(src, dst)
+                dst.save(output_file)
+            finally:
+                for part in opened:
+                    part.close()
+        return 0
+    finally:
+        for part in parts:
+            if os.path.exists(part):
+                os.unlink(part)
+
+
+def shrink_pdf(
+    filepath,
+    gs_path="gs",
+    gs_threads=DEFAULT_THREADS,
+    gs_tuned=False,
+    gs_backend=DEFAULT_BACKEND,
+    profile="printer",
+    gs_shards=0,
+):
+    """Shrink the PDF file size using Ghostscript
+
+    The profile is either ``printer``, for the printer preset of Ghostscript,
+    or ``eink``, which converts images to grayscale and downsamples them to
+    the resolution at which they are shown on the reMarkable.
+
+    Large files are split into page ranges that are shrunk by gs_shards
+    parallel processes (the number of CPUs if 0, 1 disables this). Files
+    with links to pages in the document are shrunk as a whole.
+    """
     logger.info("Shrinking pdf file ...")
     size_before = os.path.getsize(filepath)
     output_file = os.path.splitext(filepath)[0] + "-shrink.pdf"
-    status = subprocess.call(
+    profile_flags = []
+    if profile == "eink":
+        dpi = eink_resolution(filepath)
+        logger.info("Downsampling images to %i dpi in grayscale" % dpi)
+        profile_flags = eink_flags(dpi)
+    args = (
         [
-            gs_path,
             "-sDEVICE=pdfwrite",
             "-dCompatibilityLevel=1.4",
             "-dPDFSETTINGS=/printer",
-            "-dNOPAUSE",
-            "-dBATCH",
-            "-dQUIET",
-            "-sOutputFile=%s" % output_file,
-            filepath,
-        ],
-        stdout=subprocess.DEVNULL,
-        stderr=subprocess.DEVNULL,
+        ]
+        + profile_flags
+        + ["-dNOPAUSE", "-dBATCH", "-dQUIET"]
     )
+    gs_kwargs = dict(gs_path=gs_path, threads=gs_threads, tuned=gs_tuned)
+
+    with Pdf.open(filepath) as pdf:
+        n_pages = len(pdf.pages)
+        n_shards = _num_shards(n_pages, size_before, gs_shards)
+        if n_shards > 1 and _has_internal_links(pdf):
+            logger.info("Not splitting the pdf file, it has internal links")
+            n_shards = 1
+    if n_shards > 1:
+        # the libgs backend runs one call at a time, so use processes
+        status = _shrink_sharded(
+            filepath, output_file, args, n_pages, n_shards, **gs_kwargs
+        )
+    else:
+        status = run_gs(
+            args + ["-sOutputFile=%s" % output_file, filepath],
+            backend=gs_backend,
+            **gs_kwargs,
+        )
     if not status == 0:
         logger.warning("Failed to shrink the pdf file")
         return filepath
@@ -1,24 +1,14 @@
 # -*- coding: utf-8 -*-
 
-from .acl import ACL
-from .acm import ACM
-from .arxiv import Arxiv
-from .cvf import CVF
-from .diva import DiVA
-from .eccc import ECCC
-from .html import HTML
-from .iacr import IACR
-from .jmlr import JMLR
-from .local import LocalFile
-from .nature import Nature
-from .nber import NBER
-from .neurips import NeurIPS
-from .openreview import OpenReview
-from .pdf_url import PdfUrl
-from .pmlr import PMLR
-from .pubmed import PubMed
-from .semantic_scholar import SemanticScholar
-from .springer import Springer
+"""Registry of the providers
+
+The provider modules are imported lazily, when a provider class is first
+accessed. This keeps startup fast, as several providers depend on heavy
+libraries that are only needed when that provider actually runs.
+
+"""
+
+import importlib
 
 # # The following providers are no longer functional due to Cloudflare blocking
 # # automated access, and have therefore been removed from the list of providers
@@ -29,24 +19,49 @@ from .springer import Springer
 # from .tandfonline import TandFOnline
 
 # NOTE: Order matters here, PdfUrl and HTML should be last
-providers = [
-    ACL,
-    ACM,
-    Arxiv,
-    CVF,
-    DiVA,
-    ECCC,
-    IACR,
-    JMLR,
-    Nature,
-    NBER,
-    NeurIPS,
-    OpenReview,
-    PMLR,
-    PubMed,
-    Springer,
-    SemanticScholar,
-    LocalFile,
-    PdfUrl,
-    HTML,
+_PROVIDERS = [
+    ("ACL", ".acl"),
+    ("ACM", ".acm"),
+    ("Arxiv", ".arxiv"),
+    ("CVF", ".cvf"),
+    ("DiVA", ".diva"),
+    ("ECCC", ".eccc"),
+    ("IACR", ".iacr"),
+    ("JMLR", ".jmlr"),
+    ("Nature", ".nature"),
+    ("NBER", ".nber"),
+    ("NeurIPS", ".neurips"),
+    ("OpenReview", ".openreview"),
+    ("PMLR", ".pmlr"),
+    ("PubMed", ".pubmed"),
+    ("Springer", ".springer"),
+    ("SemanticScholar", ".semantic_scholar"),
+    ("LocalFile", ".local"),
+    ("PdfUrl", ".pdf_url"),
+    ("HTML", ".html"),
 ]
+
+_MODULES = dict(_PROVIDERS)
+
+
+def _load(name):
+    module = importlib.import_module(_MODULES[name], __name__)
+    return getattr(module, name)
+
+
+def iter_providers():
+    """Iterate over the provider classes in order, importing them lazily"""
+    for name, _ in _PROVIDERS:
+        yield _load(name)
+
+
+def __getattr__(name):
+    if name == "providers":
+        return list(iter_providers())
+    if name in _MODULES:
+        return _load(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_MODULES) + ["providers"])
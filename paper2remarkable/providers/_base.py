@@ -9,34 +9,55 @@ Copyright: 2019, G.J.J. van den Burg
 """
 
 import abc
+import concurrent.futures
+import contextlib
 import os
+import re
 import shutil
 import subprocess
 import tempfile
+import threading
 import time
+import urllib.parse
 
+from ..cache import DEFAULT_METADATA_TTL
+from ..cache import MetadataCache
 from ..exceptions import _CalledProcessError
+from ..ghostscript import DEFAULT_BACKEND
+from ..ghostscript import DEFAULT_SHRINK_THRESHOLD
+from ..ghostscript import DEFAULT_THREADS
+from ..ghostscript import run_gs
 from ..log import Logger
+from ..pdf_ops import analyze_pdf
 from ..pdf_ops import blank_pdf
+from ..pdf_ops import estimate_shrink
+from ..pdf_ops import linearize_pdf
 from ..pdf_ops import prepare_pdf
 from ..pdf_ops import shrink_pdf
-from ..utils import assert_file_is_pdf
 from ..utils import chdir
 from ..utils import check_pdftool
 from ..utils import download_url
 from ..utils import follow_redirects
+from ..utils import page_memo
 from ..utils import upload_to_remarkable_rmapi
 from ..utils import upload_to_remarkable_usb
 from ._info import Informer
 
 logger = Logger()
 
+DOI_REGEX = r"\b(?P<doi>10\.\d{4,9}/[^\s?#&]+)"
+
 
 class Provider(metaclass=abc.ABCMeta):
     """ABC for providers of pdf sources"""
 
     SUPPORTED_FORMATS = ["pdf", "ps", "epub"]
 
+    # Whether the paper information and the document can be retrieved at the
+    # same time. Providers that reuse the informer's results when retrieving
+    # the document should disable this.
+    concurrent_retrieve = True
+
     def __init__(
         self,
         verbose=False,
@@ -45,6 +66,7 @@ class Provider(metaclass=abc.ABCMeta):
         experimental=False,
         crop="left",
         blank=False,
+        linearize=False,
         remarkable_dir="/",
         usb_upload=False,
         rmapi_path="rmapi",
@@ -52,9 +74,17 @@ class Provider(metaclass=abc.ABCMeta):
         pdftk_path="pdftk",
         qpdf_path="qpdf",
         gs_path="gs",
+        gs_threads=DEFAULT_THREADS,
+        gs_tuned=False,
+        gs_backend=DEFAULT_BACKEND,
+        shrink_profile="printer",
+        shrink_threshold=DEFAULT_SHRINK_THRESHOLD,
+        gs_shards=0,
         css=None,
         font_urls=None,
         cookiejar=None,
+        metadata_ttl=DEFAULT_METADATA_TTL,
+        refresh_metadata=False,
     ):
         self.upload = upload
         self.debug = debug
@@ -66,14 +96,29 @@ class Provider(metaclass=abc.ABCMeta):
         self.pdftk_path = pdftk_path
         self.qpdf_path = qpdf_path
         self.gs_path = gs_path
+        self.gs_threads = gs_threads
+        self.gs_tuned = gs_tuned
+        self.gs_backend = gs_backend
+        self.shrink_profile = shrink_profile
+        self.shrink_threshold = shrink_threshold
+        self.gs_shards = gs_shards
         self.css = css
         self.font_urls = font_urls
         self.cookiejar = cookiejar
+        self.refresh_metadata = refresh_metadata
 
         self.informer = Informer()
 
+        # paper information is cached between runs, unless the ttl is zero
+        self.metadata_cache = (
+            MetadataCache(ttl=metadata_ttl) if metadata_ttl else None
+        )
+
         self.pdftool = check_pdftool(self.pdftk_path, self.qpdf_path)
 
+        # set to stop a download that is no longer needed, see retrieve
+        self._download_cancel = threading.Event()
+
         # wait time to not hit the server too frequently
         self.server_delay = 0
 
@@ -81,12 +126,20 @@ class Provider(metaclass=abc.ABCMeta):
         if not verbose:
             logger.disable()
 
+        # Time spent in the stages of the last run, see _timed
+        self.timings = {}
+        self._stage = None
+
+        # Profile of the retrieved file, see analyze_pdf
+        self.preflight = None
+        self.rewrite_skipped = False
+
         # Define the operations to run on the pdf. Providers can add others.
         self.operations = {format: [] for format in self.SUPPORTED_FORMATS}
-        self._configure_operations(crop, blank)
+        self._configure_operations(crop, blank, linearize)
         logger.info("Starting %s provider" % type(self).__name__)
 
-    def _configure_operations(self, crop, blank):
+    def _configure_operations(self, crop, blank, linearize=False):
         """Configure operations for PDF and PS formats"""
         # Formats that need PDF processing
         # No processing for epubs is assumed
@@ -97,7 +150,7 @@ class Provider(metaclass=abc.ABCMeta):
                 self.operations[fmt].append((operation_name, operation_func))
 
         # Base operations
-        add_operation(pdf_formats, "rewrite", self.rewrite_pdf)
+        add_operation(pdf_formats, "rewrite", self.maybe_rewrite_pdf)
 
         # Crop operations mapping
         crop_operations = {
@@ -117,6 +170,10 @@ class Provider(metaclass=abc.ABCMeta):
         # PDF-specific shrink operation
         add_operation(["pdf"], "shrink", self.shrink_pdf)
 
+        # Linearize the final file if specified
+        if linearize:
+            add_operation(pdf_formats, "linearize", linearize_pdf)
+
     @staticmethod
     @abc.abstractmethod
     def validate(src):
@@ -126,6 +183,64 @@ class Provider(metaclass=abc.ABCMeta):
     def get_abs_pdf_urls(self, src):
         """Get the url for the HTML page and the PDF file"""
 
+    @staticmethod
+    def get_paper_id(url):
+        """Get a canonical identifier for the paper at the url, if possible
+
+        By default a DOI in the url is used, providers can override this to
+        use the identifiers of their outlet. The extension of a pdf url isn't
+        part of the DOI, so the abstract and pdf urls get the same id.
+        """
+        m = re.search(DOI_REGEX, urllib.parse.unquote(url))
+        if m is None:
+            return None
+        doi = re.sub(r"\.pdf$", "", m.group("doi"), flags=re.IGNORECASE)
+        return "doi:" + doi.lower()
+
+    @classmethod
+    def get_identity(cls, src):
+        """Identity of the paper at src, used to recognize duplicates
+
+        This is the paper identifier if there is one, and otherwise the url
+        without its scheme and fragment.
+        """
+        paper_id = cls.get_paper_id(src)
+        if paper_id:
+            return paper_id
+        parts = urllib.parse.urlsplit(src)
+        return "url:" + urllib.parse.urlunsplit(
+            ("", parts.netloc.lower(), parts.path, parts.query, "")
+        ).lstrip("/")
+
+    def get_filename(self, abs_url):
+        """Generate the output filename from the paper information
+
+        The paper information is cached between runs under the canonical
+        paper identifier, so that it only has to be retrieved once.
+        """
+        paper_id = None
+        if self.metadata_cache is not None:
+            paper_id = self.get_paper_id(abs_url)
+
+        if paper_id and self.refresh_metadata:
+            self.metadata_cache.invalidate(paper_id)
+        elif paper_id:
+            info = self.metadata_cache.get(paper_id)
+            if info:
+                logger.info("Using cached paper info for %s" % paper_id)
+                self.informer.title = info["title"]
+                self.informer.authors = info["authors"]
+                self.informer.year = info["year"]
+
+        filename = self.informer.get_filename(abs_url)
+
+        info = self.informer
+        if paper_id and info.title and info.authors and info.year:
+            self.metadata_cache.put(
+                paper_id, info.title, info.authors, info.year
+            )
+        return filename
+
     # Wrappers for pdf operations that have additional arguments
     def crop_pdf(self, filepath):
         return prepare_pdf(filepath, "crop", pdftoppm_path=self.pdftoppm_path)
@@ -138,13 +253,102 @@ class Provider(metaclass=abc.ABCMeta):
     def right_pdf(self, filepath):
         return prepare_pdf(filepath, "right", pdftoppm_path=self.pdftoppm_path)
 
+    def maybe_rewrite_pdf(self, filepath):
+        """Rewrite the file, unless the preflight found it well-formed"""
+        profile = self.preflight
+        if profile and profile.describes(filepath) and profile.well_formed:
+            logger.info("Not rewriting, the pdf file is well-formed")
+            self.skip_stage("well-formed pdf")
+            self.rewrite_skipped = True
+            return filepath
+        return self.rewrite_pdf(filepath)
+
+    def estimate_shrink(self, filepath):
+        """Estimate the fraction by which shrinking reduces the file size
+
+        The preflight profile is used for the file it describes. When the
+        file wasn't rewritten, the other operations keep its fonts, images
+        and streams, so the profile is also used for the files made from the
+        retrieved file.
+        """
+        profile = self.preflight
+        if profile and (profile.describes(filepath) or self.rewrite_skipped):
+            return profile.estimate_shrink(profile=self.shrink_profile)
+        return estimate_shrink(filepath, profile=self.shrink_profile)
+
     def shrink_pdf(self, filepath):
-        return shrink_pdf(filepath, gs_path=self.gs_path)
+        if self.shrink_threshold > 0:
+            savings = self.estimate_shrink(filepath)
+            if savings < self.shrink_threshold:
+                logger.info(
+                    "Not shrinking, expected reduction is only %.0f%%"
+                    % (100 * savings)
+                )
+                self.skip_stage("expected reduction %.0f%%" % (100 * savings))
+                return filepath
+        return shrink_pdf(
+            filepath,
+            gs_path=self.gs_path,
+            gs_threads=self.gs_threads,
+            gs_tuned=self.gs_tuned,
+            gs_backend=self.gs_backend,
+            profile=self.shrink_profile,
+            gs_shards=self.gs_shards,
+        )
 
     def retrieve_pdf(self, pdf_url, filename):
         """Download pdf from src and save to filename"""
         # This must exist so that the LocalFile provider can overwrite it
-        download_url(pdf_url, filename, cookiejar=self.cookiejar)
+        download_url(
+            pdf_url,
+            filename,
+            cookiejar=self.cookiejar,
+            cancel=self._download_cancel,
+        )
+
+    def retrieve(self, abs_url, pdf_url, filename=None):
+        """Retrieve the document and determine the output filename
+
+        When no filename is given, the paper information is retrieved from the
+        abstract page while the document itself is downloaded, as both urls
+        are known at this point. The download is cancelled when this fails or
+        gives an unsupported format. Returns the output filename and the name
+        of the retrieved file in the current directory.
+        """
+        if filename or not self.concurrent_retrieve:
+            clean_filename = filename or self.get_filename(abs_url)
+            tmp_filename = self._tmp_filename(clean_filename)
+            self.retrieve_pdf(pdf_url, tmp_filename)
+            return clean_filename, tmp_filename
+
+        download_filename = "paper.download"
+        self._download_cancel.clear()
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        download = executor.submit(
+            self.retrieve_pdf, pdf_url, download_filename
+        )
+        try:
+            clean_filename = self.get_filename(abs_url)
+            tmp_filename = self._tmp_filename(clean_filename)
+        except BaseException:
+            # Don't wait for a download that isn't going to be used
+            self._download_cancel.set()
+            download.cancel()
+            raise
+        finally:
+            executor.shutdown()
+        download.result()
+
+        os.rename(download_filename, tmp_filename)
+        return clean_filename, tmp_filename
+
+    def _tmp_filename(self, clean_filename):
+        extension = clean_filename.split(".")[-1]
+        if extension not in self.SUPPORTED_FORMATS:
+            raise ValueError(
+                f"Unsupported file format {extension}. Must be one of {self.SUPPORTED_FORMATS}"
+            )
+        return f"paper.{extension}"
 
     def compress_pdf(self, in_pdf, out_pdf):
         """Compress a pdf file, returns subprocess status"""
@@ -176,9 +380,8 @@ class Provider(metaclass=abc.ABCMeta):
         if out_pdf is None:
             out_pdf = os.path.splitext(in_file)[0] + "-rewrite.pdf"
 
-        status = subprocess.call(
+        status = run_gs(
             [
-                self.gs_path,
                 "-sDEVICE=pdfwrite",
                 "-dQUIET",
                 "-dWriteXRefStm=false",
@@ -186,7 +389,11 @@ class Provider(metaclass=abc.ABCMeta):
                 "-o",
                 out_pdf,
                 in_file,
-            ]
+            ],
+            gs_path=self.gs_path,
+            threads=self.gs_threads,
+            tuned=self.gs_tuned,
+            backend=self.gs_backend,
         )
         if not status == 0:
             raise _CalledProcessError(
@@ -220,65 +427,165 @@ class Provider(metaclass=abc.ABCMeta):
                 "%s failed to uncompress the PDF file." % self.pdftool
             )
 
-    def run(self, src, filename=None):
-        # follow_redirects here is needed with library use
-        if os.path.exists(src):
-            src = src
-        elif self.cookiejar is None:
-            # NOTE: We assume that if the cookiejar is not None, we are
-            # properly redirected.
-            src, self.cookiejar = follow_redirects(src)
-            time.sleep(self.server_delay)
-
-        # extract page and pdf file urls
-        abs_url, pdf_url = self.get_abs_pdf_urls(src)
-
-        # generate nice filename if needed
-        clean_filename = filename or self.informer.get_filename(abs_url)
-        extension = clean_filename.split(".")[-1]
-        tmp_filename = f"paper.{extension}"
+    @contextlib.contextmanager
+    def _timed(self, stage):
+        """Record the time spent in a stage of the run in self.timings"""
+        self.timings[stage] = {"seconds": None, "skipped": None}
+        self._stage = stage
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[stage]["seconds"] = time.perf_counter() - start
+            self._stage = None
+
+    def skip_stage(self, reason):
+        """Record that the current stage had nothing to do
+
+        Operations call this when they find that their work isn't needed, so
+        that the decision shows up in the timings.
+        """
+        if self._stage is not None:
+            self.timings[self._stage]["skipped"] = reason
 
-        if extension not in self.SUPPORTED_FORMATS:
-            raise ValueError(
-                f"Unsupported file format {extension}. Must be one of {self.SUPPORTED_FORMATS}"
-            )
+    def inspect_pdf(self, pdf, profile):
+        """Add checks to the preflight of the retrieved file
+
+        Called by analyze_pdf with the open file and its profile. Providers
+        can override this to record what their operations need to know.
+        """
+
+    def _log_timings(self):
+        parts = []
+        for stage, timing in self.timings.items():
+            part = "%s %.2fs" % (stage, timing["seconds"])
+            if timing["skipped"]:
+                part += " (skipped: %s)" % timing["skipped"]
+            parts.append(part)
+        if parts:
+            logger.info("Stage timings: " + ", ".join(parts))
+
+    def run(self, src, filename=None, state=None):
+        """Retrieve and process the document and upload or save it
+
+        The state is a :class:`~paper2remarkable.batch.ItemState` in which
+        the finished stages are recorded. Stages that were finished in an
+        earlier run are skipped.
+        """
+        # Pages retrieved while processing this source are shared between the
+        # provider and the informer, so they are only downloaded once.
+        self.timings = {}
+        self.preflight = None
+        self.rewrite_skipped = False
+        with page_memo():
+            result = self._run(src, filename=filename, state=state)
+        self._log_timings()
+        return result
+
+    def _run(self, src, filename=None, state=None):
+        if self.debug:
+            state = None
+
+        resolved = state.get("resolved") if state else None
+        if resolved:
+            src = resolved["src"]
+            abs_url, pdf_url = resolved["abs_url"], resolved["pdf_url"]
+            if not os.path.exists(src) and self.cookiejar is None:
+                _, self.cookiejar = follow_redirects(src)
+        else:
+            with self._timed("resolve"):
+                # follow_redirects here is needed with library use
+                if os.path.exists(src):
+                    src = src
+                elif self.cookiejar is None:
+                    # NOTE: We assume that if the cookiejar is not None, we
+                    # are properly redirected.
+                    src, self.cookiejar = follow_redirects(src)
+                    time.sleep(self.server_delay)
+
+                # extract page and pdf file urls
+                abs_url, pdf_url = self.get_abs_pdf_urls(src)
+            if state:
+                state.record(
+                    "resolved", src=src, abs_url=abs_url, pdf_url=pdf_url
+                )
 
         self.initial_dir = os.getcwd()
         with tempfile.TemporaryDirectory(prefix="p2r_") as working_dir:
             with chdir(working_dir):
-                self.retrieve_pdf(pdf_url, tmp_filename)
-
-                if extension in "pdf ps".split():
-                    assert_file_is_pdf(tmp_filename)
-
-                intermediate_fname = tmp_filename
-                for opname, op in self.operations[extension]:
-                    intermediate_fname = op(intermediate_fname)
-
-                shutil.copy(intermediate_fname, clean_filename)
+                tmp_filename = None
+                downloaded = state.get("downloaded") if state else None
+                if downloaded:
+                    clean_filename = downloaded["clean_filename"]
+                    tmp_filename = state.restore(
+                        "downloaded", self._tmp_filename(clean_filename)
+                    )
+                if tmp_filename is None:
+                    with self._timed("retrieve"):
+                        clean_filename, tmp_filename = self.retrieve(
+                            abs_url, pdf_url, filename=filename
+                        )
+                    if state:
+                        state.record(
+                            "downloaded",
+                            tmp_filename,
+                            clean_filename=clean_filename,
+                        )
+                extension = tmp_filename.split(".")[-1]
+
+                intermediate_fname = None
+                if state and state.done("processed"):
+                    intermediate_fname = state.restore("processed")
+                if intermediate_fname is None:
+                    if extension in "pdf ps".split():
+                        with self._timed("preflight"):
+                            self.preflight = analyze_pdf(
+                                tmp_filename, inspect=self.inspect_pdf
+                            )
+                        logger.info("Preflight: " + self.preflight.summary())
+
+                    intermediate_fname = tmp_filename
+                    for opname, op in self.operations[extension]:
+                        with self._timed(opname):
+                            intermediate_fname = op(intermediate_fname)
+                    if state:
+                        state.record("processed", intermediate_fname)
+
+                # the operations may all have been skipped
+                if not (
+                    os.path.exists(clean_filename)
+                    and os.path.samefile(intermediate_fname, clean_filename)
+                ):
+                    shutil.copy(intermediate_fname, clean_filename)
 
                 if self.debug:
                     print("Paused in debug mode in dir: %s" % working_dir)
                     print("Press enter to exit.")
                     return input()
 
-                if self.upload:
-                    if not self.usb_upload:
-                        return upload_to_remarkable_rmapi(
-                            clean_filename,
-                            remarkable_dir=self.remarkable_dir,
-                            rmapi_path=self.rmapi_path,
-                        )
+                with self._timed("upload"):
+                    if self.upload:
+                        if not self.usb_upload:
+                            result = upload_to_remarkable_rmapi(
+                                clean_filename,
+                                remarkable_dir=self.remarkable_dir,
+                                rmapi_path=self.rmapi_path,
+                            )
+                        else:
+                            result = upload_to_remarkable_usb(
+                                clean_filename,
+                                remarkable_dir=self.remarkable_dir,
+                            )
                     else:
-                        return upload_to_remarkable_usb(
-                            clean_filename,
-                            remarkable_dir=self.remarkable_dir,
+                        target_path = os.path.join(
+                            self.initial_dir, clean_filename
                         )
-
-                target_path = os.path.join(self.initial_dir, clean_filename)
-                while os.path.exists(target_path):
-                    base = os.path.splitext(target_path)[0]
-                    target_path = base + "_.pdf"
-                shutil.move(clean_filename, target_path)
-
-        return target_path
+                        while os.path.exists(target_path):
+                            base = os.path.splitext(target_path)[0]
+                            target_path = base + "_.pdf"
+                        shutil.move(clean_filename, target_path)
+                        result = target_path
+
+        if state:
+            state.record("uploaded")
+        return result
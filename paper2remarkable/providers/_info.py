@@ -3,13 +3,12 @@
 """Functionality for retrieving paper info
 """
 
-import bs4
-import titlecase
 import unidecode
 
 from ..log import Logger
 from ..utils import clean_string
-from ..utils import get_page_with_retry
+from ..utils import get_head_with_retry
+from ..utils import get_soup_with_retry
 
 logger = Logger()
 
@@ -30,6 +29,11 @@ class Informer:
     meta_title_key = "citation_title"
     meta_date_key = "citation_date"
 
+    # Whether all information is in the meta tags in the head of the page, so
+    # that the body doesn't need to be downloaded and parsed. Informers that
+    # look at the body must set this to False.
+    head_only = True
+
     def __init__(self, title=None, authors=None, year=None):
         self.title = title
         self.authors = authors or []
@@ -41,6 +45,8 @@ class Informer:
         The provided url must be to a HTMl page where this information can be
         found, not to the PDF file itself.
         """
+        import titlecase
+
         logger.info("Generating output filename")
 
         # Retrieve the paper information
@@ -68,13 +74,23 @@ class Informer:
         return name
 
     def get_info(self, url):
+        if self.title and self.authors and self.year:
+            # nothing to retrieve, for instance when the info was cached
+            return
         logger.info("Getting paper info")
-        page = get_page_with_retry(url)
-        soup = bs4.BeautifulSoup(page, "html.parser")
+        soup = self._get_soup(url)
         self.authors = self.authors or self.get_authors(soup)
         self.title = self.title or self.get_title(soup)
         self.year = self.year or self.get_year(soup)
 
+    def _get_soup(self, url):
+        if self.head_only:
+            head = get_head_with_retry(url)
+            if head.find("meta", {"name": self.meta_title_key}):
+                return head
+            logger.info("No meta tags in the head, parsing the full page")
+        return get_soup_with_retry(url)
+
     ## Title
 
     def get_title(self, soup):
@@ -59,6 +59,14 @@ class ACL(Provider):
 
         raise URLResolutionError("ACL", url)
 
+    @staticmethod
+    def get_paper_id(url):
+        for regex in [ACL.re_pdf_1, ACL.re_pdf_2, ACL.re_abs_1, ACL.re_abs_2]:
+            m = re.match(regex, url)
+            if m:
+                return "acl:" + m.group("key")
+        return None
+
     @staticmethod
     def validate(src):
         return (
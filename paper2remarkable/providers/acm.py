@@ -19,6 +19,7 @@ logger = Logger()
 
 
 class ACMInformer(Informer):
+    head_only = False
     meta_author_key = "citation_authors"
 
     def get_title(self, soup):
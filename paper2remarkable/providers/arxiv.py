@@ -11,8 +11,11 @@ Copyright: 2019, G.J.J. van den Burg
 import os
 import re
 
+import pikepdf
+
 from ..exceptions import URLResolutionError
 from ..log import Logger
+from ..pdf_ops import _inherited
 from ._base import Provider
 from ._info import Informer
 
@@ -23,17 +26,32 @@ DEARXIV_URI_REGEX = (
     b"https?://ar(x|X)iv\.org\/abs\/([\w\-]+\/\d+|\d{4}\.\d{4,5})v\d+"
 )
 
+# The text of the stamp, the url of the stamp, and the url in the alternative
+# form used by for instance Jackson arXiv 0309285v2, combined so that every
+# object is searched only once.
+DEARXIV_REGEX = re.compile(
+    b"|".join(
+        [
+            b"(?P<text>\\(%s\\)Tj)" % DEARXIV_TEXT_REGEX,
+            b"(?P<uri><<\n\\/URI \\(%s\\)\n\\/S /URI\n>>\n)"
+            % DEARXIV_URI_REGEX,
+            b"(?P<uri2><<\n\\/S \\/URI\n/URI \\(%s\\)\n>>\n)"
+            % DEARXIV_URI_REGEX,
+        ]
+    )
+)
+
 
 class ArxivInformer(Informer):
     pass
 
 
 class Arxiv(Provider):
-    re_abs_1 = r"https?://arxiv.org/abs/\d{4}\.\d{4,5}(v\d+)?"
-    re_pdf_1 = r"https?://arxiv.org/pdf/\d{4}\.\d{4,5}(v\d+)?(\.pdf)?"
+    re_abs_1 = r"https?://arxiv.org/abs/(?P<id>\d{4}\.\d{4,5})(v\d+)?"
+    re_pdf_1 = r"https?://arxiv.org/pdf/(?P<id>\d{4}\.\d{4,5})(v\d+)?(\.pdf)?"
 
-    re_abs_2 = r"https?://arxiv.org/abs/[\w\-]+/\d{7}(v\d+)?"
-    re_pdf_2 = r"https?://arxiv.org/pdf/[\w\-]+/\d{7}(v\d+)?(\.pdf)?"
+    re_abs_2 = r"https?://arxiv.org/abs/(?P<id>[\w\-]+/\d{7})(v\d+)?"
+    re_pdf_2 = r"https?://arxiv.org/pdf/(?P<id>[\w\-]+/\d{7})(v\d+)?(\.pdf)?"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -70,111 +88,57 @@ class Arxiv(Provider):
             or re.match(Arxiv.re_pdf_2, src)
         )
 
+    @staticmethod
+    def get_paper_id(url):
+        """Get the arXiv identifier, without version"""
+        for regex in [
+            Arxiv.re_abs_1,
+            Arxiv.re_pdf_1,
+            Arxiv.re_abs_2,
+            Arxiv.re_pdf_2,
+        ]:
+            m = re.match(regex, url)
+            if m:
+                return "arxiv:" + m.group("id")
+        return None
+
+    def inspect_pdf(self, pdf, profile):
+        profile.arxiv_stamp = _first_page_has_stamp(pdf)
+
     def dearxiv(self, input_file):
         """Remove the arXiv timestamp from a pdf"""
         logger.info("Removing arXiv timestamp ... ", end="")
         basename = os.path.splitext(input_file)[0]
 
+        profile = self.preflight
+        if profile and profile.describes(input_file):
+            has_stamp = profile.arxiv_stamp
+        else:
+            has_stamp = has_arxiv_stamp(input_file)
+        if not has_stamp:
+            logger.append("none found", "info")
+            self.skip_stage("no arXiv stamp on the first page")
+            return input_file
+
+        if self.experimental:
+            output_file = basename + "_dearxiv.pdf"
+            replaced_arXiv = remove_stamp_pikepdf(input_file, output_file)
+            logger.append(
+                "[experimental] success" if replaced_arXiv else "none found",
+                "info",
+            )
+            return output_file
+
         recoded_file = basename + "_rewrite.pdf"
         self.rewrite_pdf(input_file, recoded_file)
 
         uncompress_file = basename + "_uncompress.pdf"
         self.uncompress_pdf(recoded_file, uncompress_file)
 
-        new_data = []
-        current_obj = []
-        replaced_arXiv = False
-        char_count = skip_n = startxref = 0
-        xref = {}
-
-        with open(uncompress_file, "rb") as fp:
-            for line in fp:
-                if skip_n:
-                    # Skip a line
-                    skip_n -= 1
-                    continue
-
-                if line.endswith(b" obj\n") or line.endswith(b" obj \n"):
-                    # Start a new object. Add it to the current object and
-                    # record its position for the xref table.
-                    current_obj.append(line)
-                    objid = int(line.split(b" ")[0])
-                    xref[objid] = char_count
-                elif current_obj and (
-                    line.startswith(b"endobj")
-                    and not line.startswith(b"endobj xref")
-                ):
-                    # End the current object. If needed, replace the arXiv
-                    # stamp in the block (done only once). Reset current
-                    # object.
-                    current_obj.append(line)
-                    block = b"".join(current_obj)
-                    # remove the text
-                    block, n_subs1 = re.subn(
-                        b"\(" + DEARXIV_TEXT_REGEX + b"\)Tj",
-                        b"()Tj",
-                        block,
-                    )
-                    # remove the url (type 1)
-                    block, n_subs2 = re.subn(
-                        b"<<\n\/URI \("
-                        + DEARXIV_URI_REGEX
-                        + b"\)\n\/S /URI\n>>\n",
-                        b"",
-                        block,
-                    )
-                    # remove the url (type 2, i.e. Jackson arXiv 0309285v2)
-                    block, n_subs3 = re.subn(
-                        b"<<\n\/S \/URI\n"
-                        + b"/URI \("
-                        + DEARXIV_URI_REGEX
-                        + b"\)\n>>\n",
-                        b"",
-                        block,
-                    )
-
-                    if n_subs1 or n_subs2:
-                        # fix the length of the object stream
-                        block = fix_stream_length(block)
-                        replaced_arXiv = True
-                    new_data.append(block)
-                    char_count += len(block)
-                    current_obj = []
-                elif line in [b"xref\n", b"endobj xref\n"]:
-                    if b"endobj" in line and current_obj:
-                        current_obj.append(b"endobj\n")
-                        block = b"".join(current_obj)
-                        new_data.append(block)
-                        char_count += len(block)
-                        current_obj = []
-                        line = b"xref\n"
-                    # We found the xref table, record its position and write it
-                    # out using our updated indices.
-                    startxref = sum(map(len, new_data))
-                    new_data.append(line)
-                    new_data.append(b"0 %i\n" % (len(xref) + 1))
-                    new_data.append(b"0000000000 65535 f \n")
-                    for objid in sorted(xref):
-                        new_data.append(b"%010d 00000 n \n" % xref[objid])
-
-                    # skip the appropriate number of lines
-                    skip_n = len(xref) + 2
-                elif current_obj:
-                    # If we're recording an object, simply add the line to it
-                    current_obj.append(line)
-                elif line == b"startxref\n":
-                    # Write out our recorded startxref position, skip the old
-                    # position.
-                    new_data.append(b"startxref\n%i\n" % startxref)
-                    skip_n = 1
-                else:
-                    # Anything else passes through
-                    new_data.append(line)
-                    char_count += len(line)
-
         removed_file = basename + "_removed.pdf"
-        with open(removed_file, "wb") as fp:
-            fp.write(b"".join(new_data))
+        with open(uncompress_file, "rb") as fin:
+            with open(removed_file, "wb") as fout:
+                replaced_arXiv = remove_stamp(fin, fout)
 
         output_file = basename + "_dearxiv.pdf"
         self.compress_pdf(removed_file, output_file)
@@ -184,6 +148,206 @@ class Arxiv(Provider):
         return output_file
 
 
+def _remove_from_block(block):
+    """Remove the stamp from an object, returns the block and whether the
+    stream length must be fixed"""
+    # Most objects don't mention arXiv at all, skip the regex for those
+    if not (b"arXiv" in block or b"arxiv" in block):
+        return block, False
+
+    found = []
+
+    def replace(match):
+        found.append(match.lastgroup)
+        return b"()Tj" if match.lastgroup == "text" else b""
+
+    block = DEARXIV_REGEX.sub(replace, block)
+    return block, "text" in found or "uri" in found
+
+
+def remove_stamp(fin, fout):
+    """Copy an uncompressed PDF from fin to fout, removing the arXiv stamp
+
+    The file is processed line by line and written out as it is read, only a
+    single object is kept in memory at a time. The xref table is rewritten
+    with the new positions of the objects. Returns whether the stamp was
+    found.
+    """
+    current_obj = []
+    replaced_arXiv = False
+    skip_n = startxref = 0
+    xref = {}
+
+    for line in fin:
+        if skip_n:
+            # Skip a line
+            skip_n -= 1
+            continue
+
+        if line.endswith(b" obj\n") or line.endswith(b" obj \n"):
+            # Start a new object. Add it to the current object and record its
+            # position for the xref table.
+            current_obj.append(line)
+            objid = int(line.split(b" ")[0])
+            xref[objid] = fout.tell()
+        elif current_obj and (
+            line.startswith(b"endobj") and not line.startswith(b"endobj xref")
+        ):
+            # End the current object. If needed, replace the arXiv stamp in
+            # the block. Reset current object.
+            current_obj.append(line)
+            block, removed = _remove_from_block(b"".join(current_obj))
+            if removed:
+                # fix the length of the object stream
+                block = fix_stream_length(block)
+                replaced_arXiv = True
+            fout.write(block)
+            current_obj = []
+        elif line in [b"xref\n", b"endobj xref\n"]:
+            if b"endobj" in line and current_obj:
+                current_obj.append(b"endobj\n")
+                fout.write(b"".join(current_obj))
+                current_obj = []
+                line = b"xref\n"
+            # We found the xref table, record its position and write it out
+            # using our updated indices.
+            startxref = fout.tell()
+            fout.write(line)
+            fout.write(b"0 %i\n" % (len(xref) + 1))
+            fout.write(b"0000000000 65535 f \n")
+            for objid in sorted(xref):
+                fout.write(b"%010d 00000 n \n" % xref[objid])
+
+            # skip the appropriate number of lines
+            skip_n = len(xref) + 2
+        elif current_obj:
+            # If we're recording an object, simply add the line to it
+            current_obj.append(line)
+        elif line == b"startxref\n":
+            # Write out our recorded startxref position, skip the old
+            # position.
+            fout.write(b"startxref\n%i\n" % startxref)
+            skip_n = 1
+        else:
+            # Anything else passes through
+            fout.write(line)
+
+    return replaced_arXiv
+
+
+def _stream_data(obj):
+    """Decoded data of a content stream, or of an array of them"""
+    if isinstance(obj, pikepdf.Array):
+        return b"\n".join(_stream_data(x) for x in obj)
+    if isinstance(obj, pikepdf.Stream):
+        return obj.read_bytes()
+    return b""
+
+
+def has_arxiv_stamp(filename):
+    """Check whether the first page of a PDF may have the arXiv stamp
+
+    Only the decoded content of the first page, the form xobjects it uses,
+    and its link annotations are searched. Files that can't be opened with
+    pikepdf (such as postscript files) are assumed to have the stamp.
+    """
+    try:
+        with pikepdf.Pdf.open(filename) as pdf:
+            return _first_page_has_stamp(pdf)
+    except pikepdf.PdfError:
+        return True
+
+
+def _first_page_has_stamp(pdf):
+    if not len(pdf.pages):
+        return False
+    page = pdf.pages[0].obj
+    data = [_stream_data(page.get("/Contents"))]
+    # the resources may be inherited from the page tree
+    resources = _inherited(page, "/Resources") or {}
+    xobjects = resources.get("/XObject", {})
+    for _, xobj in xobjects.items():
+        if xobj.get("/Subtype") == pikepdf.Name.Form:
+            data.append(_stream_data(xobj))
+    if any(re.search(DEARXIV_TEXT_REGEX, x) for x in data):
+        return True
+    return any(_is_stamp_link(a) for a in page.get("/Annots", []))
+
+
+def _is_stamp(operands, operator):
+    """Whether a content stream instruction shows the text of the stamp"""
+    if operator == pikepdf.Operator("Tj"):
+        text = bytes(operands[0])
+    elif operator == pikepdf.Operator("TJ"):
+        text = b"".join(
+            bytes(x) for x in operands[0] if isinstance(x, pikepdf.String)
+        )
+    else:
+        return False
+    return re.fullmatch(DEARXIV_TEXT_REGEX, text) is not None
+
+
+def _remove_from_content(obj, write):
+    """Remove the stamp from the content stream of a page or form xobject"""
+    try:
+        instructions = pikepdf.parse_content_stream(obj)
+    except pikepdf.PdfError:
+        return False
+    kept = [
+        (operands, operator)
+        for operands, operator in instructions
+        if not _is_stamp(operands, operator)
+    ]
+    if len(kept) == len(instructions):
+        return False
+    write(pikepdf.unparse_content_stream(kept))
+    return True
+
+
+def _is_stamp_link(annot):
+    action = annot.get("/A")
+    if action is None or action.get("/S") != pikepdf.Name.URI:
+        return False
+    uri = bytes(action.get("/URI", b""))
+    return re.fullmatch(DEARXIV_URI_REGEX, uri) is not None
+
+
+def remove_stamp_pikepdf(input_file, output_file):
+    """Remove the arXiv stamp from the first page of a PDF using pikepdf
+
+    Only the content stream of the first page, the form xobjects it uses, and
+    its link annotations are searched, and the file is saved once. Unlike
+    :func:`remove_stamp` this works for files with object streams. Returns
+    whether the stamp was found.
+    """
+    with pikepdf.Pdf.open(input_file) as pdf:
+        if not len(pdf.pages):
+            pdf.save(output_file)
+            return False
+        page = pdf.pages[0]
+
+        def write_page(data):
+            page.obj.Contents = pdf.make_stream(data)
+
+        found = _remove_from_content(page.obj, write_page)
+
+        resources = _inherited(page.obj, "/Resources") or {}
+        xobjects = resources.get("/XObject", {})
+        for _, xobj in xobjects.items():
+            if xobj.get("/Subtype") == pikepdf.Name.Form:
+                found |= _remove_from_content(xobj, xobj.write)
+
+        annots = page.obj.get("/Annots")
+        if annots is not None:
+            kept = [a for a in annots if not _is_stamp_link(a)]
+            if len(kept) < len(annots):
+                page.obj.Annots = pdf.make_indirect(pikepdf.Array(kept))
+                found = True
+
+        pdf.save(output_file)
+    return found
+
+
 def fix_stream_length(block):
     # This fixes the stream length of a block, which is needed after we have
     # removed the arXiv stamp.
@@ -23,8 +23,8 @@ class CVFInformer(Informer):
 
 
 class CVF(Provider):
-    re_abs = r"^https?://openaccess.thecvf.com/content_([\w\d]+)/html/([\w\d\_\-]+).html$"
-    re_pdf = r"^https?://openaccess.thecvf.com/content_([\w\d]+)/papers/([\w\d\_\-]+).pdf$"
+    re_abs = r"^https?://openaccess.thecvf.com/content_(?P<conf>[\w\d]+)/html/(?P<name>[\w\d\_\-]+).html$"
+    re_pdf = r"^https?://openaccess.thecvf.com/content_(?P<conf>[\w\d]+)/papers/(?P<name>[\w\d\_\-]+).pdf$"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -43,6 +43,11 @@ class CVF(Provider):
             raise URLResolutionError("CVF", url)
         return abs_url, pdf_url
 
+    @staticmethod
+    def get_paper_id(url):
+        m = re.match(CVF.re_abs, url) or re.match(CVF.re_pdf, url)
+        return "cvf:%s/%s" % (m.group("conf"), m.group("name")) if m else None
+
     @staticmethod
     def validate(src):
         m = re.match(CVF.re_abs, src) or re.match(CVF.re_pdf, src)
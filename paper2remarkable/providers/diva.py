@@ -10,12 +10,10 @@ Copyright: 2019, 2024, G.J.J. van den Burg, Johan Holmberg
 
 import re
 
-import bs4
-
 from ..exceptions import FulltextMissingError
 from ..exceptions import URLResolutionError
 from ..log import Logger
-from ..utils import get_page_with_retry
+from ..utils import get_soup_with_retry
 from ._base import Provider
 from ._info import Informer
 
@@ -47,8 +45,7 @@ class DiVA(Provider):
         self.informer = DiVAInformer()
 
     def _get_doc_url(self, abs_url):
-        page = get_page_with_retry(abs_url)
-        soup = bs4.BeautifulSoup(page, "html.parser")
+        soup = get_soup_with_retry(abs_url)
 
         pdf_url = soup.find("meta", {"name": "citation_pdf_url"})
         if pdf_url is None:
@@ -21,6 +21,8 @@ logger = Logger()
 
 
 class ECCCInformer(Informer):
+    head_only = False
+
     def _get_paper_div(self, soup):
         h3 = soup.find(lambda t: t.name == "h3" and t.get_text() == "Paper:")
         div = h3.find_next_sibling("div")
@@ -67,8 +69,10 @@ class ECCCInformer(Informer):
 
 
 class ECCC(Provider):
-    re_abs = r"https?://eccc.weizmann.ac.il/report/\d{4}/\d+/?$"
-    re_pdf = r"https?://eccc.weizmann.ac.il/report/\d{4}/\d+/download/?$"
+    re_abs = r"https?://eccc.weizmann.ac.il/report/(?P<id>\d{4}/\d+)/?$"
+    re_pdf = (
+        r"https?://eccc.weizmann.ac.il/report/(?P<id>\d{4}/\d+)/download/?$"
+    )
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -85,6 +89,11 @@ class ECCC(Provider):
             raise URLResolutionError("ECCC", url)
         return abs_url, pdf_url
 
+    @staticmethod
+    def get_paper_id(url):
+        m = re.match(ECCC.re_abs, url) or re.match(ECCC.re_pdf, url)
+        return "eccc:" + m.group("id") if m else None
+
     @staticmethod
     def validate(src):
         return re.match(ECCC.re_abs, src) or re.match(ECCC.re_pdf, src)
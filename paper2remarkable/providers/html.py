@@ -16,10 +16,8 @@ import urllib
 
 import html2text
 import markdown
-import readability
 import titlecase
 import unidecode
-import weasyprint
 
 from ..log import Logger
 from ..utils import clean_string
@@ -71,6 +69,8 @@ FONT_URLS = [
 
 
 def url_fetcher(url):
+    import weasyprint
+
     if url.startswith("//"):
         url = "https:" + url
     elif url.startswith("file:///"):
@@ -102,6 +102,8 @@ def make_readable(request_html):
         title = article["title"]
         raw_html = article["content"]
     else:
+        import readability
+
         logger.info("Converting HTML using readability")
         doc = readability.Document(request_html)
         title = doc.title()
@@ -148,6 +150,9 @@ class HTMLInformer(Informer):
 
 
 class HTML(Provider):
+    # The article is extracted by the informer and reused in retrieve_pdf
+    concurrent_retrieve = False
+
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.informer = HTMLInformer()
@@ -203,6 +208,8 @@ class HTML(Provider):
         4. Convert the HTML to PDF, pulling in images where needed
         5. Save the PDF to the specified filename.
         """
+        import weasyprint
+
         if self.informer._cached_title and self.informer._cached_article:
             title = self.informer._cached_title
             article = self.informer._cached_article
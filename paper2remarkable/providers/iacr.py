@@ -12,11 +12,9 @@ import os
 import re
 import urllib.parse
 
-import bs4
-
 from ..exceptions import URLResolutionError
 from ..log import Logger
-from ..utils import get_page_with_retry
+from ..utils import get_soup_with_retry
 from ._base import Provider
 from ._info import Informer
 
@@ -24,6 +22,8 @@ logger = Logger()
 
 
 class IACRInformer(Informer):
+    head_only = False
+
     def get_title(self, soup):
         title = soup.find_all("title")
         if not title:
@@ -65,17 +65,16 @@ class IACRInformer(Informer):
 
 
 class IACR(Provider):
-    re_abs = r"https?://eprint.iacr.org/\d{4}/\d+$"
-    re_pdf = r"https?://eprint.iacr.org/\d{4}/\d+\.pdf$"
-    re_ps = r"https?://eprint.iacr.org/\d{4}/\d+\.ps$"
+    re_abs = r"https?://eprint.iacr.org/(?P<id>\d{4}/\d+)$"
+    re_pdf = r"https?://eprint.iacr.org/(?P<id>\d{4}/\d+)\.pdf$"
+    re_ps = r"https?://eprint.iacr.org/(?P<id>\d{4}/\d+)\.ps$"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.informer = IACRInformer()
 
     def _get_doc_url(self, abs_url):
-        page = get_page_with_retry(abs_url)
-        soup = bs4.BeautifulSoup(page, "html.parser")
+        soup = get_soup_with_retry(abs_url)
 
         dts = soup.find_all("dt")
         dt = next(
@@ -131,6 +130,14 @@ class IACR(Provider):
         super().retrieve_pdf(pdf_url, tmpfilename)
         self.rewrite_pdf(tmpfilename, out_pdf=filename)
 
+    @staticmethod
+    def get_paper_id(url):
+        for regex in [IACR.re_abs, IACR.re_pdf, IACR.re_ps]:
+            m = re.match(regex, url)
+            if m:
+                return "iacr:" + m.group("id")
+        return None
+
     @staticmethod
     def validate(src):
         return re.match(IACR.re_abs, src) or re.match(IACR.re_pdf, src)
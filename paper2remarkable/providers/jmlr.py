@@ -64,6 +64,19 @@ class JMLR(Provider):
             raise URLResolutionError("JMLR", url)
         return abs_url, pdf_url
 
+    @staticmethod
+    def get_paper_id(url):
+        for regex in [
+            JMLR.re_abs_1,
+            JMLR.re_pdf_1,
+            JMLR.re_abs_2,
+            JMLR.re_pdf_2,
+        ]:
+            m = re.match(regex, url)
+            if m:
+                return "jmlr:v%s/%s" % (m.group("vol"), m.group("pid"))
+        return None
+
     @staticmethod
     def validate(src):
         return (
@@ -11,6 +11,7 @@ Copyright: 2019, G.J.J. van den Burg
 import os
 import shutil
 
+from ..utils import file_hash
 from ._base import Provider
 from ._info import Informer
 
@@ -30,6 +31,11 @@ class LocalFile(Provider):
         # pdf_url.
         return url, url
 
+    @classmethod
+    def get_identity(cls, src):
+        """Local files are identified by the hash of their contents"""
+        return "sha256:" + file_hash(src)
+
     @staticmethod
     def validate(src):
         return os.path.exists(src)
@@ -23,8 +23,8 @@ class NatureInformer(Informer):
 
 
 class Nature(Provider):
-    re_abs = r"^https://www.nature.com/articles/s[a-z0-9\-]+$"
-    re_pdf = r"^https://www.nature.com/articles/s[a-z0-9\-]+\.pdf$"
+    re_abs = r"^https://www.nature.com/articles/(?P<id>s[a-z0-9\-]+)$"
+    re_pdf = r"^https://www.nature.com/articles/(?P<id>s[a-z0-9\-]+)\.pdf$"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -41,6 +41,12 @@ class Nature(Provider):
             raise URLResolutionError("Nature", url)
         return abs_url, pdf_url
 
+    @staticmethod
+    def get_paper_id(url):
+        """Nature article identifiers are the suffix of the DOI"""
+        m = re.match(Nature.re_abs, url) or re.match(Nature.re_pdf, url)
+        return "doi:10.1038/" + m.group("id") if m else None
+
     @staticmethod
     def validate(src):
         return re.match(Nature.re_abs, src) or re.match(Nature.re_pdf, src)
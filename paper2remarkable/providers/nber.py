@@ -56,6 +56,14 @@ class NBER(Provider):
             raise URLResolutionError("NBER", url)
         return abs_url, pdf_url
 
+    @staticmethod
+    def get_paper_id(url):
+        for regex in [NBER.re_abs, NBER.re_pdf, NBER.re_pdf_2]:
+            m = re.match(regex, url)
+            if m:
+                return "nber:" + m.group("ref")
+        return None
+
     @staticmethod
     def validate(src):
         return (
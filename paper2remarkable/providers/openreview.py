@@ -20,6 +20,7 @@ logger = Logger()
 
 
 class OpenReviewInformer(Informer):
+    head_only = False
     meta_date_key = "citation_online_date"
 
     def get_authors(self, soup):
@@ -55,8 +56,8 @@ class OpenReviewInformer(Informer):
 
 
 class OpenReview(Provider):
-    re_abs = r"https?://openreview.net/forum\?id=[A-Za-z0-9]+"
-    re_pdf = r"https?://openreview.net/pdf\?id=[A-Za-z0-9]+"
+    re_abs = r"https?://openreview.net/forum\?id=(?P<id>[A-Za-z0-9]+)"
+    re_pdf = r"https?://openreview.net/pdf\?id=(?P<id>[A-Za-z0-9]+)"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -74,6 +75,13 @@ class OpenReview(Provider):
             raise URLResolutionError("OpenReview", url)
         return abs_url, pdf_url
 
+    @staticmethod
+    def get_paper_id(url):
+        m = re.match(OpenReview.re_abs, url) or re.match(
+            OpenReview.re_pdf, url
+        )
+        return "openreview:" + m.group("id") if m else None
+
     @staticmethod
     def validate(src):
         """Check if the url is a valid OpenReview url."""
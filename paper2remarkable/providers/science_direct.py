@@ -12,16 +12,9 @@ import json
 import re
 import urllib
 
-import bs4
-
-from Crypto import Random
-from Crypto.Cipher import AES
-from Crypto.Hash import SHA256
-from Crypto.Util.Padding import pad
-
 from ..exceptions import URLResolutionError
 from ..log import Logger
-from ..utils import get_page_with_retry
+from ..utils import get_soup_with_retry
 from ._base import Provider
 from ._info import Informer
 
@@ -29,6 +22,7 @@ logger = Logger()
 
 
 class ScienceDirectInformer(Informer):
+    head_only = False
     meta_date_key = "citation_publication_date"
 
     def get_authors(self, soup):
@@ -71,8 +65,7 @@ class ScienceDirect(Provider):
         return abs_url, pdf_url
 
     def _get_pdf_url(self, url):
-        page = get_page_with_retry(url)
-        soup = bs4.BeautifulSoup(page, "html.parser")
+        soup = get_soup_with_retry(url)
 
         # For open access (and maybe behind institution?) the full text pdf url
         # is retrieved by mimicking the authentication dance in Python.
@@ -104,8 +97,7 @@ class ScienceDirect(Provider):
 
         # Open the temp url, this lands us on a page that requires Javascript
         # to do an authentication dance
-        page = get_page_with_retry(tmp_url)
-        soup = bs4.BeautifulSoup(page, "html.parser")
+        soup = get_soup_with_retry(tmp_url)
         script = soup.find(
             lambda tag: tag.name == "script" and "subtle.encrypt" in tag.text
         )
@@ -154,8 +146,7 @@ class ScienceDirect(Provider):
 
         # tmp_url2 gives a page with a ten second wait or a direct url, we need
         # the direct url
-        page = get_page_with_retry(tmp_url2)
-        soup = bs4.BeautifulSoup(page, "html.parser")
+        soup = get_soup_with_retry(tmp_url2)
         noscript = soup.find_all("noscript")
         if not noscript:
             raise URLResolutionError("ScienceDirect", url)
@@ -186,6 +177,11 @@ class ScienceDirect(Provider):
         return t
 
     def sd_run(self, token, data):
+        from Crypto import Random
+        from Crypto.Cipher import AES
+        from Crypto.Hash import SHA256
+        from Crypto.Util.Padding import pad
+
         # token is the string that is passed to sha-256
         # data is the string that is passed to encrypt
         a = Random.new().read(16)
@@ -10,11 +10,9 @@ Copyright: 2020, G.J.J. van den Burg
 
 import re
 
-import bs4
-
 from ..exceptions import URLResolutionError
 from ..utils import get_content_type_with_retry
-from ..utils import get_page_with_retry
+from ..utils import get_soup_with_retry
 from ._base import Provider
 from ._info import Informer
 
@@ -27,7 +25,7 @@ class SemanticScholarInformer(Informer):
 
 
 class SemanticScholar(Provider):
-    re_abs = r"https?:\/\/www.semanticscholar.org/paper/[A-Za-z0-9%\-]+/[0-9a-f]{40}"
+    re_abs = r"https?:\/\/www.semanticscholar.org/paper/[A-Za-z0-9%\-]+/(?P<id>[0-9a-f]{40})"
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
@@ -43,8 +41,7 @@ class SemanticScholar(Provider):
         return abs_url, pdf_url
 
     def _get_pdf_url(self, url):
-        page = get_page_with_retry(url)
-        soup = bs4.BeautifulSoup(page, "html.parser")
+        soup = get_soup_with_retry(url)
 
         # First try to get the direct url to the PDF file from the HTML
         a = soup.find(
@@ -87,6 +84,11 @@ class SemanticScholar(Provider):
             )
         return pdf_url
 
+    @staticmethod
+    def get_paper_id(url):
+        m = re.match(SemanticScholar.re_abs, url)
+        return "s2:" + m.group("id") if m else None
+
     @staticmethod
     def validate(src):
         return re.match(SemanticScholar.re_abs, src)
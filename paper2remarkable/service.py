@@ -0,0 +1,567 @@
+# -*- coding: utf-8 -*-
+
+"""HTTP service that processes papers for multiple users
+
+Jobs are submitted to a small HTTP API and stored in a durable queue in an
+SQLite database, from which worker processes take them. The API is:
+
+    POST /jobs               submit a job, either as a JSON object with a
+                             "url" or as a PDF file in the body, in which
+                             case the other fields are query parameters
+    GET  /jobs               list the jobs, optionally filtered on ?status=
+    GET  /jobs/<id>          status of a job, including its log
+    POST /jobs/<id>/retry    queue a failed job again
+
+Besides the input, a job can have a "filename", an "account", and the options
+in :data:`JOB_OPTIONS`. Accounts are names of rmapi configuration files, set
+in the ``service`` section of the configuration file. When ``upload_dir`` is
+set in that section, files are placed in ``<upload_dir>/<account>/<dir>``
+instead of being uploaded, which is useful for testing. Jobs for files that
+are already on the server can be submitted with a "path" instead of a "url"
+if ``allow_paths`` is enabled.
+
+Uploaded files are stored in the ``uploads`` directory next to the queue,
+and removed when their job is done. Files of failed jobs are kept so that
+the job can be retried.
+
+The API has no authentication, so the service listens on localhost unless
+another host is given. Workers that stop because of an error outside of a
+job, such as a database error, are restarted.
+
+"""
+
+import copy
+import io
+import json
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+import urllib.parse
+
+from contextlib import redirect_stderr
+from contextlib import redirect_stdout
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler
+from http.server import ThreadingHTTPServer
+
+from .cache import SQLiteCache
+from .exceptions import InvalidJobError
+from .log import Logger
+from .utils import chdir
+
+DEFAULT_WORKERS = 2
+POLL_INTERVAL = 1.0  # seconds
+SUPERVISE_INTERVAL = 5.0  # seconds
+MAX_UPLOAD_SIZE = 200 * 1024 * 1024
+UPLOAD_PREFIX = "upload_"
+
+# The core options that can be set per job, with their allowed values
+JOB_OPTIONS = {
+    "blank": [True, False],
+    "crop": ["none", "left", "center", "right"],
+    "experimental": [True, False],
+    "linearize": [True, False],
+    "remarkable_dir": str,
+}
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class JobQueue(SQLiteCache):
+    """Durable queue of jobs in an SQLite database
+
+    Jobs are claimed in an immediate transaction, so that every job is given
+    to one worker only, also when the workers run in separate processes.
+    """
+
+    filename = "jobs.sqlite"
+    schema = (
+        "CREATE TABLE IF NOT EXISTS jobs ("
+        "id INTEGER PRIMARY KEY AUTOINCREMENT, input TEXT, source TEXT, "
+        "filename TEXT, account TEXT, options TEXT, status TEXT, "
+        "attempts INTEGER, result TEXT, error TEXT, log TEXT, "
+        "created REAL, updated REAL)"
+    )
+    columns = [
+        "id",
+        "input",
+        "source",
+        "filename",
+        "account",
+        "options",
+        "status",
+        "attempts",
+        "result",
+        "error",
+        "log",
+        "created",
+        "updated",
+    ]
+
+    def submit(
+        self, cli_input, source=None, filename=None, account=None, options=None
+    ):
+        """Add a job to the queue and return its id"""
+        now = time.time()
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (input, source, filename, account, options, "
+                "status, attempts, created, updated) "
+                "VALUES (?, ?, ?, ?, ?, ?, 0, ?, ?)",
+                (
+                    cli_input,
+                    source,
+                    filename,
+                    account,
+                    json.dumps(options or {}),
+                    QUEUED,
+                    now,
+                    now,
+                ),
+            )
+            return cursor.lastrowid
+
+    def claim(self):
+        """Take the oldest queued job and mark it running, or return None"""
+        with self._connect() as conn:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT id FROM jobs WHERE status = ? ORDER BY id LIMIT 1",
+                (QUEUED,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = ?, attempts = attempts + 1, "
+                "updated = ? WHERE id = ?",
+                (RUNNING, time.time(), row[0]),
+            )
+            return self._get(conn, row[0])
+
+    def finish(self, job_id, result=None, log=None):
+        self._update(job_id, DONE, result=result, log=log)
+
+    def fail(self, job_id, error, log=None):
+        self._update(job_id, FAILED, error=error, log=log)
+
+    def retry(self, job_id):
+        """Queue a failed job again, returns False if it hasn't failed"""
+        with self._connect() as conn:
+            cursor = conn.execute(
+                "UPDATE jobs SET status = ?, error = NULL, updated = ? "
+                "WHERE id = ? AND status = ?",
+                (QUEUED, time.time(), job_id, FAILED),
+            )
+            return cursor.rowcount == 1
+
+    def recover(self):
+        """Queue the jobs again that were running when the service stopped"""
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, updated = ? WHERE status = ?",
+                (QUEUED, time.time(), RUNNING),
+            )
+
+    def get(self, job_id):
+        """Get the job as a dict, or None if it doesn't exist"""
+        with self._connect() as conn:
+            return self._get(conn, job_id)
+
+    def list(self, status=None):
+        query = "SELECT * FROM jobs"
+        params = ()
+        if status is not None:
+            query += " WHERE status = ?"
+            params = (status,)
+        with self._connect() as conn:
+            rows = conn.execute(query + " ORDER BY id", params).fetchall()
+        return [self._to_dict(row) for row in rows]
+
+    def _get(self, conn, job_id):
+        row = conn.execute(
+            "SELECT * FROM jobs WHERE id = ?", (job_id,)
+        ).fetchone()
+        return None if row is None else self._to_dict(row)
+
+    def _update(self, job_id, status, result=None, error=None, log=None):
+        with self._connect() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = ?, result = ?, error = ?, log = ?, "
+                "updated = ? WHERE id = ?",
+                (status, result, error, log, time.time(), job_id),
+            )
+
+    def _to_dict(self, row):
+        job = dict(zip(self.columns, row))
+        job["options"] = json.loads(job["options"])
+        return job
+
+
+def validate_job(data, accounts):
+    """Check the fields of a submitted job and return its options"""
+    if not isinstance(data.get("options", {}), dict):
+        raise InvalidJobError("Expected an object for the options")
+    options = {}
+    for key, value in data.get("options", {}).items():
+        if key not in JOB_OPTIONS:
+            raise InvalidJobError("Unknown option: %s" % key)
+        allowed = JOB_OPTIONS[key]
+        valid = (
+            isinstance(value, allowed) if allowed is str else value in allowed
+        )
+        if not valid:
+            raise InvalidJobError(
+                "Invalid value for option %s: %r" % (key, value)
+            )
+        options[key] = value
+
+    if ".." in options.get("remarkable_dir", "").split("/"):
+        raise InvalidJobError("Invalid remarkable_dir")
+
+    filename = data.get("filename")
+    if filename is not None and not is_valid_filename(filename):
+        raise InvalidJobError("Invalid filename: %r" % (filename,))
+
+    account = data.get("account")
+    if account is not None and account not in accounts:
+        raise InvalidJobError("Unknown account: %s" % account)
+    return options
+
+
+def is_valid_filename(filename):
+    """Whether the filename of a job is a plain name of a supported format
+
+    The output is written to this name, so anything that could point to
+    another directory is refused.
+    """
+    from .providers._base import Provider
+
+    return (
+        isinstance(filename, str)
+        and os.path.basename(filename) == filename
+        and "\0" not in filename
+        and filename not in (".", "..")
+        and filename.rsplit(".", 1)[-1] in Provider.SUPPORTED_FORMATS
+    )
+
+
+def upload_dir(queue_path):
+    """Directory in which the uploaded files of the queue are stored"""
+    return os.path.join(os.path.dirname(queue_path), "uploads")
+
+
+def remove_upload(job, queue_path):
+    """Remove the uploaded file of a job, if it has one"""
+    path = os.path.abspath(job["input"])
+    if job["source"] != "file" or not _is_upload(path, queue_path):
+        # a path on the server, submitted with allow_paths
+        return
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
+
+
+def _is_upload(path, queue_path):
+    return os.path.dirname(path) == upload_dir(queue_path) and (
+        os.path.basename(path).startswith(UPLOAD_PREFIX)
+    )
+
+
+def remove_orphan_uploads(queue):
+    """Remove uploaded files that no job that can still run refers to"""
+    directory = upload_dir(queue.path)
+    if not os.path.isdir(directory):
+        return
+    needed = {
+        os.path.abspath(job["input"])
+        for status in [QUEUED, RUNNING, FAILED]
+        for job in queue.list(status=status)
+    }
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if _is_upload(path, queue.path) and path not in needed:
+            os.unlink(path)
+
+
+def job_options(options, job, service):
+    """Options to run the job with, the service options and job overrides"""
+    opts = copy.deepcopy(options)
+    opts["core"].update(job["options"])
+    opts["core"]["source"] = job["source"]
+    # log everything, so it ends up in the job log
+    opts["core"]["verbose"] = True
+    if service.get("upload_dir"):
+        opts["core"]["upload"] = False
+        opts["core"]["usb_upload"] = False
+    return opts
+
+
+def run_job(job, options, service):
+    """Run a single job and return the result of Provider.run"""
+    # Imported here to avoid a circular import, as the ui imports this module
+    from .ui import choose_provider
+    from .ui import create_provider
+
+    opts = job_options(options, job, service)
+    account = job["account"]
+    if account is not None and not service.get("upload_dir"):
+        os.environ["RMAPI_CONFIG"] = service["accounts"][account]
+
+    target_dir = os.getcwd()
+    if service.get("upload_dir"):
+        parts = [service["upload_dir"], account or ""]
+        parts += opts["core"]["remarkable_dir"].strip("/").split("/")
+        target_dir = os.path.join(*parts)
+        os.makedirs(target_dir, exist_ok=True)
+
+    provider, new_input, cookiejar = choose_provider(
+        job["input"], job["source"]
+    )
+    prov = create_provider(provider, opts, cookiejar=cookiejar)
+    with chdir(target_dir):
+        return prov.run(new_input, filename=job["filename"])
+
+
+def worker(queue_path, options, service, stop, poll_interval=POLL_INTERVAL):
+    """Process jobs from the queue until the stop event is set"""
+    queue = JobQueue(queue_path)
+    environ = dict(os.environ)
+    while not stop.is_set():
+        try:
+            job = queue.claim()
+        except Exception:
+            _log_error("Failed to claim a job")
+            stop.wait(poll_interval)
+            continue
+        if job is None:
+            stop.wait(poll_interval)
+            continue
+
+        log = io.StringIO()
+        with redirect_stdout(log), redirect_stderr(log):
+            # providers disable the shared logger for non-verbose jobs
+            Logger().enable()
+            try:
+                result = run_job(job, options, service)
+            except Exception:
+                error = traceback.format_exc()
+            else:
+                error = None
+        os.environ.clear()
+        os.environ.update(environ)
+
+        try:
+            if error is None:
+                queue.finish(job["id"], result=result, log=log.getvalue())
+                remove_upload(job, queue_path)
+            else:
+                queue.fail(job["id"], error, log=log.getvalue())
+        except Exception:
+            _log_error("Failed to record the result of job %i" % job["id"])
+
+
+def _log_error(msg):
+    print("%s\n%s" % (msg, traceback.format_exc()), file=sys.stderr)
+
+
+def _supervise(workers, start_worker, stop, interval=SUPERVISE_INTERVAL):
+    """Restart the worker processes that stopped, until stop is set"""
+    while not stop.wait(interval):
+        for i, proc in enumerate(workers):
+            if not proc.is_alive():
+                print(
+                    "Worker stopped with exit code %s, restarting it"
+                    % proc.exitcode,
+                    file=sys.stderr,
+                )
+                workers[i] = start_worker()
+
+
+class JobHandler(BaseHTTPRequestHandler):
+    """Handler for the requests to the job API"""
+
+    server_version = "paper2remarkable"
+
+    def do_GET(self):
+        parts, query = self._parse_path()
+        queue = self.server.queue
+        if parts == ["jobs"]:
+            status = query.get("status", [None])[0]
+            return self._send(HTTPStatus.OK, queue.list(status=status))
+        if len(parts) == 2 and parts[0] == "jobs" and parts[1].isdigit():
+            job = queue.get(int(parts[1]))
+            if job is None:
+                return self._error(HTTPStatus.NOT_FOUND, "No such job")
+            return self._send(HTTPStatus.OK, job)
+        return self._error(HTTPStatus.NOT_FOUND, "Not found")
+
+    def do_POST(self):
+        parts, query = self._parse_path()
+        queue = self.server.queue
+        if parts == ["jobs"]:
+            try:
+                job_id = self._submit(query)
+            except InvalidJobError as err:
+                return self._error(HTTPStatus.BAD_REQUEST, err.reason)
+            return self._send(HTTPStatus.CREATED, queue.get(job_id))
+        if (
+            len(parts) == 3
+            and parts[0] == "jobs"
+            and parts[1].isdigit()
+            and parts[2] == "retry"
+        ):
+            job_id = int(parts[1])
+            if queue.get(job_id) is None:
+                return self._error(HTTPStatus.NOT_FOUND, "No such job")
+            if not queue.retry(job_id):
+                return self._error(
+                    HTTPStatus.CONFLICT, "Only failed jobs can be retried"
+                )
+            return self._send(HTTPStatus.OK, queue.get(job_id))
+        return self._error(HTTPStatus.NOT_FOUND, "Not found")
+
+    def _submit(self, query):
+        length = int(self.headers.get("Content-Length", 0))
+        if length > MAX_UPLOAD_SIZE:
+            raise InvalidJobError("Request body too large")
+        body = self.rfile.read(length)
+        content_type = self.headers.get("Content-Type", "").split(";")[0]
+
+        if content_type == "application/pdf":
+            if not body.startswith(b"%PDF"):
+                raise InvalidJobError("Uploaded file is not a PDF file")
+            data = {k: v[0] for k, v in query.items()}
+            data["options"] = {}
+            for key in list(data):
+                if key in JOB_OPTIONS:
+                    value = data.pop(key)
+                    if value in ("true", "false"):
+                        value = value == "true"
+                    data["options"][key] = value
+            options = validate_job(data, self.server.accounts)
+            cli_input = self.server.store_upload(body)
+            source = "file"
+            filename = data.get("filename")
+        elif content_type == "application/json":
+            try:
+                data = json.loads(body)
+            except ValueError:
+                raise InvalidJobError("Invalid JSON")
+            if not isinstance(data, dict):
+                raise InvalidJobError("Expected a JSON object")
+            options = validate_job(data, self.server.accounts)
+            if "url" in data:
+                cli_input, source = data["url"], "url"
+            elif "path" in data and self.server.allow_paths:
+                cli_input, source = data["path"], "file"
+            else:
+                raise InvalidJobError("Missing url of the paper")
+            filename = data.get("filename")
+        else:
+            raise InvalidJobError(
+                "Unsupported content type: %s" % content_type
+            )
+
+        return self.server.queue.submit(
+            cli_input,
+            source=source,
+            filename=filename,
+            account=data.get("account"),
+            options=options,
+        )
+
+    def _parse_path(self):
+        parsed = urllib.parse.urlparse(self.path)
+        parts = [p for p in parsed.path.split("/") if p]
+        return parts, urllib.parse.parse_qs(parsed.query)
+
+    def _send(self, status, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _error(self, status, message):
+        self._send(status, {"error": message})
+
+    def log_message(self, format, *args):
+        Logger().info(format % args)
+
+
+class JobServer(ThreadingHTTPServer):
+    """HTTP server for the job API"""
+
+    def __init__(self, address, queue, accounts=None, allow_paths=False):
+        super().__init__(address, JobHandler)
+        self.queue = queue
+        self.accounts = accounts or {}
+        self.allow_paths = allow_paths
+        self.upload_dir = upload_dir(queue.path)
+        os.makedirs(self.upload_dir, exist_ok=True)
+
+    def store_upload(self, body):
+        """Store an uploaded file and return its path"""
+        fd, path = tempfile.mkstemp(
+            suffix=".pdf", prefix=UPLOAD_PREFIX, dir=self.upload_dir
+        )
+        with os.fdopen(fd, "wb") as fp:
+            fp.write(body)
+        return path
+
+
+def serve(address, options):
+    """Run the service until it is interrupted
+
+    The address is a (host, port) tuple, and options are the merged options
+    of the command line and the configuration file. Settings of the service
+    itself are in ``options["service"]``.
+    """
+    service = options.get("service", {})
+    queue = JobQueue(service.get("queue"))
+    queue.recover()
+    remove_orphan_uploads(queue)
+
+    stop = multiprocessing.Event()
+
+    def start_worker():
+        proc = multiprocessing.Process(
+            target=worker, args=(queue.path, options, service, stop)
+        )
+        proc.start()
+        return proc
+
+    workers = [
+        start_worker() for _ in range(service.get("workers", DEFAULT_WORKERS))
+    ]
+    supervisor = threading.Thread(
+        target=_supervise, args=(workers, start_worker, stop), daemon=True
+    )
+    supervisor.start()
+
+    server = JobServer(
+        address,
+        queue,
+        accounts=service.get("accounts"),
+        allow_paths=service.get("allow_paths", False),
+    )
+    print("p2r service listening on http://%s:%i" % server.server_address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        supervisor.join()
+        for proc in workers:
+            proc.join()
+        server.server_close()
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+"""Discovery of the external programs used by paper2remarkable
+
+Programs such as gs, pdftk, qpdf, pdftoppm, and rmapi are probed once per
+process and the result is shared by all providers and croppers. The results
+can also be persisted between runs in a cache file. Entries are keyed by the
+resolved path and the modification time of the executable, so that
+installing a different version triggers a new probe. The versions of the
+programs that were used are reported in verbose output.
+
+"""
+
+import collections
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+
+from .log import Logger
+
+logger = Logger()
+
+# Arguments that make a program print its version and exit successfully. The
+# programs not listed here are only checked for existence.
+VERSION_ARGS = {
+    "gs": ["--version"],
+    "pdftk": ["--version"],
+    "pdftoppm": ["-v"],
+    "qpdf": ["--version"],
+}
+
+Tool = collections.namedtuple("Tool", ["name", "path", "version"])
+
+
+class ToolRegistry:
+    """Registry of the external programs that have been probed"""
+
+    def __init__(self, cache_file=None):
+        self.cache_file = cache_file
+        self._tools = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def find(self, name, path=None):
+        """Find the program with the given name
+
+        The path can be a command on the PATH or the path to an executable.
+        Returns a :class:`Tool` or None if the program isn't available.
+        """
+        if not path:
+            return None
+        resolved = shutil.which(path)
+        if resolved is None:
+            return None
+        resolved = os.path.realpath(resolved)
+        key = "%s|%s|%s" % (name, resolved, os.stat(resolved).st_mtime)
+
+        with self._lock:
+            self._load()
+            if key in self._tools:
+                return self._tools[key]
+
+        tool = self._probe(name, resolved)
+        with self._lock:
+            self._tools[key] = tool
+            self._save()
+        return tool
+
+    def versions(self):
+        """Dict with the version of every program that was found"""
+        with self._lock:
+            return {t.name: t.version for t in self._tools.values() if t}
+
+    def _probe(self, name, path):
+        if name not in VERSION_ARGS:
+            return Tool(name, path, None)
+        try:
+            proc = subprocess.run(
+                [path] + VERSION_ARGS[name],
+                stdout=subprocess.PIPE,
+                stderr=subprocess.STDOUT,
+                timeout=60,
+            )
+        except (OSError, subprocess.SubprocessError):
+            return None
+        if not proc.returncode == 0:
+            return None
+        output = proc.stdout.decode(errors="replace").strip()
+        version = output.splitlines()[0].strip() if output else None
+        logger.info("Found %s (%s) at %s" % (name, version, path))
+        return Tool(name, path, version)
+
+    def _load(self):
+        if self._loaded:
+            return
+        self._loaded = True
+        if not self.cache_file or not os.path.exists(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, "r") as fp:
+                data = json.load(fp)
+        except (OSError, ValueError):
+            return
+        for key, value in data.items():
+            self._tools.setdefault(key, Tool(*value) if value else None)
+
+    def _save(self):
+        # The cache file is only an optimization, so failing to write it
+        # isn't an error. Every process writes its own temporary file, as
+        # several processes may share the cache file.
+        if not self.cache_file:
+            return
+        data = {k: list(t) if t else None for k, t in self._tools.items()}
+        tmp_file = None
+        try:
+            fd, tmp_file = tempfile.mkstemp(
+                prefix="tools_", dir=os.path.dirname(self.cache_file)
+            )
+            with os.fdopen(fd, "w") as fp:
+                json.dump(data, fp)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as err:
+            logger.warning("Failed to save the tool cache: %s" % err)
+            if tmp_file is not None and os.path.exists(tmp_file):
+                os.unlink(tmp_file)
+
+
+# The registry shared within the process
+registry = ToolRegistry()
+
+
+def find_tool(name, path=None):
+    """Find a program using the shared registry"""
+    return registry.find(name, path)
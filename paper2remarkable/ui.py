@@ -18,11 +18,25 @@ import yaml
 
 from . import GITHUB_URL
 from . import __version__
+from . import tools
+from .batch import BatchState
+from .batch import options_key
+from .cache import DEFAULT_METADATA_TTL
+from .cache import RedirectCache
+from .cache import UploadHistory
+from .cache import cache_dir
 from .exceptions import InvalidURLError
 from .exceptions import UnidentifiedSourceError
-from .providers import LocalFile
-from .providers import providers
+from .ghostscript import BACKENDS
+from .ghostscript import DEFAULT_BACKEND
+from .ghostscript import DEFAULT_SHRINK_THRESHOLD
+from .ghostscript import SHRINK_PROFILES
+from .log import Logger
+from .providers import iter_providers
 from .utils import follow_redirects
+from .utils import resolve_redirects
+
+logger = Logger()
 
 
 def build_argument_parser():
@@ -95,6 +109,27 @@ def build_argument_parser():
         help="upload through usb instead of rmapi",
         action="store_true",
     )
+    parser.add_argument(
+        "--refresh-metadata",
+        help="don't use cached paper information, retrieve it again",
+        action="store_true",
+    )
+    parser.add_argument(
+        "--force",
+        help=(
+            "upload papers that were uploaded before with the same options, "
+            "instead of skipping them"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--resume",
+        help=(
+            "resume an interrupted run with the same inputs and options, "
+            "skipping the inputs that were completed"
+        ),
+        action="store_true",
+    )
     parser.add_argument(
         "--gs", help="path to gs executable (default: gs)", default=None
     )
@@ -141,17 +176,47 @@ def build_argument_parser():
             "this does not guarantee successful processing."
         ),
     )
+    parser.add_argument(
+        "--daemon",
+        help=(
+            "Run as a daemon that keeps dependencies loaded and processes "
+            "the commands of later p2r invocations"
+        ),
+        action="store_true",
+    )
+    parser.add_argument(
+        "--watch",
+        metavar="DIR",
+        help=(
+            "Watch a directory and process the PDF files that are added to "
+            "it, see the watch section of the configuration file"
+        ),
+        default=None,
+    )
+    parser.add_argument(
+        "--serve",
+        metavar="[HOST:]PORT",
+        help=(
+            "Run the HTTP service that accepts jobs from multiple users, see "
+            "the service section of the configuration file. The service has "
+            "no authentication and listens on localhost unless HOST is given"
+        ),
+        default=None,
+    )
     parser.add_argument(
         "input",
         help="One or more URLs to a paper or paths to local PDF files",
-        nargs="+",
+        nargs="*",
     )
     return parser
 
 
-def parse_args():
+def parse_args(argv=None):
     parser = build_argument_parser()
-    return parser.parse_args()
+    args = parser.parse_args(argv)
+    if not args.input and not (args.daemon or args.serve or args.watch):
+        parser.error("the following arguments are required: input")
+    return args
 
 
 def exception(msg):
@@ -167,7 +232,26 @@ def exception(msg):
     raise SystemExit(1)
 
 
-def choose_provider(cli_input, source_type=None):
+def get_source_type(cli_input, source_type=None):
+    """Determine whether the input is a local file or a url
+
+    Returns "file" or "url", or None if the input is neither. If source_type
+    is specified it overrides the automatic detection.
+    """
+    from .providers import LocalFile
+
+    if source_type is not None:
+        return source_type if source_type in ("file", "url") else None
+    if LocalFile.validate(cli_input):
+        return "file"
+    if validators.url(cli_input):
+        return "url"
+    return None
+
+
+def choose_provider(
+    cli_input, source_type=None, redirect_cache=None, redirects=None
+):
     """Choose the provider to use for the given source
 
     This function determines the appropriate provider based on the input and the
@@ -184,6 +268,12 @@ def choose_provider(cli_input, source_type=None):
     source_type : str, optional
         The type of the source, either "file" or "url". If provided, it overrides
         the automatic detection.
+    redirect_cache : RedirectCache, optional
+        Cache used when following the redirects of a url.
+    redirects : dict, optional
+        Results of :func:`resolve_redirects` for urls that were resolved
+        beforehand, for instance for a batch of inputs. An exception in the
+        results is raised for its url.
 
     Returns
     -------
@@ -209,19 +299,27 @@ def choose_provider(cli_input, source_type=None):
         Raised when the input *is* a valid url (or source_type is "url"), but no
         provider can handle it.
     """
+    from .providers import LocalFile
+
     provider = cookiejar = None
-    if source_type == "file" or (
-        source_type is None and LocalFile.validate(cli_input)
-    ):
+    kind = get_source_type(cli_input, source_type)
+    if kind == "file":
         # input is a local file or user specified source type is file
         new_input = cli_input
         provider = LocalFile
-    elif source_type == "url" or (
-        source_type is None and validators.url(cli_input)
-    ):
+    elif kind == "url":
         # input is a url or user specified source type is url
-        new_input, cookiejar = follow_redirects(cli_input)
-        provider = next((p for p in providers if p.validate(new_input)), None)
+        if redirects and cli_input in redirects:
+            if isinstance(redirects[cli_input], Exception):
+                raise redirects[cli_input]
+            new_input, cookiejar = redirects[cli_input]
+        else:
+            new_input, cookiejar = follow_redirects(
+                cli_input, cache=redirect_cache
+            )
+        provider = next(
+            (p for p in iter_providers() if p.validate(new_input)), None
+        )
     else:
         # not a proper URL or non-existent file
         raise UnidentifiedSourceError
@@ -250,6 +348,7 @@ def merge_options(args, config=None):
     opts.setdefault("core", {})
     opts.setdefault("system", {})
     opts.setdefault("html", {})
+    opts.setdefault("service", {})
 
     def set_bool(d, key, value, invert=False):
         if value:
@@ -268,6 +367,9 @@ def merge_options(args, config=None):
     set_bool(opts["core"], "upload", args.no_upload, invert=True)
     set_bool(opts["core"], "experimental", args.experimental)
     set_bool(opts["core"], "usb_upload", args.usb_upload)
+    set_bool(opts["core"], "refresh_metadata", args.refresh_metadata)
+    opts["core"].setdefault("metadata_ttl", DEFAULT_METADATA_TTL)
+    opts["core"].setdefault("shrink_profile", "printer")
 
     if args.center:
         opts["core"]["crop"] = "center"
@@ -318,38 +420,158 @@ def set_excepthook(debug):
     sys.excepthook = exception_handler
 
 
-def runner(inputs, filenames, options, debug=False):
+def create_provider(provider, options, cookiejar=None, debug=False):
+    """Create an instance of the provider class with the merged options"""
+    return provider(
+        verbose=options["core"]["verbose"],
+        upload=options["core"]["upload"],
+        debug=debug,
+        experimental=options["core"]["experimental"],
+        crop=options["core"]["crop"],
+        blank=options["core"]["blank"],
+        linearize=options["core"].get("linearize", False),
+        remarkable_dir=options["core"]["remarkable_dir"],
+        usb_upload=options["core"]["usb_upload"],
+        rmapi_path=options["system"]["rmapi"],
+        pdftoppm_path=options["system"]["pdftoppm"],
+        pdftk_path=options["system"]["pdftk"],
+        qpdf_path=options["system"]["qpdf"],
+        gs_path=options["system"]["gs"],
+        gs_threads=int(options["system"].get("gs_threads", 0)),
+        gs_tuned=options["system"].get("gs_tuned", False),
+        gs_backend=options["system"].get("gs_backend", DEFAULT_BACKEND),
+        gs_shards=int(options["system"].get("gs_shards", 0)),
+        shrink_profile=options["core"].get("shrink_profile", "printer"),
+        shrink_threshold=float(
+            options["core"].get("shrink_threshold", DEFAULT_SHRINK_THRESHOLD)
+        ),
+        css=options["html"]["css"],
+        font_urls=options["html"]["font_urls"],
+        cookiejar=cookiejar,
+        metadata_ttl=options["core"].get("metadata_ttl", DEFAULT_METADATA_TTL),
+        refresh_metadata=options["core"].get("refresh_metadata", False),
+    )
+
+
+def upload_target(options):
+    """Description of the location that files are uploaded to"""
+    if options["core"].get("usb_upload", False):
+        device = "usb"
+    else:
+        device = "rmapi:" + os.environ.get("RMAPI_CONFIG", "")
+    return "%s:%s" % (device, options["core"]["remarkable_dir"])
+
+
+def runner(inputs, filenames, options, debug=False, resume=False, force=False):
     if not len(inputs) == len(filenames):
         raise ValueError("Number of inputs and filenames must be the same")
-    for cli_input, filename in zip(inputs, filenames):
+    source_type = options["core"].get("source")
+
+    # Results of probing the external programs are kept between runs
+    tools.registry.cache_file = os.path.join(cache_dir(), "tools.json")
+
+    if not options["core"].get("verbose", False):
+        logger.disable()
+
+    # The progress of a batch is recorded so an interrupted run can be
+    # resumed
+    batch = None
+    if len(inputs) > 1 or resume:
+        batch = BatchState.open(inputs, filenames, options, resume=resume)
+    todo = [
+        (batch.item(i) if batch else None, cli_input, filename)
+        for i, (cli_input, filename) in enumerate(zip(inputs, filenames))
+    ]
+    for item, cli_input, _ in todo:
+        if item and item.done("uploaded"):
+            logger.info("Skipping %s, completed in an earlier run" % cli_input)
+    todo = [t for t in todo if not (t[0] and t[0].done("uploaded"))]
+
+    # Resolve the redirects of all urls up front, as this can be done
+    # concurrently.
+    redirect_cache = RedirectCache()
+    urls = [i for _, i, _ in todo if get_source_type(i, source_type) == "url"]
+    redirects = None
+    if len(urls) > 1:
+        redirects = resolve_redirects(urls, cache=redirect_cache)
+
+    # Papers are recognized by their identity, so duplicates in the batch
+    # and papers that were uploaded before are skipped.
+    history = None
+    if options["core"].get("upload", False) and not debug:
+        history = UploadHistory()
+        target = upload_target(options)
+        key = options_key(options)
+    seen = {}
+
+    for item, cli_input, filename in todo:
         provider, new_input, cookiejar = choose_provider(
-            cli_input, options["core"].get("source")
+            cli_input,
+            source_type,
+            redirect_cache=redirect_cache,
+            redirects=redirects,
         )
-        prov = provider(
-            verbose=options["core"]["verbose"],
-            upload=options["core"]["upload"],
-            debug=debug,
-            experimental=options["core"]["experimental"],
-            crop=options["core"]["crop"],
-            blank=options["core"]["blank"],
-            remarkable_dir=options["core"]["remarkable_dir"],
-            usb_upload=options["core"]["usb_upload"],
-            rmapi_path=options["system"]["rmapi"],
-            pdftoppm_path=options["system"]["pdftoppm"],
-            pdftk_path=options["system"]["pdftk"],
-            qpdf_path=options["system"]["qpdf"],
-            gs_path=options["system"]["gs"],
-            css=options["html"]["css"],
-            font_urls=options["html"]["font_urls"],
-            cookiejar=cookiejar,
+        identity = provider.get_identity(new_input)
+        if (identity, filename) in seen:
+            logger.info(
+                "Skipping %s, same paper as %s"
+                % (cli_input, seen[(identity, filename)])
+            )
+            continue
+        seen[(identity, filename)] = cli_input
+
+        previous = history.get(identity, target, key) if history else None
+        if previous and not force:
+            logger.info(
+                "Skipping %s, already uploaded as %s (use --force to upload "
+                "it again)" % (cli_input, previous)
+            )
+            continue
+
+        prov = create_provider(
+            provider, options, cookiejar=cookiejar, debug=debug
         )
-        prov.run(new_input, filename=filename)
+        prov.run(new_input, filename=filename, state=item)
+        if history:
+            history.put(identity, target, key, cli_input)
+
+    versions = tools.registry.versions()
+    if versions:
+        used = [
+            "%s (%s)" % (name, version or "unknown version")
+            for name, version in sorted(versions.items())
+        ]
+        logger.info("Programs used: " + ", ".join(used))
+
+    if batch:
+        batch.remove()
 
 
 def main():
     args = parse_args()
     set_excepthook(args.debug)
 
+    if args.daemon:
+        from .daemon import serve
+
+        try:
+            serve(execute)
+        except OSError as err:
+            exception(str(err))
+        return
+
+    execute(args)
+
+
+def parse_address(address):
+    """Parse an address of the form [HOST:]PORT"""
+    host, _, port = address.rpartition(":")
+    if not port.isdigit():
+        exception("Invalid address for the service: %s" % address)
+    return host or "127.0.0.1", int(port)
+
+
+def execute(args):
     if args.center and args.right:
         exception("Can't center and right align at the same time!")
 
@@ -367,8 +589,41 @@ def main():
     config = load_config(path=args.config)
     options = merge_options(args, config=config)
 
+    if options["core"]["shrink_profile"] not in SHRINK_PROFILES:
+        exception(
+            "Unknown shrink_profile '%s', must be one of: %s"
+            % (options["core"]["shrink_profile"], ", ".join(SHRINK_PROFILES))
+        )
+    gs_backend = options["system"].get("gs_backend", DEFAULT_BACKEND)
+    if gs_backend not in BACKENDS:
+        exception(
+            "Unknown gs_backend '%s', must be one of: %s"
+            % (gs_backend, ", ".join(BACKENDS))
+        )
+
+    if args.serve:
+        from .service import serve
+
+        serve(parse_address(args.serve), options)
+        return
+
+    if args.watch:
+        from .watch import watch
+
+        if not os.path.isdir(args.watch):
+            exception("Directory to watch doesn't exist: %s" % args.watch)
+        watch(args.watch, options)
+        return
+
     filenames = (
         [None] * len(args.input) if not args.filename else args.filename
     )
 
-    runner(args.input, filenames, options, debug=args.debug)
+    runner(
+        args.input,
+        filenames,
+        options,
+        debug=args.debug,
+        resume=args.resume,
+        force=args.force,
+    )
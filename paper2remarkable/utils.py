@@ -8,22 +8,26 @@ Copyright: 2019, G.J.J. van den Burg
 
 """
 
+import concurrent.futures
+import contextvars
+import hashlib
+import html.parser
 import os
+import re
 import string
 import subprocess
+import threading
 import time
 
 import requests
 import unidecode
 
-from pikepdf import Pdf
-from pikepdf import PdfError
-
 from .exceptions import BlockedByCloudFlareError
-from .exceptions import FileTypeError
+from .exceptions import DownloadError
 from .exceptions import NoPDFToolError
 from .exceptions import RemarkableError
 from .log import Logger
+from .tools import find_tool
 
 HEADERS = {
     "User-Agent": "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_10_1) "
@@ -31,8 +35,18 @@ HEADERS = {
     "Safari/537.36"
 }
 
+HTTP_PARTIAL_CONTENT = 206
+HTTP_RANGE_NOT_SATISFIABLE = 416
 HTTP_SERVICE_UNAVAILABLE = 503
 
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+HEAD_CHUNK_SIZE = 64 * 1024
+HEAD_READ_SIZE = 16 * 1024
+HEAD_END_REGEX = re.compile(rb"</head\s*>|<body[\s>]", re.IGNORECASE)
+CHARSET_REGEX = re.compile(rb"<meta[^>]+charset=[\"']?([\w-]+)", re.IGNORECASE)
+HEADER_CHARSET_REGEX = re.compile(r"charset=[\"']?([\w-]+)", re.IGNORECASE)
+
 REMARKABLE_USB_URL = "http://10.11.99.1"
 
 logger = Logger()
@@ -51,29 +65,437 @@ def clean_string(s):
     return cleaned
 
 
-def assert_file_is_pdf(filename):
-    """Assert that a given file is a PDF file.
+def file_hash(filename):
+    """SHA-256 hash of the contents of a file"""
+    sha = hashlib.sha256()
+    with open(filename, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1024 * 1024), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def _wait_retry(cancel, seconds=5):
+    """Wait before the next attempt, or until the cancel event is set"""
+    if cancel is None:
+        time.sleep(seconds)
+    else:
+        cancel.wait(seconds)
+
+
+def download_url(url, filename, tries=5, cookiejar=None, cancel=None):
+    """Download the content of an url and save it to a filename
+
+    The data is streamed to a partial file next to the target. When the
+    transfer fails midway the partial file is kept, and the next attempt asks
+    the server for the remaining bytes only. The range request is made
+    conditional on the ETag or Last-Modified header of the first response, so
+    a server that doesn't support ranges or a file that changed in between
+    results in a full download instead.
 
-    This is done by trying to open it using pikepdf.
+    When the cancel event is set the download stops early, the partial file
+    is removed, and the file at filename isn't created.
     """
+    logger.info("Downloading file at url: %s" % url)
+    jar = {} if cookiejar is None else cookiejar
+    partial = filename + ".part"
+    if os.path.exists(partial):
+        os.unlink(partial)
+
+    msg = "(%i/%i) Error downloading url %s. Retrying in 5 seconds."
+    count = 0
+    validator = None
+    while count < tries:
+        if cancel is not None and cancel.is_set():
+            break
+        count += 1
+        offset = os.path.getsize(partial) if os.path.exists(partial) else 0
+        headers = dict(HEADERS)
+        ranged = bool(offset and validator)
+        if ranged:
+            headers["Range"] = "bytes=%i-" % offset
+            headers["If-Range"] = validator
+
+        res = None
+        try:
+            res = requests.get(url, headers=headers, cookies=jar, stream=True)
+        except requests.exceptions.ConnectionError:
+            pass
+
+        if (
+            res is not None
+            and res.status_code == HTTP_SERVICE_UNAVAILABLE
+            and res.headers.get("server", "") == "cloudflare"
+        ):
+            raise BlockedByCloudFlareError(url)
+
+        if ranged and res is not None and not _is_resumed(res, offset):
+            # The partial file can't be resumed with this response, start
+            # over right away with a plain request
+            res.close()
+            os.unlink(partial)
+            validator = None
+            count -= 1
+            continue
+
+        if res is None or not res.ok:
+            if res is not None:
+                res.close()
+            logger.warning(msg % (count, tries, url))
+            _wait_retry(cancel)
+            continue
+
+        if not ranged and res.status_code == HTTP_PARTIAL_CONTENT:
+            # Part of the file that wasn't asked for, can't be used
+            res.close()
+            logger.warning(msg % (count, tries, url))
+            _wait_retry(cancel)
+            continue
+
+        resume = ranged and res.status_code == HTTP_PARTIAL_CONTENT
+        if resume:
+            logger.info("Resuming download at byte %i" % offset)
+        validator = _range_validator(res)
+
+        try:
+            with open(partial, "ab" if resume else "wb") as fid:
+                for chunk in res.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                    if cancel is not None and cancel.is_set():
+                        break
+                    fid.write(chunk)
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+        ):
+            logger.warning(msg % (count, tries, url))
+            _wait_retry(cancel)
+            continue
+        finally:
+            res.close()
+
+        if cancel is not None and cancel.is_set():
+            break
+
+        os.replace(partial, filename)
+        logger.info("Downloaded url: %s" % url)
+        return
+
+    if cancel is not None and cancel.is_set():
+        logger.info("Download cancelled: %s" % url)
+        if os.path.exists(partial):
+            os.unlink(partial)
+        return
+    raise DownloadError(url, tries)
+
+
+def _range_validator(res):
+    """Get the validator to use in the If-Range header of a resumed request"""
+    if res.headers.get("Accept-Ranges", "bytes").lower() == "none":
+        return None
+    etag = res.headers.get("ETag")
+    # Weak ETags can't be used for range requests
+    if etag and not etag.startswith("W/"):
+        return etag
+    return res.headers.get("Last-Modified")
+
+
+def _is_resumed(res, offset):
+    """Whether the response to a range request can be used
+
+    That is either the remainder of the file starting at the offset, or the
+    whole file when the server ignored the range or the file has changed.
+    """
+    if res.status_code == HTTP_PARTIAL_CONTENT:
+        return _range_start(res) == offset
+    return res.status_code != HTTP_RANGE_NOT_SATISFIABLE
+
+
+def _range_start(res):
+    """Get the first byte position from the Content-Range header"""
+    content_range = res.headers.get("Content-Range", "")
     try:
-        pdf = Pdf.open(filename)
-        pdf.close()
-        del pdf
-        return True
-    except PdfError:
-        raise FileTypeError(filename, "pdf")
+        return int(content_range.split(" ")[1].split("-")[0])
+    except (IndexError, ValueError):
+        return None
 
 
-def download_url(url, filename, cookiejar=None):
-    """Download the content of an url and save it to a filename"""
-    logger.info("Downloading file at url: %s" % url)
-    content = get_page_with_retry(url, cookiejar=cookiejar)
-    with open(filename, "wb") as fid:
-        fid.write(content)
+# The page memo of the current run, see page_memo
+_PAGE_MEMO = contextvars.ContextVar("page_memo", default=None)
+
+
+class page_memo:
+    """Reuse pages retrieved while the context is active
+
+    Within the context, get_page_with_retry and get_soup_with_retry return the
+    response of an earlier request for the same url and cookies instead of
+    retrieving (and parsing) the page again. This is used to ensure that a
+    page that is needed by both the provider and the informer is only
+    downloaded once per run. Nested contexts share the outer memo.
+
+    Every context owns its memo, and it is only active in the thread (or
+    task) that entered it. Runs in other threads therefore don't share pages,
+    and callers mustn't modify the pages and soups they get.
+    """
 
+    def __init__(self):
+        self._pages = {}
+        self._soups = {}
+        self._lock = threading.Lock()
+        self._token = None
 
-def get_page_with_retry(url, tries=5, cookiejar=None, return_text=False):
+    def __enter__(self):
+        if _PAGE_MEMO.get() is None:
+            self._token = _PAGE_MEMO.set(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._token is not None:
+            _PAGE_MEMO.reset(self._token)
+            self._token = None
+
+    @staticmethod
+    def get(kind, key):
+        memo = _PAGE_MEMO.get()
+        if memo is None:
+            return None
+        with memo._lock:
+            table = memo._pages if kind == "page" else memo._soups
+            return table.get(key)
+
+    @staticmethod
+    def put(kind, key, value):
+        memo = _PAGE_MEMO.get()
+        if memo is None:
+            return
+        with memo._lock:
+            table = memo._pages if kind == "page" else memo._soups
+            table[key] = value
+
+
+def _memo_key(url, cookiejar):
+    """Key for the page memo, based on the url and the cookies sent"""
+    if cookiejar is None:
+        cookies = ()
+    elif isinstance(cookiejar, requests.cookies.RequestsCookieJar):
+        cookies = tuple(sorted(cookiejar.get_dict().items()))
+    else:
+        cookies = tuple(sorted(cookiejar.items()))
+    return (url, cookies)
+
+
+def get_soup_with_retry(url, tries=5, cookiejar=None, parser="html.parser"):
+    """Retrieve a page and parse it with BeautifulSoup
+
+    The parsed page is shared between callers while a page_memo is active, so
+    callers must not modify it.
+    """
+    import bs4
+
+    key = _memo_key(url, cookiejar) + (parser,)
+    soup = page_memo.get("soup", key)
+    if soup is None:
+        page = get_page_with_retry(url, tries=tries, cookiejar=cookiejar)
+        soup = bs4.BeautifulSoup(page, parser)
+        page_memo.put("soup", key, soup)
+    return soup
+
+
+class _HeadParser(html.parser.HTMLParser):
+    """Collect the meta tags and title of a document, until the body"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.metas = []
+        self.title = []
+        self.done = False
+        self._in_title = False
+
+    def handle_starttag(self, tag, attrs):
+        if self.done:
+            return
+        if tag == "meta":
+            self.metas.append({k: v or "" for k, v in attrs})
+        elif tag == "title":
+            self._in_title = True
+        elif tag == "body":
+            self.done = True
+
+    def handle_endtag(self, tag):
+        if tag == "title":
+            self._in_title = False
+        elif tag == "head":
+            self.done = True
+
+    def handle_data(self, data):
+        if self._in_title:
+            self.title.append(data)
+
+
+class HeadMeta:
+    """The meta tags in the head of an HTML document
+
+    The tags are indexed on all their attributes in a single pass. This
+    supports the subset of the BeautifulSoup interface that the informers use
+    for meta tags: ``find`` and ``find_all`` return dicts of the attributes,
+    which are copies so that the parsed head can be shared.
+    """
+
+    def __init__(self, metas, title=""):
+        self.metas = metas
+        self.title = title
+        self._index = {}
+        for meta in metas:
+            for item in meta.items():
+                self._index.setdefault(item, []).append(meta)
+
+    def find_all(self, name, attrs=None):
+        if not name == "meta":
+            raise ValueError("Only meta tags are available in HeadMeta")
+        attrs = list((attrs or {}).items())
+        if not attrs:
+            return [dict(meta) for meta in self.metas]
+        first, rest = attrs[0], attrs[1:]
+        return [
+            dict(meta)
+            for meta in self._index.get(first, [])
+            if all(meta.get(k) == v for k, v in rest)
+        ]
+
+    def find(self, name, attrs=None):
+        found = self.find_all(name, attrs)
+        return found[0] if found else None
+
+
+def parse_head(content, charset=None):
+    """Parse the head of an HTML document given as bytes into a HeadMeta
+
+    Only the part of the document before the end of the head is decoded and
+    parsed, the body can be large and isn't needed for the meta tags. The
+    charset from the Content-Type header, if given, takes precedence over
+    the one in the meta tags, and utf-8 is used if neither is available.
+    """
+    m = HEAD_END_REGEX.search(content)
+    head = content[: m.end()] if m else content
+    encoding = charset
+    if encoding is None:
+        m = CHARSET_REGEX.search(head)
+        encoding = m.group(1).decode("ascii") if m else "utf-8"
+    try:
+        text = head.decode(encoding, errors="replace")
+    except LookupError:
+        text = head.decode("utf-8", errors="replace")
+
+    parser = _HeadParser()
+    for start in range(0, len(text), HEAD_CHUNK_SIZE):
+        parser.feed(text[start : start + HEAD_CHUNK_SIZE])
+        if parser.done:
+            break
+    return HeadMeta(parser.metas, title="".join(parser.title).strip())
+
+
+def get_head_with_retry(url, tries=5, cookiejar=None):
+    """Retrieve a page and parse the meta tags in its head
+
+    This is a faster alternative to get_soup_with_retry for callers that only
+    need the meta tags. The result is shared while a page_memo is active.
+    """
+    key = _memo_key(url, cookiejar) + ("head",)
+    head = page_memo.get("soup", key)
+    if head is None:
+        page, charset = _get_head(url, tries=tries, cookiejar=cookiejar)
+        head = parse_head(page, charset=charset)
+        page_memo.put("soup", key, head)
+    return head
+
+
+def _header_charset(res):
+    """Charset given in the Content-Type header of a response, or None"""
+    m = HEADER_CHARSET_REGEX.search(res.headers.get("content-type", ""))
+    return m.group(1) if m else None
+
+
+def _read_head(res):
+    """Read a streamed response until the end of the head of the document
+
+    The connection is closed afterwards, so the rest of the page isn't
+    transferred.
+    """
+    content = b""
+    try:
+        for chunk in res.iter_content(chunk_size=HEAD_READ_SIZE):
+            # the end tag may be split over two chunks
+            start = max(0, len(content) - 16)
+            content += chunk
+            if HEAD_END_REGEX.search(content, start):
+                break
+    finally:
+        res.close()
+    return content
+
+
+def _get_head(url, tries=5, cookiejar=None):
+    """Retrieve the head of a page, see get_page_with_retry
+
+    Returns the content and the charset from the Content-Type header, which
+    is None if the header doesn't give one.
+    """
+    key = _memo_key(url, cookiejar)
+    res = page_memo.get("page", key)
+    if res is not None:
+        logger.info("Reusing retrieved url: %s" % url)
+        return res.content, _header_charset(res)
+    head = page_memo.get("page", key + ("head",))
+    if head is not None:
+        logger.info("Reusing retrieved url: %s" % url)
+        return head
+
+    res, content = _request_with_retry(
+        url, tries=tries, cookiejar=cookiejar, read=_read_head
+    )
+    if res is None:
+        return None, None
+    head = (content, _header_charset(res))
+    logger.info("Downloaded head of url: %s" % url)
+    page_memo.put("page", key + ("head",), head)
+    return head
+
+
+def get_page_with_retry(
+    url, tries=5, cookiejar=None, return_text=False, head_only=False
+):
+    """Retrieve a page, retrying on errors
+
+    With head_only, the response is streamed and only the part up to the end
+    of the head of the document is retrieved and returned.
+    """
+    if head_only:
+        content, charset = _get_head(url, tries=tries, cookiejar=cookiejar)
+        if return_text and content is not None:
+            return content.decode(charset or "utf-8", errors="replace")
+        return content
+
+    key = _memo_key(url, cookiejar)
+    res = page_memo.get("page", key)
+    if res is not None:
+        logger.info("Reusing retrieved url: %s" % url)
+        return res.text if return_text else res.content
+
+    res, _ = _request_with_retry(url, tries=tries, cookiejar=cookiejar)
+    if res is None:
+        return None
+    logger.info("Downloaded url: %s" % url)
+    page_memo.put("page", key, res)
+    if return_text:
+        return res.text
+    return res.content
+
+
+def _request_with_retry(url, tries=5, cookiejar=None, read=None):
+    """Request a url, retrying on errors
+
+    With read, the response is streamed and read is called to read its
+    content, so that errors while reading are retried too. Returns the
+    response and its content, or None and None if all tries failed.
+    """
     count = 0
     res = None
     jar = {} if cookiejar is None else cookiejar
@@ -81,8 +503,17 @@ def get_page_with_retry(url, tries=5, cookiejar=None, return_text=False):
         count += 1
         error = False
         try:
-            res = requests.get(url, headers=HEADERS, cookies=jar)
-        except requests.exceptions.ConnectionError:
+            res = requests.get(
+                url, headers=HEADERS, cookies=jar, stream=read is not None
+            )
+            if read is None:
+                content = res.content
+            elif res.ok:
+                content = read(res)
+        except (
+            requests.exceptions.ConnectionError,
+            requests.exceptions.ChunkedEncodingError,
+        ):
             error = True
 
         if (
@@ -99,11 +530,8 @@ def get_page_with_retry(url, tries=5, cookiejar=None, return_text=False):
             )
             time.sleep(5)
             continue
-
-        logger.info("Downloaded url: %s" % url)
-        if return_text:
-            return res.text
-        return res.content
+        return res, content
+    return None, None
 
 
 def get_content_type_with_retry(url, tries=5, cookiejar=None):
@@ -135,32 +563,76 @@ def get_content_type_with_retry(url, tries=5, cookiejar=None):
     return None
 
 
-def follow_redirects(url):
-    """Follow redirects from the URL (at most 100)"""
+def follow_redirects(url, cache=None):
+    """Follow redirects from the URL (at most 100)
+
+    If a RedirectCache is provided, hops of the redirect chain that are in the
+    cache are replayed without making a request, and new hops are added to
+    it.
+    """
     it = 0
     jar = requests.cookies.RequestsCookieJar()
+    final_cookies = None
     while it < 100:
-        req = requests.head(
-            url, headers=HEADERS, allow_redirects=False, cookies=jar
-        )
-        if req.status_code == 200:
-            break
-        if not "Location" in req.headers:
-            break
-        new_url = req.headers["Location"]
-        url = requests.compat.urljoin(url, new_url)
-        jar.update(req.cookies)
+        hop = None if cache is None else cache.get(url)
+        if hop is None:
+            req = requests.head(
+                url, headers=HEADERS, allow_redirects=False, cookies=jar
+            )
+            if cache is not None:
+                cache.put(url, req)
+            final_cookies = req.cookies
+            if req.status_code == 200:
+                break
+            if not "Location" in req.headers:
+                break
+            new_url = req.headers["Location"]
+            url = requests.compat.urljoin(url, new_url)
+            jar.update(req.cookies)
+        else:
+            new_url, final_cookies = hop
+            if new_url is None:
+                break
+            url = new_url
+            jar.update(final_cookies)
         it += 1
     if it == 100:
         logger.warning("Max redirects reached. There may be a problem.")
-    jar = jar or req.cookies
+    jar = jar or final_cookies
     return url, jar
 
 
+def resolve_redirects(urls, cache=None, max_workers=8):
+    """Follow the redirects of multiple urls concurrently
+
+    Returns a dict that maps each url to the result of
+    :func:`follow_redirects`, or to the exception it raised for that url, so
+    that one failing url doesn't stop the others.
+    """
+    urls = list(dict.fromkeys(urls))
+    if not urls:
+        return {}
+    workers = min(max_workers, len(urls))
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            url: pool.submit(follow_redirects, url, cache=cache)
+            for url in urls
+        }
+    results = {}
+    for url, future in futures.items():
+        try:
+            results[url] = future.result()
+        except Exception as err:
+            results[url] = err
+    return results
+
+
 def upload_to_remarkable_rmapi(
     filepath, remarkable_dir="/", rmapi_path="rmapi"
 ):
     logger.info("Starting upload to reMarkable")
+    if find_tool("rmapi", rmapi_path) is None:
+        raise RemarkableError("rmapi not found: %s" % rmapi_path)
 
     # Create the reMarkable dir if it doesn't exist
     remarkable_dir = remarkable_dir.rstrip("/")
@@ -250,27 +722,9 @@ def upload_to_remarkable_usb(filepath, remarkable_dir="/"):
 
 def check_pdftool(pdftk_path, qpdf_path):
     """Check whether we have pdftk or qpdf available"""
-    # set defaults in case either is set to None or something
-    pdftk_path = pdftk_path or "false"
-    qpdf_path = qpdf_path or "false"
-
-    try:
-        status = subprocess.call(
-            [pdftk_path], stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
-        )
-    except FileNotFoundError:
-        status = 1
-    if status == 0:
+    if find_tool("pdftk", pdftk_path):
         return "pdftk"
-    try:
-        status = subprocess.call(
-            [qpdf_path, "--help"],
-            stdout=subprocess.DEVNULL,
-            stderr=subprocess.DEVNULL,
-        )
-    except FileNotFoundError:
-        status = 1
-    if status == 0:
+    if find_tool("qpdf", qpdf_path):
         return "qpdf"
     raise NoPDFToolError
 
@@ -0,0 +1,269 @@
+# -*- coding: utf-8 -*-
+
+"""Watch a directory and process the PDF files that are added to it
+
+New files are detected with inotify on Linux and by scanning the directory
+on other platforms. A file is processed once its size and modification time
+haven't changed for a while, so files that are still being written are left
+alone. Files are processed by a pool of worker processes and afterwards moved
+to the ``done`` or ``failed`` subdirectory, the latter together with a file
+with the error.
+
+Directories on network file systems don't always report changes through
+inotify, so the directory is also scanned every ``poll_interval`` seconds.
+When files aren't uploaded and the current directory is the watched one, the
+output is saved in the ``output`` subdirectory, so it isn't processed again.
+
+"""
+
+import concurrent.futures
+import ctypes
+import ctypes.util
+import os
+import select
+import shutil
+import stat
+import struct
+import sys
+import time
+import traceback
+
+from .log import Logger
+from .utils import chdir
+
+logger = Logger()
+
+DEFAULT_WORKERS = 2
+SETTLE_TIME = 2.0  # seconds
+POLL_INTERVAL = 2.0  # seconds
+
+DONE_DIR = "done"
+FAILED_DIR = "failed"
+OUTPUT_DIR = "output"
+
+# inotify constants from <sys/inotify.h>
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_Q_OVERFLOW = 0x00004000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+EVENT_HEADER = struct.Struct("iIII")
+
+
+class Inotify:
+    """Minimal inotify watch on a single directory, using ctypes"""
+
+    def __init__(self, directory):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        mask = IN_CLOSE_WRITE | IN_MOVED_TO
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(directory), mask)
+        if wd < 0:
+            os.close(self.fd)
+            raise OSError(ctypes.get_errno(), "inotify_add_watch failed")
+
+    def wait(self, timeout):
+        """Names of the changed files, or None if all must be checked"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        data = os.read(self.fd, 64 * 1024)
+        names = set()
+        offset = 0
+        while offset < len(data):
+            _, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            if mask & IN_Q_OVERFLOW:
+                return None
+            name = data[offset : offset + length].rstrip(b"\0")
+            names.add(os.fsdecode(name))
+            offset += length
+        return names
+
+    def close(self):
+        os.close(self.fd)
+
+
+class Poller:
+    """Fallback for platforms without inotify"""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return None
+
+    def close(self):
+        pass
+
+
+def process_file(path, options):
+    """Process a single file with the normal pipeline"""
+    # Imported here to avoid a circular import, as the ui imports this module
+    from .ui import choose_provider
+    from .ui import create_provider
+
+    provider, new_input, cookiejar = choose_provider(path, "file")
+    prov = create_provider(provider, options, cookiejar=cookiejar)
+    directory = os.path.dirname(path)
+    if options["core"]["upload"] or not os.path.samefile(
+        os.getcwd(), directory
+    ):
+        return prov.run(new_input)
+    output_dir = os.path.join(directory, OUTPUT_DIR)
+    os.makedirs(output_dir, exist_ok=True)
+    with chdir(output_dir):
+        return prov.run(new_input)
+
+
+class FolderWatcher:
+    """Watch a directory and process the PDF files added to it
+
+    At most ``2 * workers`` files are handed to the pool at a time, the
+    others wait until there is room.
+    """
+
+    def __init__(
+        self,
+        directory,
+        options,
+        workers=DEFAULT_WORKERS,
+        settle_time=SETTLE_TIME,
+        poll_interval=POLL_INTERVAL,
+        executor=None,
+        process=process_file,
+    ):
+        self.directory = os.path.abspath(directory)
+        self.options = options
+        self.workers = workers
+        self.settle_time = settle_time
+        self.poll_interval = poll_interval
+        self.process = process
+        self.executor = executor or concurrent.futures.ProcessPoolExecutor(
+            max_workers=workers
+        )
+        for subdir in [DONE_DIR, FAILED_DIR]:
+            os.makedirs(os.path.join(self.directory, subdir), exist_ok=True)
+
+        self.source = self._make_source()
+        # name -> ((size, mtime), time at which it was last changed)
+        self.pending = {}
+        # future -> name
+        self.in_flight = {}
+        # files present at the start are processed too
+        self._last_scan = None
+        self._update(None)
+
+    def _make_source(self):
+        if sys.platform.startswith("linux"):
+            try:
+                return Inotify(self.directory)
+            except (OSError, AttributeError) as err:
+                logger.warning("Can't use inotify, polling instead: %s" % err)
+        return Poller()
+
+    def run(self):
+        logger.info("Watching %s for new PDF files" % self.directory)
+        try:
+            while True:
+                self.step()
+        finally:
+            self.close()
+
+    def step(self):
+        """Wait for changes and handle the files that are ready"""
+        timeout = self.poll_interval
+        if self.pending or self.in_flight:
+            timeout = min(timeout, self.settle_time / 2)
+        names = self.source.wait(timeout)
+        if time.monotonic() - self._last_scan >= self.poll_interval:
+            names = None
+        self._update(names)
+        self._submit_ready()
+        self._collect_finished()
+
+    def close(self):
+        # Unfinished files stay in the directory, so they are processed again
+        # on the next start.
+        self.source.close()
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def _update(self, names):
+        """Track changes to the files, all of them if names is None"""
+        if names is None:
+            names = os.listdir(self.directory)
+            self._last_scan = time.monotonic()
+        busy = set(self.in_flight.values())
+        for name in names:
+            if name.lower().endswith(".pdf") and name not in busy:
+                self.pending.setdefault(name, (None, time.monotonic()))
+
+    def _submit_ready(self):
+        now = time.monotonic()
+        for name, (signature, since) in list(self.pending.items()):
+            path = os.path.join(self.directory, name)
+            try:
+                st = os.stat(path)
+            except FileNotFoundError:
+                st = None
+            if st is None or not stat.S_ISREG(st.st_mode):
+                del self.pending[name]
+                continue
+            current = (st.st_size, st.st_mtime)
+            if current != signature:
+                self.pending[name] = (current, now)
+            elif now - since < self.settle_time:
+                continue
+            elif len(self.in_flight) < 2 * self.workers:
+                del self.pending[name]
+                logger.info("Processing %s" % name)
+                future = self.executor.submit(self.process, path, self.options)
+                self.in_flight[future] = name
+
+    def _collect_finished(self):
+        for future in [f for f in self.in_flight if f.done()]:
+            name = self.in_flight.pop(future)
+            error = future.exception()
+            subdir = DONE_DIR if error is None else FAILED_DIR
+            target = self._move(name, subdir)
+            if error is None:
+                logger.info("Finished %s" % name)
+                continue
+            logger.warning("Failed to process %s: %s" % (name, error))
+            if target is None:
+                continue
+            text = "".join(
+                traceback.format_exception(
+                    type(error), error, error.__traceback__
+                )
+            )
+            with open(target + ".error.txt", "w") as fp:
+                fp.write(text)
+
+    def _move(self, name, subdir):
+        target = os.path.join(self.directory, subdir, name)
+        while os.path.exists(target):
+            base = os.path.splitext(target)[0]
+            target = base + "_.pdf"
+        try:
+            shutil.move(os.path.join(self.directory, name), target)
+        except FileNotFoundError:
+            logger.warning("File was removed while processing: %s" % name)
+            return None
+        return target
+
+
+def watch(directory, options):
+    """Watch the directory until interrupted"""
+    settings = options.get("watch", {})
+    watcher = FolderWatcher(
+        directory,
+        options,
+        workers=settings.get("workers", DEFAULT_WORKERS),
+        settle_time=settings.get("settle_time", SETTLE_TIME),
+        poll_interval=settings.get("poll_interval", POLL_INTERVAL),
+    )
+    try:
+        watcher.run()
+    except KeyboardInterrupt:
+        pass
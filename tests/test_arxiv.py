@@ -7,15 +7,22 @@ This file is part of paper2remarkable.
 
 """
 
+import io
 import os
 import re
 import shutil
 import tempfile
 import unittest
 
+import pikepdf
+
 from paper2remarkable.providers.arxiv import DEARXIV_TEXT_REGEX
 from paper2remarkable.providers.arxiv import DEARXIV_URI_REGEX
 from paper2remarkable.providers.arxiv import Arxiv
+from paper2remarkable.providers.arxiv import _first_page_has_stamp
+from paper2remarkable.providers.arxiv import has_arxiv_stamp
+from paper2remarkable.providers.arxiv import remove_stamp
+from paper2remarkable.providers.arxiv import remove_stamp_pikepdf
 
 
 class TestArxiv(unittest.TestCase):
@@ -61,6 +68,143 @@ class TestArxiv(unittest.TestCase):
         m = re.fullmatch(DEARXIV_URI_REGEX, key)
         self.assertIsNotNone(m)
 
+    def test_get_paper_id(self):
+        tests = [
+            ("https://arxiv.org/abs/1811.11242v1", "arxiv:1811.11242"),
+            ("https://arxiv.org/pdf/1811.11242.pdf", "arxiv:1811.11242"),
+            ("https://arxiv.org/abs/math/0309285", "arxiv:math/0309285"),
+            (
+                "http://arxiv.org/pdf/physics/0605197v1",
+                "arxiv:physics/0605197",
+            ),
+        ]
+        for url, exp in tests:
+            with self.subTest(url=url):
+                self.assertEqual(Arxiv.get_paper_id(url), exp)
+
+    def test_remove_stamp(self):
+        objects = [
+            b"1 0 obj\n<< /Type /Catalog >>\nendobj\n",
+            b"2 0 obj\n<< /Length 58 >>\nstream\n"
+            b"BT (arXiv:1908.03213v1 [astro-ph.HE] 8 Aug 2019)Tj ET\n"
+            b"endstream\nendobj\n",
+            b"3 0 obj\n<<\n/URI (https://arxiv.org/abs/1101.0028v3)\n"
+            b"/S /URI\n>>\nendobj\n",
+        ]
+        data = b"%PDF-1.4\n" + b"".join(objects)
+        data += b"xref\n0 4\n0000000000 65535 f \n"
+        data += b"0000000000 00000 n \n" * 3
+        data += b"trailer\n<< /Size 4 /Root 1 0 R >>\n"
+        data += b"startxref\n1\n%%EOF\n"
+
+        fout = io.BytesIO()
+        self.assertTrue(remove_stamp(io.BytesIO(data), fout))
+        out = fout.getvalue()
+        self.assertNotIn(b"arXiv:", out)
+        self.assertNotIn(b"/URI", out)
+        self.assertIn(b"BT ()Tj ET", out)
+        self.assertIn(b"<< /Length 11 >>", out)
+
+        # the xref table points to the objects in the new file
+        startxref = int(out.split(b"startxref\n")[1].split(b"\n")[0])
+        self.assertTrue(out[startxref:].startswith(b"xref\n0 4\n"))
+        entries = out[startxref:].split(b"\n")[3:6]
+        for objid, entry in enumerate(entries, start=1):
+            offset = int(entry.split(b" ")[0])
+            self.assertTrue(out[offset:].startswith(b"%i 0 obj\n" % objid))
+
+        # files without the stamp are copied unchanged
+        fout = io.BytesIO()
+        self.assertFalse(remove_stamp(io.BytesIO(out), fout))
+        self.assertEqual(fout.getvalue(), out)
+
+    def test_remove_stamp_pikepdf(self):
+        pdf = pikepdf.new()
+        pdf.add_blank_page()
+        page = pdf.pages[0].obj
+        stamp = b"(arXiv:1908.03213v1 [astro-ph.HE] 8 Aug 2019)Tj"
+        page.Contents = pdf.make_stream(
+            b"BT " + stamp + b" ET BT (Hello)Tj ET"
+        )
+        form = pdf.make_stream(
+            b"BT [(arXiv:1101.0028v3  [math.NA]  9 ) (Apr 2004)]TJ ET"
+        )
+        form.Type = pikepdf.Name.XObject
+        form.Subtype = pikepdf.Name.Form
+        form.BBox = [0, 0, 100, 100]
+        page.Resources = pikepdf.Dictionary(
+            XObject=pikepdf.Dictionary(Fm0=form)
+        )
+
+        def link(uri):
+            action = pikepdf.Dictionary(S=pikepdf.Name.URI, URI=uri)
+            return pdf.make_indirect(
+                pikepdf.Dictionary(Subtype=pikepdf.Name.Link, A=action)
+            )
+
+        page.Annots = pdf.make_indirect(
+            pikepdf.Array(
+                [
+                    link("https://arxiv.org/abs/1908.03213v1"),
+                    link("https://example.com"),
+                ]
+            )
+        )
+        input_file = os.path.join(self.test_dir, "input.pdf")
+        pdf.save(input_file)
+
+        output_file = os.path.join(self.test_dir, "output.pdf")
+        self.assertTrue(has_arxiv_stamp(input_file))
+        self.assertTrue(remove_stamp_pikepdf(input_file, output_file))
+        self.assertFalse(has_arxiv_stamp(output_file))
+        with pikepdf.open(output_file) as pdf:
+            page = pdf.pages[0].obj
+            content = page.Contents.read_bytes()
+            self.assertNotIn(b"arXiv", content)
+            self.assertIn(b"Hello", content)
+            form = page.Resources.XObject.Fm0.read_bytes()
+            self.assertNotIn(b"arXiv", form)
+            self.assertEqual(len(page.Annots), 1)
+            self.assertEqual(str(page.Annots[0].A.URI), "https://example.com")
+
+        # files without the stamp are left as they are
+        self.assertFalse(remove_stamp_pikepdf(output_file, input_file))
+
+    def test_stamp_inherited_resources(self):
+        pdf = pikepdf.new()
+        pdf.add_blank_page()
+        form = pdf.make_stream(
+            b"BT (arXiv:1908.03213v1 [astro-ph.HE] 8 Aug 2019)Tj ET"
+        )
+        form.Type = pikepdf.Name.XObject
+        form.Subtype = pikepdf.Name.Form
+        form.BBox = [0, 0, 100, 100]
+        # the page gets its resources from the page tree, which pikepdf
+        # only changes when the file is saved
+        del pdf.pages[0].obj["/Resources"]
+        pdf.Root.Pages.Resources = pikepdf.Dictionary(
+            XObject=pikepdf.Dictionary(Fm0=form)
+        )
+        self.assertTrue(_first_page_has_stamp(pdf))
+
+    def test_dearxiv_skipped(self):
+        pdf = pikepdf.new()
+        pdf.add_blank_page()
+        pdf.save("paper.pdf")
+        prov = Arxiv(upload=False)
+        with prov._timed("dearxiv"):
+            output = prov.dearxiv("paper.pdf")
+        self.assertEqual(output, "paper.pdf")
+        self.assertEqual(
+            prov.timings["dearxiv"]["skipped"],
+            "no arXiv stamp on the first page",
+        )
+
+        # postscript files can't be checked
+        with open("paper.ps", "w") as fp:
+            fp.write("%!PS-Adobe-3.0\n")
+        self.assertTrue(has_arxiv_stamp("paper.ps"))
+
     def test_stamp_removed_1(self):
         url = "https://arxiv.org/pdf/1703.06103.pdf"
         prov = Arxiv(upload=False)
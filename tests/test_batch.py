@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the state of batch runs
+
+This file is part of paper2remarkable.
+
+"""
+
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from _constants import TEST_FILE
+
+from paper2remarkable.batch import STATE_TTL
+from paper2remarkable.batch import BatchState
+from paper2remarkable.providers.local import LocalFile
+from paper2remarkable.utils import chdir
+
+
+class TestBatchState(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        self.base_dir = os.path.join(self.tmpdir, "batches")
+        self.inputs = ["https://arxiv.org/abs/1811.11242", "paper.pdf"]
+        self.filenames = [None, None]
+        self.options = {"core": {"crop": "left", "verbose": False}}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def open(self, resume=False, options=None):
+        return BatchState.open(
+            self.inputs,
+            self.filenames,
+            options or self.options,
+            resume=resume,
+            base_dir=self.base_dir,
+        )
+
+    def test_record_and_resume(self):
+        source = os.path.join(self.tmpdir, "source.pdf")
+        with open(source, "w") as fp:
+            fp.write(TEST_FILE)
+
+        item = self.open().item(0)
+        item.record("resolved", src="https://arxiv.org/abs/1811.11242")
+        item.record("downloaded", source, clean_filename="Paper.pdf")
+
+        # a resumed run sees the finished stages
+        item = self.open(resume=True).item(0)
+        self.assertTrue(item.done("downloaded"))
+        self.assertFalse(item.done("processed"))
+        self.assertEqual(item.get("downloaded")["clean_filename"], "Paper.pdf")
+        with chdir(self.tmpdir):
+            restored = item.restore("downloaded", "paper.pdf")
+            with open(restored, "r") as fp:
+                self.assertEqual(fp.read(), TEST_FILE)
+
+        # the key ignores verbosity but not the other options
+        options = {"core": {"crop": "left", "verbose": True}}
+        self.assertTrue(
+            self.open(resume=True, options=options).item(0).done("resolved")
+        )
+        options = {"core": {"crop": "center", "verbose": False}}
+        self.assertFalse(
+            self.open(resume=True, options=options).item(0).done("resolved")
+        )
+
+        # without resume the state starts over
+        self.assertFalse(self.open().item(0).done("resolved"))
+
+    def test_record_resets_later_stages(self):
+        item = self.open().item(1)
+        item.record("resolved", src="a")
+        item.record("uploaded")
+        item.record("resolved", src="b")
+        self.assertFalse(item.done("uploaded"))
+
+    def test_restore_damaged(self):
+        source = os.path.join(self.tmpdir, "source.pdf")
+        with open(source, "w") as fp:
+            fp.write(TEST_FILE)
+        batch = self.open()
+        item = batch.item(0)
+        item.record("downloaded", source, clean_filename="Paper.pdf")
+        item.record("processed", source)
+        with open(os.path.join(item.directory, "downloaded.pdf"), "a") as fp:
+            fp.write("garbage")
+
+        with chdir(self.tmpdir):
+            self.assertIsNone(item.restore("downloaded"))
+        self.assertFalse(item.done("downloaded"))
+        self.assertFalse(item.done("processed"))
+
+    def test_remove_expired(self):
+        old = self.open()
+        old.item(0).record("resolved", src="a")
+        stale = time.time() - STATE_TTL - 60
+        os.utime(old.state_file, (stale, stale))
+
+        # opening the state of another run removes the expired state
+        current = self.open(options={"core": {"crop": "right"}})
+        self.assertFalse(os.path.exists(old.directory))
+        self.assertTrue(os.path.exists(current.directory))
+
+        # but the state that is resumed is kept
+        current.item(0).record("resolved", src="a")
+        os.utime(current.state_file, (stale, stale))
+        resumed = BatchState.open(
+            self.inputs,
+            self.filenames,
+            {"core": {"crop": "right"}},
+            resume=True,
+            base_dir=self.base_dir,
+        )
+        self.assertTrue(resumed.item(0).done("resolved"))
+
+    def test_provider_resume(self):
+        source = os.path.join(self.tmpdir, "source.pdf")
+        with open(source, "w") as fp:
+            fp.write(TEST_FILE)
+        item = self.open().item(0)
+        item.record("resolved", src=source, abs_url=source, pdf_url=source)
+        item.record("downloaded", source, clean_filename="Paper.pdf")
+        item.record("processed", source)
+
+        prov = LocalFile(upload=False, crop="none")
+        # the stages are restored, so these shouldn't be called
+        prov.retrieve = None
+        prov.operations = None
+        with chdir(self.tmpdir):
+            target = prov.run("does_not_exist.pdf", state=item)
+        self.assertEqual(target, os.path.join(self.tmpdir, "Paper.pdf"))
+        self.assertTrue(item.done("uploaded"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the persistent caches
+
+This file is part of paper2remarkable.
+
+"""
+
+import http.server
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+import requests
+
+from paper2remarkable.cache import MetadataCache
+from paper2remarkable.cache import RedirectCache
+from paper2remarkable.cache import UploadHistory
+from paper2remarkable.utils import follow_redirects
+from paper2remarkable.utils import resolve_redirects
+
+
+class RedirectHandler(http.server.BaseHTTPRequestHandler):
+    """Permanent redirect from /a to /b, temporary from /b to /c"""
+
+    seen = []
+
+    def do_HEAD(self):
+        self.seen.append(self.path)
+        if self.path == "/a":
+            self.send_response(301)
+            self.send_header("Location", "/b")
+            self.send_header("Set-Cookie", "perm=1; Max-Age=3600; Path=/")
+        elif self.path == "/b":
+            self.send_response(302)
+            self.send_header("Location", "/c")
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class TestMetadataCache(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix="p2r_test_cache_")
+        self.path = os.path.join(self.test_dir, "metadata.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_put_get(self):
+        cache = MetadataCache(path=self.path)
+        # the database is only created when it is used
+        self.assertFalse(os.path.exists(self.path))
+        self.assertIsNone(cache.get("arxiv:1811.11242"))
+        cache.put("arxiv:1811.11242", "Title", ["Burg", "Sutton"], "2018")
+        info = cache.get("arxiv:1811.11242")
+        self.assertEqual(info["title"], "Title")
+        self.assertEqual(info["authors"], ["Burg", "Sutton"])
+        self.assertEqual(info["year"], "2018")
+
+    def test_ttl(self):
+        cache = MetadataCache(path=self.path, ttl=-1)
+        cache.put("doi:10.1145/3025453.3026030", "Title", ["A"], "2017")
+        self.assertIsNone(cache.get("doi:10.1145/3025453.3026030"))
+
+    def test_invalidate(self):
+        cache = MetadataCache(path=self.path)
+        cache.put("acl:P19-1001", "Title", ["A"], "2019")
+        cache.put("acl:P19-1002", "Title", ["B"], "2019")
+        cache.invalidate("acl:P19-1001")
+        self.assertIsNone(cache.get("acl:P19-1001"))
+        self.assertIsNotNone(cache.get("acl:P19-1002"))
+        cache.invalidate()
+        self.assertIsNone(cache.get("acl:P19-1002"))
+
+
+class TestUploadHistory(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix="p2r_test_cache_")
+        self.path = os.path.join(self.test_dir, "uploads.sqlite")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_put_get(self):
+        history = UploadHistory(path=self.path)
+        url = "https://arxiv.org/abs/1811.11242"
+        self.assertIsNone(history.get("arxiv:1811.11242", "rmapi::/", "a"))
+        history.put("arxiv:1811.11242", "rmapi::/", "a", url)
+        self.assertEqual(history.get("arxiv:1811.11242", "rmapi::/", "a"), url)
+        # other targets and options aren't duplicates
+        self.assertIsNone(history.get("arxiv:1811.11242", "rmapi::/x", "a"))
+        self.assertIsNone(history.get("arxiv:1811.11242", "rmapi::/", "b"))
+
+
+class TestRedirectCache(unittest.TestCase):
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp(prefix="p2r_test_cache_")
+        self.path = os.path.join(self.test_dir, "redirects.sqlite")
+        self.server = http.server.HTTPServer(("127.0.0.1", 0), RedirectHandler)
+        thread = threading.Thread(target=self.server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.base = "http://127.0.0.1:%i" % self.server.server_port
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        shutil.rmtree(self.test_dir)
+
+    def test_follow_redirects_cached(self):
+        cache = RedirectCache(path=self.path)
+
+        url, jar = follow_redirects(self.base + "/a", cache=cache)
+        self.assertEqual(url, self.base + "/c")
+        self.assertEqual(RedirectHandler.seen, ["/a", "/b", "/c"])
+
+        # only the temporary redirect needs a request the second time
+        RedirectHandler.seen.clear()
+        url, jar = follow_redirects(self.base + "/a", cache=cache)
+        self.assertEqual(url, self.base + "/c")
+        self.assertEqual(RedirectHandler.seen, ["/b"])
+        self.assertEqual(jar.get("perm"), "1")
+
+    def test_resolve_redirects(self):
+        good, bad = self.base + "/a", "http://127.0.0.1:1/a"
+        results = resolve_redirects([good, bad])
+        # a failing url doesn't stop the others
+        self.assertEqual(results[good][0], self.base + "/c")
+        self.assertIsInstance(results[bad], requests.ConnectionError)
+
+
+if __name__ == "__main__":
+    unittest.main()
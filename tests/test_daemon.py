@@ -0,0 +1,150 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the daemon mode
+
+This file is part of paper2remarkable.
+
+"""
+
+import contextlib
+import io
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import unittest
+
+from paper2remarkable import daemon
+from paper2remarkable.ui import parse_args
+
+
+class TestDaemon(unittest.TestCase):
+    def test_is_local(self):
+        def is_local(argv):
+            return daemon._is_local(parse_args(argv))
+
+        self.assertFalse(is_local(["-v", "-p", "/papers", "url"]))
+        # an option value that contains a d isn't the debug flag
+        self.assertFalse(is_local(["-p", "/docs", "url"]))
+        self.assertFalse(is_local(["-pdocs", "url"]))
+        self.assertTrue(is_local(["--debug", "url"]))
+        self.assertTrue(is_local(["-vd", "url"]))
+        self.assertTrue(is_local(["--daemon"]))
+
+    def test_handle_local(self):
+        client, server = socket.socketpair()
+        with client, server:
+            request = {"argv": ["-d", "url"], "cwd": tempfile.gettempdir()}
+            client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            daemon.handle(server, lambda args: self.fail("executed"))
+            server.shutdown(socket.SHUT_WR)
+            lines = client.makefile("r", encoding="utf-8").readlines()
+        self.assertEqual([json.loads(x) for x in lines], [{"local": True}])
+
+    def test_handle(self):
+        def execute(args):
+            print("converting %s" % args.input[0])
+            print("warning", file=sys.stderr)
+            return 3
+
+        client, server = socket.socketpair()
+        with client, server:
+            request = {
+                "argv": ["-v", "paper.pdf"],
+                "cwd": tempfile.gettempdir(),
+            }
+            client.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            cwd = os.getcwd()
+            daemon.handle(server, execute)
+            self.assertEqual(os.getcwd(), cwd)
+            server.shutdown(socket.SHUT_WR)
+            lines = client.makefile("r", encoding="utf-8").readlines()
+
+        messages = [json.loads(line) for line in lines]
+        self.assertEqual(
+            messages,
+            [
+                {"stream": "stdout", "data": "converting paper.pdf"},
+                {"stream": "stdout", "data": "\n"},
+                {"stream": "stderr", "data": "warning"},
+                {"stream": "stderr", "data": "\n"},
+                {"status": 3},
+            ],
+        )
+
+    def test_forward(self):
+        tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        path = os.path.join(tmpdir, "p2r.sock")
+        self.assertIsNone(daemon.forward(["url"], path=path))
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        received = []
+
+        def serve_one():
+            conn, _ = server.accept()
+            with conn:
+                fp = conn.makefile("r", encoding="utf-8")
+                received.append(json.loads(fp.readline()))
+                for msg in [
+                    {"stream": "stdout", "data": "done\n"},
+                    {"status": 0},
+                ]:
+                    conn.sendall(json.dumps(msg).encode("utf-8") + b"\n")
+
+        thread = threading.Thread(target=serve_one)
+        thread.start()
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            status = daemon.forward(["url"], path=path)
+        thread.join()
+        server.close()
+        os.unlink(path)
+        os.rmdir(tmpdir)
+
+        self.assertEqual(status, 0)
+        self.assertEqual(out.getvalue(), "done\n")
+        self.assertEqual(received[0]["argv"], ["url"])
+        self.assertEqual(received[0]["cwd"], os.getcwd())
+
+    def test_forward_version(self):
+        tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        path = os.path.join(tmpdir, "p2r.sock")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        server.setblocking(False)
+        # the client prints its own version, without asking the daemon
+        status = daemon.forward(["--version"], path=path)
+        with self.assertRaises(BlockingIOError):
+            server.accept()
+        server.close()
+        os.unlink(path)
+        os.rmdir(tmpdir)
+        self.assertIsNone(status)
+
+    def test_forward_not_private(self):
+        tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        path = os.path.join(tmpdir, "p2r.sock")
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen()
+        # a socket that other users can replace isn't used
+        os.chmod(tmpdir, 0o777)
+        err = io.StringIO()
+        with contextlib.redirect_stderr(err):
+            status = daemon.forward(["url"], path=path)
+        server.close()
+        os.unlink(path)
+        os.rmdir(tmpdir)
+
+        self.assertIsNone(status)
+        self.assertIn("WARNING", err.getvalue())
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -5,13 +5,33 @@
 
 import os
 import shutil
+import sys
 import tempfile
 import unittest
+import zlib
 
 from _constants import TEST_FILE
+from pikepdf import Array
+from pikepdf import Dictionary
+from pikepdf import Encryption
+from pikepdf import Name
+from pikepdf import ObjectStreamMode
+from pikepdf import OutlineItem
 from pikepdf import Pdf
 
+from paper2remarkable.exceptions import FileTypeError
+from paper2remarkable.ghostscript import LibGS
+from paper2remarkable.ghostscript import run_gs
+from paper2remarkable.pdf_ops import analyze_pdf
+from paper2remarkable.pdf_ops import blank_pdf
+from paper2remarkable.pdf_ops import eink_flags
+from paper2remarkable.pdf_ops import eink_resolution
+from paper2remarkable.pdf_ops import estimate_shrink
+from paper2remarkable.pdf_ops import linearize_pdf
+from paper2remarkable.pdf_ops import shard_ranges
+from paper2remarkable.pdf_ops import shrink_pdf
 from paper2remarkable.providers.local import LocalFile
+from paper2remarkable.utils import chdir
 
 
 class PdfOpsTestCase(unittest.TestCase):
@@ -31,6 +51,336 @@ class PdfOpsTestCase(unittest.TestCase):
         pdf = Pdf.open(filename)
         self.assertEqual(len(pdf.pages), 2)
 
+    def test_blank_pdf(self):
+        filename = os.path.join(self._tmpdir, "paper.pdf")
+        pdf = Pdf.new()
+        for size in [(612, 792), (595, 842), (612, 792)]:
+            pdf.add_blank_page(page_size=size)
+        with pdf.open_outline() as outline:
+            outline.root.append(OutlineItem("Last", 2))
+        pdf.save(filename)
+
+        with Pdf.open(blank_pdf(filename)) as pdf:
+            self.assertEqual(len(pdf.pages), 6)
+            sizes = [tuple(map(float, p.MediaBox[2:])) for p in pdf.pages]
+            self.assertEqual(sizes[1::2], [(612, 792), (595, 842), (612, 792)])
+            # blank pages share their contents and resources
+            blanks = [p.obj for p in pdf.pages[1::2]]
+            self.assertEqual(len({b.Contents.objgen for b in blanks}), 1)
+            self.assertEqual(len({b.Resources.objgen for b in blanks}), 1)
+            # the outline still points to the same page
+            with pdf.open_outline() as outline:
+                page = outline.root[0].destination[0]
+                self.assertEqual(pdf.pages.index(page), 4)
+
+    def test_run_gs(self):
+        # a stand-in for gs that records its arguments
+        args_file = os.path.join(self._tmpdir, "args.txt")
+        gs_path = os.path.join(self._tmpdir, "gs")
+        with open(gs_path, "w") as fp:
+            fp.write(
+                '#!/bin/sh\nfor a in "$@"; do echo "$a"; done > %s\n'
+                % args_file
+            )
+        os.chmod(gs_path, 0o755)
+
+        def gs_args(**kwargs):
+            status = run_gs(
+                ["-sDEVICE=pdfwrite", "in.pdf"], gs_path=gs_path, **kwargs
+            )
+            self.assertEqual(status, 0)
+            with open(args_file) as fp:
+                return fp.read().split()
+
+        self.assertEqual(gs_args(), ["-sDEVICE=pdfwrite", "in.pdf"])
+        args = gs_args(threads=4, tuned=True)
+        self.assertIn("-dNumRenderingThreads=4", args)
+        self.assertIn("-dPassThroughJPEGImages=true", args)
+        self.assertEqual(args[-2:], ["-sDEVICE=pdfwrite", "in.pdf"])
+
+        # the executable is used when libgs isn't available
+        if LibGS.get() is None:
+            args = gs_args(backend="libgs")
+            self.assertEqual(args, ["-sDEVICE=pdfwrite", "in.pdf"])
+
+        # a missing executable is reported without calling it
+        missing = os.path.join(self._tmpdir, "missing_gs")
+        self.assertEqual(run_gs(["in.pdf"], gs_path=missing), 1)
+
+    def test_eink_resolution(self):
+        filename = os.path.join(self._tmpdir, "letter.pdf")
+        pdf = Pdf.new()
+        pdf.add_blank_page(page_size=(612, 792))
+        pdf.save(filename)
+        # a letter page is shown at about 166 dpi on the reMarkable
+        self.assertEqual(eink_resolution(filename), 166)
+
+        # cropping the page increases the resolution on the screen
+        pdf.add_blank_page(page_size=(612, 792))
+        pdf.pages[1].CropBox = [0, 0, 306, 396]
+        pdf.save(filename)
+        self.assertEqual(eink_resolution(filename), 331)
+
+        flags = eink_flags(331)
+        self.assertIn("-dColorImageResolution=331", flags)
+        self.assertIn("-dMonoImageResolution=662", flags)
+        self.assertIn("-sColorConversionStrategy=Gray", flags)
+
+    def test_estimate_shrink(self):
+        filename = os.path.join(self._tmpdir, "paper.pdf")
+        pdf = Pdf.new()
+        pdf.add_blank_page(page_size=(612, 792))
+        pdf.pages[0].Contents = pdf.make_stream(b"BT (Hello) Tj ET" * 100)
+        pdf.save(filename)
+        # only text, already compressed on save
+        self.assertLess(estimate_shrink(filename), 0.05)
+
+        # a color image of 2000x2000 pixels on a letter page (about 200 dpi)
+        size = 2000
+        data = bytes(
+            (x * 7 + y) % 256 for y in range(size) for x in range(size)
+        )
+        image = pdf.make_stream(zlib.compress(data * 3))
+        image.Type = Name.XObject
+        image.Subtype = Name.Image
+        image.Width = image.Height = size
+        image.ColorSpace = Name.DeviceRGB
+        image.BitsPerComponent = 8
+        image.Filter = Name.FlateDecode
+        pdf.pages[0].Resources = Dictionary(XObject=Dictionary(Im0=image))
+        pdf.save(filename)
+        # below 300 dpi for the printer profile, above it for the reMarkable
+        self.assertLess(estimate_shrink(filename), 0.05)
+        self.assertGreater(estimate_shrink(filename, profile="eink"), 0.5)
+
+        # cropping the page makes the image resolution higher
+        pdf.pages[0].CropBox = [0, 0, 204, 264]
+        pdf.save(filename)
+        self.assertGreater(estimate_shrink(filename), 0.5)
+
+    def test_indexed_color(self):
+        filename = os.path.join(self._tmpdir, "palette.pdf")
+        pdf = Pdf.new()
+        pdf.add_blank_page(page_size=(612, 792))
+        colorspaces = [
+            Array([Name.Indexed, Name.DeviceRGB, 1, b"\x00" * 6]),
+            Array([Name.Indexed, Name.DeviceGray, 1, b"\x00\xff"]),
+        ]
+        for i, colorspace in enumerate(colorspaces):
+            image = pdf.make_stream(zlib.compress(bytes(100)))
+            image.Type = Name.XObject
+            image.Subtype = Name.Image
+            image.Width = image.Height = 10
+            image.ColorSpace = colorspace
+            image.BitsPerComponent = 8
+            image.Filter = Name.FlateDecode
+            pdf.pages[0].Resources = Dictionary(XObject=Dictionary(Im0=image))
+            pdf.save(filename)
+            with self.subTest(colorspace=i):
+                [(_, _, color, _)] = analyze_pdf(filename).images
+                self.assertEqual(color, i == 0)
+
+    def test_shard_ranges(self):
+        self.assertEqual(shard_ranges(10, 3), [(1, 4), (5, 7), (8, 10)])
+        self.assertEqual(shard_ranges(4, 1), [(1, 4)])
+
+    def make_gs(self, fail_range=None):
+        """A stand-in for gs that copies the page range with pikepdf
+
+        Every call is logged to gs.log, and the range starting at
+        fail_range fails after writing its output.
+        """
+        gs_path = os.path.join(self._tmpdir, "gs")
+        with open(gs_path, "w") as fp:
+            fp.write(
+                "#!%s\n"
+                "import sys\n"
+                "if sys.argv[1:] == ['--version']:\n"
+                "    sys.exit(print('9.99'))\n"
+                "from pikepdf import Pdf\n"
+                "opts = dict(a[2:].split('=', 1) for a in sys.argv[1:-1] "
+                "if '=' in a)\n"
+                "with open(%r, 'a') as fp:\n"
+                "    fp.write(opts.get('FirstPage', '') + '\\n')\n"
+                "src = Pdf.open(sys.argv[-1])\n"
+                "first = int(opts.get('FirstPage', 1))\n"
+                "last = int(opts.get('LastPage', len(src.pages)))\n"
+                "dst = Pdf.new()\n"
+                "dst.pages.extend(src.pages[first - 1 : last])\n"
+                "dst.save(opts['OutputFile'])\n"
+                "sys.exit(first == %r)\n"
+                % (sys.executable, gs_path + ".log", fail_range)
+            )
+        os.chmod(gs_path, 0o755)
+        return gs_path
+
+    def make_book(self, filename, n_pages=250):
+        pdf = Pdf.new()
+        for i in range(n_pages):
+            pdf.add_blank_page(page_size=(612 + i, 792))
+            pdf.pages[i].Contents = pdf.make_stream(b"0 0 m 1 1 l S\n" * 100)
+        return pdf
+
+    def test_shrink_sharded(self):
+        gs_path = self.make_gs()
+        filename = os.path.join(self._tmpdir, "book.pdf")
+        pdf = self.make_book(filename)
+        with pdf.open_outline() as outline:
+            chapter = OutlineItem("Chapter", 100)
+            chapter.children.append(OutlineItem("Section", 180))
+            outline.root.extend([OutlineItem("Intro", 0), chapter])
+        # the output of the stand-in is compressed, so it is smaller
+        pdf.save(filename, compress_streams=False)
+
+        output = shrink_pdf(filename, gs_path=gs_path, gs_shards=4)
+        self.assertTrue(output.endswith("-shrink.pdf"))
+        with Pdf.open(output) as pdf:
+            widths = [float(p.MediaBox[2]) for p in pdf.pages]
+            self.assertEqual(widths, [612.0 + i for i in range(250)])
+            with pdf.open_outline() as outline:
+                intro, chapter = outline.root
+                self.assertEqual(chapter.title, "Chapter")
+                page = chapter.destination[0]
+                self.assertEqual(pdf.pages.index(page), 100)
+                section = chapter.children[0].destination[0]
+                self.assertEqual(pdf.pages.index(section), 180)
+
+    def test_shrink_sharded_cleanup(self):
+        gs_path = self.make_gs(fail_range=1)
+        filename = os.path.join(self._tmpdir, "book.pdf")
+        self.make_book(filename).save(filename, compress_streams=False)
+
+        output = shrink_pdf(filename, gs_path=gs_path, gs_shards=4)
+        self.assertEqual(output, filename)
+        # the page ranges are removed when a range fails
+        self.assertEqual(
+            sorted(os.listdir(self._tmpdir)),
+            ["book.pdf", "gs", "gs.log"],
+        )
+
+    def test_shrink_internal_links(self):
+        gs_path = self.make_gs()
+        filename = os.path.join(self._tmpdir, "book.pdf")
+        pdf = self.make_book(filename)
+        link = pdf.make_indirect(
+            Dictionary(
+                Type=Name.Annot,
+                Subtype=Name.Link,
+                Rect=[0, 0, 100, 100],
+                Dest=[pdf.pages[200].obj, Name.Fit],
+            )
+        )
+        pdf.pages[0].Annots = pdf.make_indirect([link])
+        pdf.save(filename, compress_streams=False)
+
+        output = shrink_pdf(filename, gs_path=gs_path, gs_shards=4)
+        self.assertTrue(output.endswith("-shrink.pdf"))
+        # the file is shrunk as a whole, so the link keeps working
+        with open(gs_path + ".log") as fp:
+            self.assertEqual(fp.read(), "\n")
+
+    def test_analyze_pdf(self):
+        filename = os.path.join(self._tmpdir, "scan.pdf")
+        pdf = Pdf.new()
+        image = pdf.make_stream(zlib.compress(bytes(100 * 100)))
+        image.Type = Name.XObject
+        image.Subtype = Name.Image
+        image.Width = image.Height = 100
+        image.ColorSpace = Name.DeviceGray
+        image.BitsPerComponent = 8
+        image.Filter = Name.FlateDecode
+        for _ in range(4):
+            pdf.add_blank_page(page_size=(595, 842))
+            pdf.pages[-1].Resources = Dictionary(XObject=Dictionary(Im0=image))
+        pdf.add_blank_page(page_size=(612, 792))
+        pdf.pages[-1].Resources = Dictionary(Font=Dictionary(F1=Dictionary()))
+        pdf.save(filename)
+
+        profile = analyze_pdf(filename)
+        self.assertEqual(profile.pages, 5)
+        self.assertEqual(profile.page_sizes[-1], (612, 792))
+        self.assertEqual(profile.scanned_pages, 4)
+        self.assertTrue(profile.scanned)
+        self.assertEqual(len(profile.images), 1)
+        self.assertTrue(profile.well_formed)
+        self.assertFalse(profile.object_streams)
+        self.assertIsNone(profile.arxiv_stamp)
+        self.assertTrue(profile.describes(filename))
+        self.assertFalse(profile.describes(filename + ".copy"))
+        self.assertEqual(profile.estimate_shrink(), estimate_shrink(filename))
+
+        pdf.save(
+            filename,
+            object_stream_mode=ObjectStreamMode.generate,
+            encryption=Encryption(owner="owner", user=""),
+        )
+        profile = analyze_pdf(filename)
+        self.assertTrue(profile.encrypted)
+        self.assertTrue(profile.object_streams)
+        self.assertFalse(profile.well_formed)
+
+        with open(filename, "w") as fp:
+            fp.write("%!PS-Adobe-3.0\n")
+        with self.assertRaises(FileTypeError):
+            analyze_pdf(filename)
+
+    def test_rewrite_skipped(self):
+        filename = os.path.join(self._tmpdir, "paper.pdf")
+        with open(filename, "w") as fp:
+            fp.write(TEST_FILE)
+        prov = LocalFile(upload=False)
+        prov.preflight = analyze_pdf(filename)
+        with prov._timed("rewrite"):
+            output = prov.maybe_rewrite_pdf(filename)
+        self.assertEqual(output, filename)
+        self.assertEqual(prov.timings["rewrite"]["skipped"], "well-formed pdf")
+        self.assertTrue(prov.rewrite_skipped)
+
+    def test_provider_all_skipped(self):
+        # a well-formed file that isn't cropped or shrunk is kept as it is
+        filename = os.path.join(self._tmpdir, "paper.pdf")
+        with open(filename, "w") as fp:
+            fp.write(TEST_FILE)
+        output_dir = os.path.join(self._tmpdir, "output")
+        os.makedirs(output_dir)
+        prov = LocalFile(upload=False, crop="none")
+        with chdir(output_dir):
+            target = prov.run(filename)
+        self.assertEqual(target, os.path.join(output_dir, "paper.pdf"))
+        self.assertEqual(prov.timings["rewrite"]["skipped"], "well-formed pdf")
+        with open(target) as fp:
+            self.assertEqual(fp.read(), TEST_FILE)
+
+    def test_provider_estimate_shrink(self):
+        filename = os.path.join(self._tmpdir, "paper.pdf")
+        with open(filename, "w") as fp:
+            fp.write(TEST_FILE)
+        other = os.path.join(self._tmpdir, "paper-crop.pdf")
+        shutil.copy(filename, other)
+        prov = LocalFile(upload=False)
+        prov.preflight = analyze_pdf(filename)
+        prov.preflight.estimate_shrink = lambda profile: 0.9
+
+        self.assertEqual(prov.estimate_shrink(filename), 0.9)
+        # a rewritten file is analyzed again
+        self.assertLess(prov.estimate_shrink(other), 0.05)
+        prov.rewrite_skipped = True
+        self.assertEqual(prov.estimate_shrink(other), 0.9)
+
+    def test_linearize_pdf(self):
+        filename = os.path.join(self._tmpdir, "paper.pdf")
+        pdf = Pdf.new()
+        for i in range(3):
+            pdf.add_blank_page(page_size=(612, 792))
+            pdf.pages[i].Contents = pdf.make_stream(b"BT (Page) Tj ET")
+        pdf.save(filename)
+
+        output = linearize_pdf(filename)
+        self.assertTrue(output.endswith("-linear.pdf"))
+        with Pdf.open(output) as pdf:
+            self.assertTrue(pdf.is_linearized)
+            self.assertEqual(len(pdf.pages), 3)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,318 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for the HTTP service
+
+This file is part of paper2remarkable.
+
+"""
+
+import contextlib
+import io
+import json
+import multiprocessing
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import unittest
+import urllib.error
+import urllib.request
+
+from unittest import mock
+
+from _constants import TEST_FILE
+
+from paper2remarkable.service import JobQueue
+from paper2remarkable.service import JobServer
+from paper2remarkable.service import _supervise
+from paper2remarkable.service import remove_orphan_uploads
+from paper2remarkable.service import upload_dir
+from paper2remarkable.service import worker
+from paper2remarkable.ui import build_argument_parser
+from paper2remarkable.ui import merge_options
+
+
+def claim_all(path, results):
+    queue = JobQueue(path)
+    while True:
+        job = queue.claim()
+        if job is None:
+            break
+        results.put(job["id"])
+
+
+class StopAfter:
+    """Stop event that is set after a number of checks"""
+
+    def __init__(self, n):
+        self.n = n
+
+    def is_set(self):
+        self.n -= 1
+        return self.n < 0
+
+    def wait(self, timeout=None):
+        pass
+
+
+class FakeProcess:
+    def __init__(self, alive):
+        self.alive = alive
+        self.exitcode = None if alive else 1
+
+    def is_alive(self):
+        return self.alive
+
+
+class TestJobQueue(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        self.queue = JobQueue(os.path.join(self.tmpdir, "jobs.sqlite"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lifecycle(self):
+        job_id = self.queue.submit(
+            "https://arxiv.org/abs/1811.11242", options={"blank": True}
+        )
+        job = self.queue.claim()
+        self.assertEqual(job["id"], job_id)
+        self.assertEqual(job["status"], "running")
+        self.assertEqual(job["attempts"], 1)
+        self.assertEqual(job["options"], {"blank": True})
+        self.assertIsNone(self.queue.claim())
+
+        self.assertFalse(self.queue.retry(job_id))
+        self.queue.fail(job_id, "broken")
+        self.assertEqual(self.queue.get(job_id)["error"], "broken")
+        self.assertTrue(self.queue.retry(job_id))
+        job = self.queue.claim()
+        self.assertEqual(job["attempts"], 2)
+        self.assertIsNone(job["error"])
+
+        self.queue.finish(job_id, result="/tmp/paper.pdf")
+        self.assertEqual(self.queue.list(status="done")[0]["id"], job_id)
+
+    def test_recover(self):
+        job_id = self.queue.submit("paper.pdf", source="file")
+        self.queue.claim()
+        self.queue.recover()
+        self.assertEqual(self.queue.get(job_id)["status"], "queued")
+
+    def test_claim_concurrent(self):
+        for i in range(50):
+            self.queue.submit("paper_%i.pdf" % i, source="file")
+        results = multiprocessing.Queue()
+        procs = [
+            multiprocessing.Process(
+                target=claim_all, args=(self.queue.path, results)
+            )
+            for _ in range(4)
+        ]
+        for proc in procs:
+            proc.start()
+        claimed = [results.get(timeout=30) for _ in range(50)]
+        for proc in procs:
+            proc.join()
+        self.assertEqual(sorted(claimed), list(range(1, 51)))
+
+
+class TestJobServer(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        self.queue = JobQueue(os.path.join(self.tmpdir, "jobs.sqlite"))
+        self.server = JobServer(
+            ("127.0.0.1", 0), self.queue, accounts={"alice": "rmapi.conf"}
+        )
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.base = "http://127.0.0.1:%i" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+        shutil.rmtree(self.tmpdir)
+
+    def request(self, path, data=None, content_type="application/json"):
+        if isinstance(data, dict):
+            data = json.dumps(data).encode("utf-8")
+        req = urllib.request.Request(self.base + path, data=data)
+        if data is not None:
+            req.add_header("Content-Type", content_type)
+        try:
+            with urllib.request.urlopen(req) as res:
+                return res.status, json.loads(res.read())
+        except urllib.error.HTTPError as err:
+            return err.code, json.loads(err.read())
+
+    def test_submit_url(self):
+        job = {
+            "url": "https://arxiv.org/abs/1811.11242",
+            "account": "alice",
+            "options": {"crop": "center", "remarkable_dir": "/papers"},
+        }
+        status, data = self.request("/jobs", job)
+        self.assertEqual(status, 201)
+        self.assertEqual(data["status"], "queued")
+        self.assertEqual(data["source"], "url")
+        self.assertEqual(data["account"], "alice")
+
+        status, data = self.request("/jobs/%i" % data["id"])
+        self.assertEqual(status, 200)
+        self.assertEqual(data["options"]["crop"], "center")
+        status, data = self.request("/jobs?status=queued")
+        self.assertEqual(len(data), 1)
+        status, _ = self.request("/jobs/100")
+        self.assertEqual(status, 404)
+
+    def test_submit_invalid(self):
+        jobs = [
+            {"url": "https://arxiv.org/abs/1811.11242", "account": "bob"},
+            {"url": "https://arxiv.org/abs/1811.11242", "options": {"x": 1}},
+            {"url": "x", "options": {"crop": "top"}},
+            {"url": "x", "options": {"remarkable_dir": "/../../etc"}},
+            {"path": "/etc/passwd"},
+            {"url": "x", "filename": "../../.bashrc.pdf"},
+            {"url": "x", "filename": "/tmp/paper.pdf"},
+            {"url": "x", "filename": "paper.sh"},
+            {"url": "x", "filename": "paper\0.pdf"},
+            {"url": "x", "filename": ["paper.pdf"]},
+        ]
+        for job in jobs:
+            with self.subTest(job=job):
+                status, data = self.request("/jobs", job)
+                self.assertEqual(status, 400)
+                self.assertIn("error", data)
+
+    def test_submit_file(self):
+        body = TEST_FILE.encode("utf-8")
+        status, data = self.request(
+            "/jobs?filename=test.pdf&blank=true",
+            body,
+            content_type="application/pdf",
+        )
+        self.assertEqual(status, 201)
+        self.assertEqual(data["source"], "file")
+        self.assertEqual(data["filename"], "test.pdf")
+        self.assertEqual(data["options"], {"blank": True})
+        self.assertTrue(os.path.exists(data["input"]))
+
+        status, _ = self.request(
+            "/jobs", b"not a pdf", content_type="application/pdf"
+        )
+        self.assertEqual(status, 400)
+        status, _ = self.request(
+            "/jobs?filename=../test.pdf",
+            body,
+            content_type="application/pdf",
+        )
+        self.assertEqual(status, 400)
+
+    def test_retry(self):
+        job_id = self.queue.submit("paper.pdf", source="file")
+        status, _ = self.request("/jobs/%i/retry" % job_id, b"")
+        self.assertEqual(status, 409)
+        self.queue.claim()
+        self.queue.fail(job_id, "broken")
+        status, data = self.request("/jobs/%i/retry" % job_id, b"")
+        self.assertEqual(status, 200)
+        self.assertEqual(data["status"], "queued")
+
+
+class TestWorker(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        self.queue = JobQueue(os.path.join(self.tmpdir, "jobs.sqlite"))
+        args = build_argument_parser().parse_args(["--no-crop", "input"])
+        self.options = merge_options(args)
+        self.service = {
+            "upload_dir": os.path.join(self.tmpdir, "uploads"),
+            "accounts": {"alice": "rmapi.conf"},
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_worker_failure(self):
+        job_id = self.queue.submit(
+            os.path.join(self.tmpdir, "missing.pdf"), source="file"
+        )
+        worker(self.queue.path, self.options, self.service, StopAfter(1))
+        job = self.queue.get(job_id)
+        self.assertEqual(job["status"], "failed")
+        self.assertIn("Traceback", job["error"])
+
+    def test_worker_upload_dir(self):
+        source = os.path.join(self.tmpdir, "test.pdf")
+        with open(source, "w") as fp:
+            fp.write(TEST_FILE)
+        job_id = self.queue.submit(
+            source,
+            source="file",
+            filename="paper.pdf",
+            account="alice",
+            options={"remarkable_dir": "/papers"},
+        )
+        worker(self.queue.path, self.options, self.service, StopAfter(1))
+        job = self.queue.get(job_id)
+        self.assertEqual(job["status"], "done", msg=job["error"])
+        expected = os.path.join(
+            self.service["upload_dir"], "alice", "papers", "paper.pdf"
+        )
+        self.assertEqual(job["result"], expected)
+        self.assertTrue(os.path.exists(expected))
+
+    def test_worker_removes_upload(self):
+        os.makedirs(upload_dir(self.queue.path))
+        source = os.path.join(upload_dir(self.queue.path), "upload_1.pdf")
+        with open(source, "w") as fp:
+            fp.write(TEST_FILE)
+        job_id = self.queue.submit(source, source="file", filename="paper.pdf")
+        worker(self.queue.path, self.options, self.service, StopAfter(1))
+        job = self.queue.get(job_id)
+        self.assertEqual(job["status"], "done", msg=job["error"])
+        self.assertFalse(os.path.exists(source))
+
+        # uploads that no job refers to are removed at startup
+        orphan = os.path.join(upload_dir(self.queue.path), "upload_2.pdf")
+        open(orphan, "w").close()
+        remove_orphan_uploads(self.queue)
+        self.assertFalse(os.path.exists(orphan))
+
+    def test_worker_queue_error(self):
+        job_id = self.queue.submit(
+            os.path.join(self.tmpdir, "missing.pdf"), source="file"
+        )
+        claim = JobQueue.claim
+        errors = [sqlite3.OperationalError("database is locked")]
+
+        def flaky_claim(queue):
+            if errors:
+                raise errors.pop()
+            return claim(queue)
+
+        err = io.StringIO()
+        with mock.patch.object(JobQueue, "claim", flaky_claim):
+            with contextlib.redirect_stderr(err):
+                worker(
+                    self.queue.path, self.options, self.service, StopAfter(2)
+                )
+        # the worker keeps going after the error
+        self.assertIn("database is locked", err.getvalue())
+        self.assertEqual(self.queue.get(job_id)["status"], "failed")
+
+    def test_supervise(self):
+        workers = [FakeProcess(True), FakeProcess(False)]
+        stop = mock.Mock()
+        stop.wait.side_effect = [False, True]
+        with contextlib.redirect_stderr(io.StringIO()):
+            _supervise(workers, lambda: FakeProcess(True), stop, interval=0)
+        self.assertTrue(all(proc.is_alive() for proc in workers))
+
+
+if __name__ == "__main__":
+    unittest.main()
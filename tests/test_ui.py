@@ -9,9 +9,13 @@ This file is part of paper2remarkable.
 
 import os
 import shutil
+import subprocess
+import sys
 import tempfile
 import unittest
 
+from _constants import TEST_FILE
+
 from paper2remarkable.exceptions import InvalidURLError
 from paper2remarkable.exceptions import UnidentifiedSourceError
 from paper2remarkable.providers.acl import ACL
@@ -30,9 +34,11 @@ from paper2remarkable.providers.openreview import OpenReview
 from paper2remarkable.providers.pdf_url import PdfUrl
 from paper2remarkable.providers.pmlr import PMLR
 from paper2remarkable.providers.pubmed import PubMed
+from paper2remarkable.providers.semantic_scholar import SemanticScholar
 from paper2remarkable.providers.springer import Springer
 from paper2remarkable.ui import build_argument_parser
 from paper2remarkable.ui import choose_provider
+from paper2remarkable.ui import execute
 from paper2remarkable.ui import merge_options
 from paper2remarkable.ui import runner
 from paper2remarkable.utils import chdir
@@ -259,6 +265,111 @@ class TestUI(unittest.TestCase):
         # Note: we can't test incorrect source type for URL because it will
         # raise an exception when determining the correct provider
 
+    def test_get_identity(self):
+        arxiv = ["abs/1811.11242", "abs/1811.11242v2", "pdf/1811.11242v1.pdf"]
+        tests = [
+            (Arxiv, "https://arxiv.org/" + u, "arxiv:1811.11242")
+            for u in arxiv
+        ] + [
+            (
+                ACL,
+                "https://www.aclweb.org/anthology/P19-1001.pdf",
+                "acl:P19-1001",
+            ),
+            (ACL, "https://aclanthology.org/P19-1001/", "acl:P19-1001"),
+            (
+                ACM,
+                "https://dl.acm.org/doi/pdf/10.1145/3025453.3026030",
+                "doi:10.1145/3025453.3026030",
+            ),
+            (
+                ACM,
+                "https://dl.acm.org/doi/pdf/10.1145/3025453.3026030.pdf",
+                "doi:10.1145/3025453.3026030",
+            ),
+            (
+                Springer,
+                "https://link.springer.com/article/10.1007/s10994-020-05910-7",
+                "doi:10.1007/s10994-020-05910-7",
+            ),
+            (
+                Springer,
+                "https://link.springer.com/content/pdf/"
+                "10.1007/s10994-020-05910-7.pdf",
+                "doi:10.1007/s10994-020-05910-7",
+            ),
+            (
+                Nature,
+                "https://www.nature.com/articles/s41586-020-2649-2.pdf",
+                "doi:10.1038/s41586-020-2649-2",
+            ),
+            (IACR, "https://eprint.iacr.org/2020/1021.pdf", "iacr:2020/1021"),
+            (
+                ECCC,
+                "https://eccc.weizmann.ac.il/report/2019/052/download/",
+                "eccc:2019/052",
+            ),
+            (NBER, "https://www.nber.org/papers/w26752.pdf", "nber:w26752"),
+            (
+                JMLR,
+                "http://www.jmlr.org/papers/volume17/14-526/14-526.pdf",
+                "jmlr:v17/14-526",
+            ),
+            (
+                CVF,
+                "https://openaccess.thecvf.com/content_ICCV_2019/papers/x_y_ICCV_2019_paper.pdf",
+                "cvf:ICCV_2019/x_y_ICCV_2019_paper",
+            ),
+            (
+                SemanticScholar,
+                "https://www.semanticscholar.org/paper/"
+                "A-Bayesian-Hierarchical-Model/"
+                "0e2bb2f9b1c4ba0a2e75b9c5d9c8b05e1e8a2a3a",
+                "s2:0e2bb2f9b1c4ba0a2e75b9c5d9c8b05e1e8a2a3a",
+            ),
+            (
+                PdfUrl,
+                "https://Example.com/files/paper.pdf#page=2",
+                "url:example.com/files/paper.pdf",
+            ),
+        ]
+        for provider, url, exp in tests:
+            with self.subTest(url=url):
+                self.assertEqual(provider.get_identity(url), exp)
+
+        # local files are identified by their contents
+        for name in ["a.pdf", "b.pdf"]:
+            with open(name, "w") as fp:
+                fp.write(TEST_FILE)
+        self.assertTrue(LocalFile.get_identity("a.pdf").startswith("sha256:"))
+        self.assertEqual(
+            LocalFile.get_identity("a.pdf"), LocalFile.get_identity("b.pdf")
+        )
+
+    def test_import_time(self):
+        # Heavy dependencies should only be imported when they're needed.
+        # Use 'make importtime' to see where the time goes.
+        heavy = [
+            "bs4",
+            "Crypto",
+            "html2text",
+            "markdown",
+            "pdfplumber",
+            "pikepdf",
+            "readability",
+            "titlecase",
+            "weasyprint",
+        ]
+        code = (
+            "import sys; import paper2remarkable.ui; "
+            "print(' '.join(sys.modules))"
+        )
+        output = subprocess.check_output([sys.executable, "-c", code])
+        modules = set(m.split(".")[0] for m in output.decode().split())
+        for name in heavy:
+            with self.subTest(name):
+                self.assertNotIn(name, modules)
+
     def test_merge_options_1(self):
         config = None
         source = "/tmp/local.pdf"  # doesn't need to exist
@@ -403,6 +514,22 @@ class TestUI(unittest.TestCase):
         self.assertEqual(opts["html"]["css"], "Hello, World!\n")
         self.assertEqual(opts["html"]["font_urls"], ["url_1", "url_2"])
 
+    def test_execute_invalid_options(self):
+        configs = [
+            "core:\n  shrink_profile: tiny\n",
+            "system:\n  gs_backend: fast\n",
+        ]
+        parser = build_argument_parser()
+        for config in configs:
+            with self.subTest(config=config):
+                with open("config.yml", "w") as fp:
+                    fp.write(config)
+                args = parser.parse_args(
+                    ["--config", "config.yml", "paper.pdf"]
+                )
+                with self.assertRaises(SystemExit):
+                    execute(args)
+
     def test_runner_1(self):
         inputs = [
             "https://arxiv.org/abs/1811.11242v1",
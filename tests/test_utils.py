@@ -1,13 +1,161 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import http.server
 import os
 import tempfile
+import threading
+import time
 import unittest
 
+from unittest import mock
+
 from paper2remarkable.exceptions import NoPDFToolError
+from paper2remarkable.exceptions import RemarkableError
+from paper2remarkable.tools import ToolRegistry
 from paper2remarkable.utils import chdir
 from paper2remarkable.utils import check_pdftool
+from paper2remarkable.utils import download_url
+from paper2remarkable.utils import get_head_with_retry
+from paper2remarkable.utils import get_page_with_retry
+from paper2remarkable.utils import get_soup_with_retry
+from paper2remarkable.utils import page_memo
+from paper2remarkable.utils import parse_head
+from paper2remarkable.utils import upload_to_remarkable_rmapi
+
+
+class CountingHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a small HTML page and counts the requests"""
+
+    count = 0
+
+    def do_GET(self):
+        CountingHandler.count += 1
+        body = b"<html><head><title>Paper</title></head></html>"
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class LargePageHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a page with a head and a large body"""
+
+    head = b'<html><head><meta name="citation_title" content="Paper"></head>'
+    body = b"<body>" + b"x" * (10 * 1024 * 1024) + b"</body></html>"
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(self.head + self.body)))
+        self.end_headers()
+        try:
+            self.wfile.write(self.head)
+            self.wfile.write(self.body)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def log_message(self, *args):
+        pass
+
+
+class Latin1PageHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a page with the charset only in the Content-Type header"""
+
+    def do_GET(self):
+        body = b'<html><head><meta name="citation_title" content="Caf\xe9">'
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=ISO-8859-1")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class BrokenHeadHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a page, but drops the connection in the first transfer"""
+
+    count = 0
+
+    def do_GET(self):
+        BrokenHeadHandler.count += 1
+        body = b'<html><head><meta name="citation_title" content="Paper">'
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html")
+        self.send_header("Content-Length", str(len(body) + 1024))
+        self.end_headers()
+        if BrokenHeadHandler.count == 1:
+            self.wfile.write(body[:10])
+            self.close_connection = True
+            return
+        self.wfile.write(body + b" " * 1024)
+
+    def log_message(self, *args):
+        pass
+
+
+class FlakyRangeHandler(http.server.BaseHTTPRequestHandler):
+    """Serves a file with range support, but drops the first transfer"""
+
+    data = bytes(range(256)) * 1024
+    seen_ranges = []
+
+    def do_GET(self):
+        rng = self.headers.get("Range")
+        self.seen_ranges.append(rng)
+        start = 0
+        if rng and self.headers.get("If-Range") == '"v1"':
+            start = int(rng[len("bytes=") : -1])
+        body = self.data[start:]
+
+        self.send_response(206 if start else 200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(body)))
+        if start:
+            self.send_header(
+                "Content-Range",
+                "bytes %i-%i/%i" % (start, len(self.data) - 1, len(self.data)),
+            )
+        self.end_headers()
+
+        if len(self.seen_ranges) == 1:
+            self.wfile.write(body[: len(body) // 3])
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class MisalignedRangeHandler(FlakyRangeHandler):
+    """Drops the first transfer and answers the range from the wrong start"""
+
+    seen_ranges = []
+
+    def do_GET(self):
+        self.seen_ranges.append(self.headers.get("Range"))
+        self.send_response(206 if len(self.seen_ranges) == 2 else 200)
+        self.send_header("ETag", '"v1"')
+        self.send_header("Content-Length", str(len(self.data)))
+        if len(self.seen_ranges) == 2:
+            self.send_header(
+                "Content-Range",
+                "bytes 0-%i/%i" % (len(self.data) - 1, len(self.data)),
+            )
+        self.end_headers()
+
+        if len(self.seen_ranges) == 1:
+            self.wfile.write(self.data[: len(self.data) // 3])
+            self.close_connection = True
+            return
+        self.wfile.write(self.data)
 
 
 class TestUtils(unittest.TestCase):
@@ -19,6 +167,248 @@ class TestUtils(unittest.TestCase):
         with self.assertRaises(NoPDFToolError):
             check_pdftool("pdftk_xyz", "qpdf_xyz")
 
+    def test_tool_registry(self):
+        tmpdir = tempfile.mkdtemp(prefix="p2r_test_tools_")
+        counter = os.path.join(tmpdir, "count")
+        exe = os.path.join(tmpdir, "qpdf")
+        with open(exe, "w") as fp:
+            fp.write(
+                "#!/bin/sh\necho x >> %s\necho 'qpdf version 11.0'\n" % counter
+            )
+        os.chmod(exe, 0o755)
+
+        def num_probes():
+            with open(counter, "r") as fp:
+                return len(fp.readlines())
+
+        cache_file = os.path.join(tmpdir, "tools.json")
+        registry = ToolRegistry(cache_file=cache_file)
+        tool = registry.find("qpdf", exe)
+        self.assertEqual(tool.version, "qpdf version 11.0")
+        self.assertEqual(registry.find("qpdf", exe), tool)
+        self.assertEqual(num_probes(), 1)
+        self.assertIsNone(registry.find("qpdf", exe + "_xyz"))
+
+        # probe results are persisted
+        registry = ToolRegistry(cache_file=cache_file)
+        self.assertEqual(registry.find("qpdf", exe), tool)
+        self.assertEqual(num_probes(), 1)
+
+        # a changed executable is probed again
+        os.utime(exe, (0, 0))
+        registry.find("qpdf", exe)
+        self.assertEqual(num_probes(), 2)
+        self.assertEqual(
+            sorted(os.listdir(tmpdir)), ["count", "qpdf", "tools.json"]
+        )
+
+        # a cache file that can't be written doesn't stop the lookup
+        cache_file = os.path.join(tmpdir, "missing", "tools.json")
+        registry = ToolRegistry(cache_file=cache_file)
+        self.assertEqual(registry.find("qpdf", exe).version, tool.version)
+
+    def test_upload_missing_rmapi(self):
+        with self.assertRaises(RemarkableError):
+            upload_to_remarkable_rmapi("paper.pdf", rmapi_path="/no/rmapi")
+
+    def test_download_url_resume(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), FlakyRangeHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%i/paper.pdf" % server.server_port
+
+        tmpdir = tempfile.mkdtemp(prefix="p2r_test_download_")
+        filename = os.path.join(tmpdir, "paper.pdf")
+        try:
+            with mock.patch("paper2remarkable.utils.time.sleep"):
+                download_url(url, filename)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with open(filename, "rb") as fp:
+            self.assertEqual(fp.read(), FlakyRangeHandler.data)
+        # the second request only asks for the missing part
+        first, second = FlakyRangeHandler.seen_ranges
+        self.assertIsNone(first)
+        self.assertTrue(second.startswith("bytes="))
+        self.assertNotEqual(second, "bytes=0-")
+        self.assertFalse(os.path.exists(filename + ".part"))
+
+    def test_download_url_misaligned_range(self):
+        server = http.server.HTTPServer(
+            ("127.0.0.1", 0), MisalignedRangeHandler
+        )
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%i/paper.pdf" % server.server_port
+
+        tmpdir = tempfile.mkdtemp(prefix="p2r_test_download_")
+        filename = os.path.join(tmpdir, "paper.pdf")
+        try:
+            with mock.patch("paper2remarkable.utils.time.sleep") as sleep:
+                download_url(url, filename, tries=2)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+        with open(filename, "rb") as fp:
+            self.assertEqual(fp.read(), MisalignedRangeHandler.data)
+        # the wrong range is discarded and retried without waiting
+        first, second, third = MisalignedRangeHandler.seen_ranges
+        self.assertIsNotNone(second)
+        self.assertIsNone(third)
+        self.assertEqual(sleep.call_count, 1)
+
+    def test_download_url_cancel(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), LargePageHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%i/paper.pdf" % server.server_port
+
+        tmpdir = tempfile.mkdtemp(prefix="p2r_test_download_")
+        filename = os.path.join(tmpdir, "paper.pdf")
+        cancel = threading.Event()
+        cancel.set()
+        try:
+            download_url(url, filename, cancel=cancel)
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertEqual(os.listdir(tmpdir), [])
+
+        # the wait before the next attempt ends when it is cancelled
+        cancel = threading.Event()
+        timer = threading.Timer(0.2, cancel.set)
+        timer.start()
+        start = time.monotonic()
+        download_url("http://127.0.0.1:1/paper.pdf", filename, cancel=cancel)
+        self.assertLess(time.monotonic() - start, 2)
+        self.assertEqual(os.listdir(tmpdir), [])
+
+    def test_page_memo(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), CountingHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%i/abs" % server.server_port
+        try:
+            with page_memo():
+                page = get_page_with_retry(url)
+                soup1 = get_soup_with_retry(url)
+                soup2 = get_soup_with_retry(url)
+            self.assertEqual(CountingHandler.count, 1)
+            self.assertIn(b"Paper", page)
+            self.assertIs(soup1, soup2)
+
+            # outside the context every call goes to the server
+            get_page_with_retry(url)
+            self.assertEqual(CountingHandler.count, 2)
+
+            # every run has its own memo, which other threads don't see
+            def other_run():
+                with page_memo():
+                    get_page_with_retry(url)
+                    get_page_with_retry(url)
+
+            with page_memo():
+                get_page_with_retry(url)
+                worker = threading.Thread(target=other_run)
+                worker.start()
+                worker.join()
+                get_page_with_retry(url)
+            self.assertEqual(CountingHandler.count, 4)
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_page_head_only(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), LargePageHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%i/abs" % server.server_port
+        try:
+            with page_memo():
+                head = get_page_with_retry(url, head_only=True)
+                self.assertTrue(head.startswith(LargePageHandler.head))
+                self.assertLess(len(head), 1024 * 1024)
+                self.assertIs(get_page_with_retry(url, head_only=True), head)
+
+                # a full page also serves later head only requests
+                page = get_page_with_retry(url)
+                self.assertEqual(
+                    len(page),
+                    len(LargePageHandler.head) + len(LargePageHandler.body),
+                )
+                self.assertEqual(
+                    get_page_with_retry(url, head_only=True), page
+                )
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_page_head_only_retry(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), BrokenHeadHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%i/abs" % server.server_port
+        try:
+            with mock.patch("paper2remarkable.utils.time.sleep") as sleep:
+                head = get_head_with_retry(url, tries=2)
+            meta = head.find("meta", {"name": "citation_title"})
+            self.assertEqual(meta["content"], "Paper")
+            self.assertEqual(BrokenHeadHandler.count, 2)
+            sleep.assert_called_once()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_parse_head(self):
+        page = (
+            b"<!DOCTYPE html><html><head>"
+            b'<meta charset="iso-8859-1">'
+            b"<title>A Paper</title>"
+            b'<meta name="citation_title" content="Caf\xe9 &amp; Paper">'
+            b'<meta name="citation_author" content="Doe, J.">'
+            b'<meta name="citation_author" content="Roe, R." />'
+            b"</head><body>"
+            b'<meta name="citation_author" content="Body, B.">'
+            b"<p>" + b"x" * 100000 + b"</p></body></html>"
+        )
+        head = parse_head(page)
+        self.assertEqual(head.title, "A Paper")
+        meta = head.find_all("meta", {"name": "citation_title"})
+        self.assertEqual(meta[0]["content"], "Caf\xe9 & Paper")
+        authors = head.find_all("meta", {"name": "citation_author"})
+        self.assertEqual(
+            [x["content"] for x in authors], ["Doe, J.", "Roe, R."]
+        )
+        self.assertIsNone(head.find("meta", {"name": "citation_date"}))
+
+        # without the end of the head, parsing stops at the body
+        head = parse_head(page.replace(b"</head>", b""))
+        self.assertEqual(
+            len(head.find_all("meta", {"name": "citation_author"})), 2
+        )
+
+        # the charset of the Content-Type header comes first
+        page = page.replace(b"iso-8859-1", b"utf-8")
+        head = parse_head(page, charset="iso-8859-1")
+        meta = head.find("meta", {"name": "citation_title"})
+        self.assertEqual(meta["content"], "Caf\xe9 & Paper")
+
+    def test_head_header_charset(self):
+        server = http.server.HTTPServer(("127.0.0.1", 0), Latin1PageHandler)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        url = "http://127.0.0.1:%i/abs" % server.server_port
+        try:
+            head = get_head_with_retry(url)
+            meta = head.find("meta", {"name": "citation_title"})
+            self.assertEqual(meta["content"], "Caf\xe9")
+        finally:
+            server.shutdown()
+            server.server_close()
+
     def test_chdir_1(self):
         start_dir = os.getcwd()
         tmpdir1 = tempfile.mkdtemp(prefix="p2r_test_chdir_")
@@ -0,0 +1,152 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Unit tests for watching a directory
+
+This file is part of paper2remarkable.
+
+"""
+
+import concurrent.futures
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+from _constants import TEST_FILE
+
+from paper2remarkable.watch import FolderWatcher
+from paper2remarkable.watch import Inotify
+from paper2remarkable.watch import Poller
+
+
+def fake_process(path, options):
+    if "broken" in path:
+        raise ValueError("broken file")
+    options["processed"].append(os.path.basename(path))
+
+
+def remove_process(path, options):
+    os.unlink(path)
+    raise ValueError("file removed")
+
+
+class SilentSource:
+    """Source that never reports changes, like inotify on a network mount"""
+
+    def wait(self, timeout):
+        time.sleep(timeout)
+        return set()
+
+    def close(self):
+        pass
+
+
+class TestFolderWatcher(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp(prefix="p2r_test_")
+        self.options = {"processed": []}
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def make_watcher(self, process=fake_process):
+        return FolderWatcher(
+            self.tmpdir,
+            self.options,
+            workers=1,
+            settle_time=0.2,
+            poll_interval=0.05,
+            executor=concurrent.futures.ThreadPoolExecutor(max_workers=1),
+            process=process,
+        )
+
+    def write(self, name, data=TEST_FILE, mode="w"):
+        with open(os.path.join(self.tmpdir, name), mode) as fp:
+            fp.write(data)
+
+    def run_until(self, watcher, condition, timeout=5):
+        start = time.monotonic()
+        while not condition() and time.monotonic() - start < timeout:
+            watcher.step()
+
+    def test_process_files(self):
+        self.write("existing.pdf")
+        watcher = self.make_watcher()
+        self.write("new.pdf")
+        self.write("broken.pdf")
+        self.write("notes.txt")
+
+        done = os.path.join(self.tmpdir, "done")
+        failed = os.path.join(self.tmpdir, "failed")
+        self.run_until(
+            watcher,
+            lambda: len(os.listdir(done)) == 2 and len(os.listdir(failed)),
+        )
+        watcher.close()
+
+        self.assertEqual(
+            sorted(self.options["processed"]), ["existing.pdf", "new.pdf"]
+        )
+        self.assertEqual(sorted(os.listdir(done)), ["existing.pdf", "new.pdf"])
+        self.assertEqual(
+            sorted(os.listdir(failed)),
+            ["broken.pdf", "broken.pdf.error.txt"],
+        )
+        with open(os.path.join(failed, "broken.pdf.error.txt")) as fp:
+            self.assertIn("broken file", fp.read())
+        self.assertTrue(os.path.exists(os.path.join(self.tmpdir, "notes.txt")))
+
+    def test_debounce(self):
+        watcher = self.make_watcher()
+        # keep writing to the file for longer than the settle time
+        for i in range(8):
+            self.write("slow.pdf", data="x" * 100, mode="a")
+            watcher.step()
+            time.sleep(0.05)
+            self.assertEqual(self.options["processed"], [])
+
+        done = os.path.join(self.tmpdir, "done")
+        self.run_until(watcher, lambda: os.listdir(done))
+        watcher.close()
+        self.assertEqual(self.options["processed"], ["slow.pdf"])
+
+    def test_rescan(self):
+        watcher = self.make_watcher()
+        watcher.source.close()
+        watcher.source = SilentSource()
+        self.write("network.pdf")
+
+        done = os.path.join(self.tmpdir, "done")
+        self.run_until(watcher, lambda: os.listdir(done))
+        watcher.close()
+        self.assertEqual(self.options["processed"], ["network.pdf"])
+
+    def test_removed_while_processing(self):
+        watcher = self.make_watcher(process=remove_process)
+        self.write("removed.pdf")
+        self.run_until(
+            watcher,
+            lambda: not os.path.exists(
+                os.path.join(self.tmpdir, "removed.pdf")
+            )
+            and not watcher.in_flight,
+        )
+        watcher.close()
+        self.assertEqual(os.listdir(os.path.join(self.tmpdir, "failed")), [])
+
+    def test_sources(self):
+        self.assertIsNone(Poller().wait(0))
+        try:
+            source = Inotify(self.tmpdir)
+        except (OSError, AttributeError):
+            self.skipTest("inotify not available")
+        self.assertEqual(source.wait(0), set())
+        self.write("paper.pdf")
+        self.assertEqual(source.wait(1), {"paper.pdf"})
+        source.close()
+
+
+if __name__ == "__main__":
+    unittest.main()